@@ -0,0 +1,49 @@
+import random
+from datetime import datetime, timedelta
+
+from ingest import ChannelSource, SourcePost
+
+_VOCAB_SIZE = 2000
+
+
+# Deterministic channel source: every channel yields `messages` distinct posts;
+# `dup_ratio` of them repeat a story shared by the whole block, as reposts do.
+class SyntheticSource(ChannelSource):
+    def __init__(self, messages: int, words: int = 60, dup_ratio: float = 0.0, seed: int = 1):
+        self.messages = messages
+        self.words = words
+        self.dup_ratio = dup_ratio
+        self.seed = seed
+        rng = random.Random(seed)
+        self.vocab = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
+                      for _ in range(_VOCAB_SIZE)]
+
+    def _text(self, rng) -> str:
+        return ' '.join(rng.choice(self.vocab) for _ in range(self.words))
+
+    async def fetch(self, username, since, after_id=None):
+        rng = random.Random(f"{self.seed}:{username}")
+        shared = random.Random(f"{self.seed}:shared")
+        now = datetime.utcnow()
+        step = max((now - since).total_seconds() / (self.messages + 1), 1)
+        posts = []
+        for i in range(1, self.messages + 1):
+            story = self._text(shared)
+            text = story if rng.random() < self.dup_ratio else self._text(rng)
+            if i > (after_id or 0):
+                posts.append(SourcePost(i, text, now - timedelta(seconds=step * (self.messages - i + 1))))
+        return posts
+
+
+async def seed_blocks(session_factory, blocks: int, channels: int) -> list:
+    from models import ThemeBlock, Channel
+    ids = []
+    async with session_factory() as session:
+        for b in range(blocks):
+            block = ThemeBlock(title=f"bench-{b}-{datetime.utcnow().timestamp()}")
+            session.add(block)
+            await session.flush()
+            session.add_all([Channel(block_id=block.id, username=f"@bench_{b}_{c}") for c in range(channels)])
+            ids.append(block.id)
+        await session.commit()
+    return ids
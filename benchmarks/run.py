@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from itertools import count
+
+from stubs.deepseek_stub import DeepSeekStub
+from stubs.fake_telegram import FakeTelegram
+
+# End-to-end pipeline benchmark: scan_block -> callback_rewrite ->
+# callback_mod_approve -> publish_scheduled, against local stand-ins for
+# DeepSeek and the Bot API.
+#
+#   python -m benchmarks.run --blocks 2 --channels 20 --messages 25
+#   python -m benchmarks.run --database-url postgresql+asyncpg://... --baseline old.json
+
+BENCH_CHAT = -1000000000001
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def summarize(latencies: list, elapsed: float, items: int = None) -> dict:
+    items = len(latencies) if items is None else items
+    return {
+        'items': items,
+        'seconds': round(elapsed, 4),
+        'throughput': round(items / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+async def run_stage(fn, items: list, concurrency: int):
+    sem = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(item):
+        nonlocal errors
+        async with sem:
+            start = time.perf_counter()
+            try:
+                await fn(item)
+            except Exception:
+                errors += 1
+                logging.getLogger('benchmark').exception("Stage call failed")
+                return
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in items))
+    result = summarize(latencies, time.perf_counter() - start)
+    result['errors'] = errors
+    return result
+
+
+# Minimal CallbackQuery/Message doubles; their Telegram calls go to the fake Bot API
+_ids = count(1)
+
+class FakeMessage:
+    def __init__(self, bot):
+        self.bot = bot
+        self.chat_id = BENCH_CHAT
+        self.message_id = next(_ids)
+
+    async def edit_text(self, text, reply_markup=None):
+        return await self.bot.edit_message_text(text=text, chat_id=self.chat_id,
+                                                message_id=self.message_id, reply_markup=reply_markup)
+
+    async def edit_reply_markup(self, reply_markup=None):
+        return await self.bot.edit_message_reply_markup(chat_id=self.chat_id, message_id=self.message_id,
+                                                        reply_markup=reply_markup)
+
+    async def delete_reply_markup(self):
+        return await self.edit_reply_markup(None)
+
+    async def delete(self):
+        return await self.bot.delete_message(self.chat_id, self.message_id)
+
+    async def reply(self, text, reply_markup=None):
+        return await self.bot.send_message(self.chat_id, text, reply_markup=reply_markup)
+
+class FakeCallback:
+    def __init__(self, bot, data: str):
+        self.bot = bot
+        self.id = str(next(_ids))
+        self.data = data
+        self.message = FakeMessage(bot)
+
+    async def answer(self, text=None, **kwargs):
+        return await self.bot.answer_callback_query(self.id, text=text)
+
+
+async def benchmark(args) -> dict:
+    deepseek = DeepSeekStub(latency=args.deepseek_latency, jitter=args.deepseek_jitter,
+                            error_rate=args.deepseek_error_rate, capacity=args.deepseek_capacity, seed=args.seed)
+    telegram = FakeTelegram(latency=args.telegram_latency, seed=args.seed)
+    os.environ['DEESEEK_API_URL'] = await deepseek.start()
+    os.environ['TELEGRAM_API_URL'] = await telegram.start()
+    os.environ.setdefault('DEESEEK_API_KEY', 'bench')
+    os.environ['BOT_TOKEN'] = '123456:BENCHMARK'
+    os.environ['PUBLISH_CHAT_RATE'] = str(args.chat_rate)
+    os.environ['PUBLISH_CHAT_BURST'] = str(max(args.chat_rate, 1))
+    os.environ['PUBLISH_GLOBAL_RATE'] = str(max(args.chat_rate, 25))
+    tmpdir = None
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    else:
+        tmpdir = tempfile.mkdtemp(prefix='contentmaker-bench-')
+        os.environ['DATABASE_URL'] = f"sqlite+aiosqlite:///{os.path.join(tmpdir, 'bench.db')}"
+
+    # Application modules read their configuration at import time
+    import bot as app
+    import context
+    import ingest
+    from models import AsyncSessionLocal, init_db, RewriteTask, Message as MsgModel, Channel, PublicationSchedule
+    from sqlalchemy import select, update
+    from publisher import get_bot, publish_scheduled
+    from benchmarks.dataset import SyntheticSource, seed_blocks
+    logging.getLogger().setLevel(logging.WARNING)
+
+    stages = {}
+    try:
+        await init_db()
+        await app.settings.set_target_chat(str(BENCH_CHAT))
+        block_ids = await seed_blocks(AsyncSessionLocal, args.blocks, args.channels)
+        ingest.set_source(SyntheticSource(args.messages, dup_ratio=args.dup_ratio, seed=args.seed))
+
+        # 1. ingestion
+        ingested = []
+
+        async def scan(block_id):
+            ingested.extend(await app.scan_block(block_id, args.hours))
+        stages['scan'] = await run_stage(scan, block_ids, args.concurrency)
+        stages['scan']['messages'] = len(ingested)
+        stages['scan']['messages_per_s'] = round(len(ingested) / stages['scan']['seconds'], 2) \
+            if stages['scan']['seconds'] else 0.0
+
+        # 2. rewrite through the inline-button handler
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(
+                select(MsgModel.id).join(Channel, Channel.id == MsgModel.channel_id)
+                .where(Channel.block_id.in_(block_ids), MsgModel.status == 'new')
+                .order_by(MsgModel.id)
+            )
+            message_ids = res.scalars().all()
+        stages['rewrite'] = await run_stage(
+            lambda mid: app.callback_rewrite(FakeCallback(get_bot(), f"rewrite:{mid}:{args.style}")),
+            message_ids, args.concurrency
+        )
+
+        # 3. moderation approval
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(
+                select(RewriteTask.id).where(RewriteTask.message_id.in_(message_ids), RewriteTask.status == 'done')
+            )
+            task_ids = res.scalars().all()
+        stages['approve'] = await run_stage(
+            lambda tid: app.callback_mod_approve(FakeCallback(get_bot(), f"mod_approve:{tid}")),
+            task_ids, args.concurrency
+        )
+
+        # 4. publishing: everything approved becomes due right now
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                update(PublicationSchedule.__table__)
+                .where(PublicationSchedule.__table__.c.status == 'scheduled')
+                .values(scheduled_time=datetime.utcnow() - timedelta(seconds=1))
+            )
+            await session.commit()
+        sent_before = len(telegram.calls)
+        start_mono = time.monotonic()
+        start = time.perf_counter()
+        await publish_scheduled()
+        elapsed = time.perf_counter() - start
+        sends = [c for c in telegram.calls[sent_before:] if c['chat_id'] == str(BENCH_CHAT)]
+        # Per item latency: time from the start of the run until the post reached the API
+        stages['publish'] = summarize([c['at'] - start_mono for c in sends], elapsed)
+    finally:
+        await context.shutdown()
+        await deepseek.stop()
+        await telegram.stop()
+
+    return {
+        'started_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'params': {k: v for k, v in vars(args).items() if k not in ('out', 'baseline')},
+        'database': os.environ['DATABASE_URL'].split('://')[0],
+        'stages': stages,
+        'stubs': {'deepseek_requests': deepseek.requests, 'deepseek_errors': deepseek.errors,
+                  'deepseek_rejected': deepseek.rejected, 'deepseek_peak_inflight': deepseek.peak_inflight,
+                  'telegram_calls': len(telegram.calls), 'telegram_throttled': telegram.throttled},
+    }
+
+
+def report(result: dict, baseline: dict = None):
+    print(f"{'stage':<10}{'items':>8}{'seconds':>10}{'items/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, st in result['stages'].items():
+        line = (f"{name:<10}{st['items']:>8}{st['seconds']:>10.3f}{st['throughput']:>10.1f}"
+                f"{st['p50_ms']:>10.1f}{st['p95_ms']:>10.1f}{st['p99_ms']:>10.1f}")
+        old = (baseline or {}).get('stages', {}).get(name)
+        if old and old.get('throughput'):
+            line += f"   x{st['throughput'] / old['throughput']:.2f} vs baseline"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end contentmaker pipeline benchmark')
+    parser.add_argument('--blocks', type=int, default=2)
+    parser.add_argument('--channels', type=int, default=10, help='channels per block')
+    parser.add_argument('--messages', type=int, default=20, help='messages per channel')
+    parser.add_argument('--hours', type=int, default=24)
+    parser.add_argument('--dup-ratio', type=float, default=0.0, help='share of reposted stories')
+    parser.add_argument('--style', default='default')
+    parser.add_argument('--concurrency', type=int, default=16, help='parallel handler calls per stage')
+    parser.add_argument('--deepseek-latency', type=float, default=0.05)
+    parser.add_argument('--deepseek-jitter', type=float, default=0.01)
+    parser.add_argument('--deepseek-error-rate', type=float, default=0.0)
+    parser.add_argument('--deepseek-capacity', type=int, help='requests the stub serves at once before 429s')
+    parser.add_argument('--telegram-latency', type=float, default=0.0)
+    parser.add_argument('--chat-rate', type=float, default=1000.0,
+                        help='publisher per-chat rate limit; Telegram itself allows ~0.33/s')
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='result file (default benchmarks/results/<timestamp>.json)')
+    parser.add_argument('--baseline', help='earlier result file to compare against')
+    args = parser.parse_args()
+
+    result = asyncio.run(benchmark(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    out = args.out or os.path.join(os.path.dirname(__file__), 'results',
+                                   f"bench-{datetime.utcnow():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"Saved {out}")
+
+if __name__ == '__main__':
+    main()
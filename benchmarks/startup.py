@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.run import percentile
+
+# Cold start of the worker roles: each run is a fresh `python worker.py <role>
+# --once` process against a temporary SQLite database. "ready" is what the
+# process logs itself (imports, engine, first queries), "wall" adds the
+# interpreter start and shutdown.
+#
+#   python -m benchmarks.startup --runs 5
+#   python -m benchmarks.startup --roles publish rewrite --target 1.0
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_READY = re.compile(r'ready in (\d+) ms')
+
+
+def run_once(roles: list, env: dict) -> tuple:
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, 'worker.py', *roles, '--once', '--metrics-port', '0'],
+                          cwd=ROOT, env=env, capture_output=True, text=True, timeout=120)
+    wall = time.perf_counter() - start
+    found = _READY.search(proc.stderr)
+    if proc.returncode or not found:
+        raise RuntimeError(f"{' '.join(roles)} failed to start:\n{proc.stderr}")
+    return int(found.group(1)) / 1000, wall
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker cold start benchmark')
+    parser.add_argument('--roles', nargs='+', default=['publish', 'rewrite', 'ingest', 'retention'])
+    parser.add_argument('--runs', type=int, default=5, help='processes started per role')
+    parser.add_argument('--target', type=float, help='seconds to ready, defaults to STARTUP_TARGET')
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    if args.database_url:
+        env['DATABASE_URL'] = args.database_url
+    else:
+        env['DATABASE_URL'] = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(prefix='contentmaker-start-'), 'start.db')}"
+    env.setdefault('BOT_TOKEN', '42:startup-benchmark')
+    env['AUTO_SCAN_INTERVAL'] = '86400'  # the ingest role scans right away; nothing to scan here
+    sys.path.insert(0, ROOT)
+    from config import STARTUP_TARGET
+    target = args.target or STARTUP_TARGET
+
+    run_once(args.roles[:1], env)  # migrations and the .pyc cache, not part of any result
+    results, over = {}, []
+    print(f"{'role':<12}{'ready p50 ms':>14}{'ready max ms':>14}{'wall p50 ms':>14}")
+    for role in args.roles:
+        ready, wall = zip(*(run_once([role], env) for _ in range(args.runs)))
+        results[role] = {'ready_p50_ms': round(percentile(ready, 50) * 1000, 1),
+                         'ready_max_ms': round(max(ready) * 1000, 1),
+                         'wall_p50_ms': round(percentile(wall, 50) * 1000, 1)}
+        r = results[role]
+        print(f"{role:<12}{r['ready_p50_ms']:>14.1f}{r['ready_max_ms']:>14.1f}{r['wall_p50_ms']:>14.1f}")
+        if percentile(ready, 50) > target:
+            over.append(role)
+    print(json.dumps({'target_ms': target * 1000, 'roles': results}))
+    if over:
+        raise SystemExit(f"over the {target * 1000:.0f} ms target: {', '.join(over)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+
+from sqlalchemy import create_engine, inspect, text
+
+# Upgrade check: builds the schema of the first models.py and the older
+# database.py sqlite schema with a few rows, migrates the first one partway to
+# every intermediate version, then runs init_db() and compares the database
+# with the current models. Exits non-zero when any path fails.
+#
+#   python -m benchmarks.upgrade
+
+BASELINE_SCHEMA = """
+CREATE TABLE bot_config (key VARCHAR NOT NULL, value VARCHAR NOT NULL, PRIMARY KEY (key));
+CREATE TABLE theme_blocks (
+    id INTEGER NOT NULL, title VARCHAR NOT NULL, created_at DATETIME,
+    PRIMARY KEY (id), UNIQUE (title)
+);
+CREATE TABLE channels (
+    id INTEGER NOT NULL, block_id INTEGER, username VARCHAR NOT NULL, added_at DATETIME,
+    PRIMARY KEY (id), CONSTRAINT _block_channel_uc UNIQUE (block_id, username),
+    FOREIGN KEY(block_id) REFERENCES theme_blocks (id) ON DELETE CASCADE
+);
+CREATE TABLE messages (
+    id INTEGER NOT NULL, channel_id INTEGER NOT NULL, original_message_id INTEGER NOT NULL,
+    content TEXT, timestamp DATETIME, status VARCHAR,
+    PRIMARY KEY (id), FOREIGN KEY(channel_id) REFERENCES channels (id)
+);
+CREATE TABLE rewrite_tasks (
+    id INTEGER NOT NULL, message_id INTEGER NOT NULL, style VARCHAR NOT NULL, result TEXT NOT NULL,
+    status VARCHAR, created_at DATETIME,
+    PRIMARY KEY (id), FOREIGN KEY(message_id) REFERENCES messages (id)
+);
+CREATE TABLE moderation_tasks (
+    id INTEGER NOT NULL, rewrite_id INTEGER NOT NULL, user_text TEXT NOT NULL, media TEXT,
+    status VARCHAR, created_at DATETIME,
+    PRIMARY KEY (id), FOREIGN KEY(rewrite_id) REFERENCES rewrite_tasks (id)
+);
+CREATE TABLE publication_schedule (
+    id INTEGER NOT NULL, moderation_task_id INTEGER NOT NULL, scheduled_time DATETIME NOT NULL,
+    status VARCHAR, created_at DATETIME,
+    PRIMARY KEY (id), FOREIGN KEY(moderation_task_id) REFERENCES moderation_tasks (id)
+);
+INSERT INTO bot_config VALUES ('TARGET_CHAT_ID', '@target');
+INSERT INTO theme_blocks VALUES (1, 'news', '2023-01-01 00:00:00');
+INSERT INTO channels VALUES (1, 1, '@source', '2023-01-01 00:00:00');
+INSERT INTO messages VALUES (1, 1, 10, 'first post', '2023-01-02 00:00:00', 'new');
+INSERT INTO messages VALUES (2, 1, 10, 'first post again', '2023-01-02 00:00:00', 'new');
+INSERT INTO messages VALUES (3, 1, 11, 'second post', '2023-01-03 00:00:00', 'funnel');
+INSERT INTO rewrite_tasks VALUES (1, 3, 'default', 'second post, rewritten', 'done', '2023-01-03 00:00:00');
+INSERT INTO moderation_tasks VALUES (1, 1, 'second post, rewritten', NULL, 'approved', '2023-01-03 00:00:00');
+INSERT INTO publication_schedule VALUES (1, 1, '2023-01-04 00:00:00', 'scheduled', '2023-01-03 00:00:00');
+"""
+
+# database.py before the models took over
+LEGACY_SCHEMA = """
+CREATE TABLE thematic_blocks (id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+CREATE TABLE channels (
+    id INTEGER PRIMARY KEY, block_id INTEGER, username TEXT UNIQUE,
+    FOREIGN KEY(block_id) REFERENCES thematic_blocks(id)
+);
+CREATE TABLE messages (
+    id INTEGER PRIMARY KEY, block_id INTEGER, original_text TEXT, rewritten_text TEXT,
+    media_type TEXT, media_id TEXT, status TEXT DEFAULT 'raw',
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY(block_id) REFERENCES thematic_blocks(id)
+);
+CREATE TABLE publication_queue (
+    id INTEGER PRIMARY KEY, message_id INTEGER, scheduled_time DATETIME, is_published BOOLEAN DEFAULT 0,
+    FOREIGN KEY(message_id) REFERENCES messages(id)
+);
+INSERT INTO thematic_blocks VALUES (1, 'news');
+INSERT INTO channels VALUES (1, 1, '@source');
+INSERT INTO messages (id, block_id, original_text, rewritten_text, status) VALUES (1, 1, 'old post', 'old rewrite', 'raw');
+INSERT INTO messages (id, block_id, original_text, status) VALUES (2, 1, 'another old post', 'raw');
+"""
+
+# messages left after the upgrade: the baseline duplicate is merged away
+EXPECTED_MESSAGES = {'baseline': 2, 'legacy': 2}
+
+
+def differences(path: str) -> list:
+    from models import Base
+    engine = create_engine(f'sqlite:///{path}')
+    try:
+        with engine.connect() as conn:
+            insp = inspect(conn)
+            tables = set(insp.get_table_names())
+            problems = []
+            for table in Base.metadata.sorted_tables:
+                if table.name not in tables:
+                    problems.append(f'missing table {table.name}')
+                    continue
+                columns = {c['name'] for c in insp.get_columns(table.name)}
+                problems += [f'missing column {table.name}.{c.name}' for c in table.c if c.name not in columns]
+                indexes = {i['name'] for i in insp.get_indexes(table.name)}
+                problems += [f'missing index {i.name}' for i in table.indexes if i.name not in indexes]
+            return problems, conn.execute(text('SELECT COUNT(*) FROM messages')).scalar()
+    finally:
+        engine.dispose()
+
+def migrate_to(path: str, version: int):
+    from migrations import upgrade
+    engine = create_engine(f'sqlite:///{path}')
+    try:
+        with engine.begin() as conn:
+            upgrade(conn, version)
+    finally:
+        engine.dispose()
+
+async def check() -> int:
+    path = os.path.join(tempfile.mkdtemp(prefix='contentmaker-upgrade-'), 'upgrade.db')
+    os.environ['DATABASE_URL'] = f'sqlite+aiosqlite:///{path}'
+    # Application modules read their configuration at import time
+    from migrations import MIGRATIONS
+    from models import init_db, dispose_engine
+
+    versions = sorted(v for v, _, _ in MIGRATIONS)
+    cases = [('legacy', LEGACY_SCHEMA, None)]
+    cases += [('baseline', BASELINE_SCHEMA, version) for version in [None] + versions[:-1]]
+    failed = 0
+    for name, schema, stop in cases:
+        if os.path.exists(path):
+            os.remove(path)
+        db = sqlite3.connect(path)
+        db.executescript(schema)
+        db.close()
+        label = name if stop is None else f'{name}, stopped at {stop}'
+        try:
+            if stop is not None:
+                migrate_to(path, stop)
+            await init_db()
+            await dispose_engine()
+            problems, messages = differences(path)
+            if messages != EXPECTED_MESSAGES[name]:
+                problems.append(f'{messages} messages, expected {EXPECTED_MESSAGES[name]}')
+        except Exception as e:
+            await dispose_engine()
+            problems = [f'{type(e).__name__}: {e}'.splitlines()[0]]
+        failed += bool(problems)
+        print(f"{label:<28}{'ok' if not problems else 'FAILED: ' + '; '.join(problems)}")
+    return failed
+
+def main():
+    argparse.ArgumentParser(description='Upgrade old schemas to the current models').parse_args()
+    failed = asyncio.run(check())
+    if failed:
+        raise SystemExit(f"{failed} upgrade paths failed")
+
+if __name__ == '__main__':
+    main()
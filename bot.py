@@ -1,387 +1,894 @@
-import logging
-import asyncio
-from datetime import datetime, timedelta
-
-from aiogram import Bot, Dispatcher, F
-from aiogram.types import (
-    Message, CallbackQuery,
-    InlineKeyboardButton, InlineKeyboardMarkup,
-    InputMediaPhoto
-)
-from aiogram.filters import Command
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.fsm.context import FSMContext
-from aiogram.fsm.state import StatesGroup, State
-
-from config import (
-    BOT_TOKEN,
-    AVAILABLE_REWRITE_STYLES,
-    DEFAULT_REWRITE_STYLE,
-    AUTO_SCAN_INTERVAL
-)
-from models import (
-    AsyncSessionLocal, init_db,
-    ThemeBlock, Channel, BotConfig,
-    Message as MsgModel, RewriteTask,
-    ModerationTask, PublicationSchedule
-)
-from deepseek import rewrite_text
-from publisher import publish_message
-from scheduler import start_scheduler
-
-logging.basicConfig(level=logging.INFO)
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-
-# FSM for moderation states
-class ModerationStates(StatesGroup):
-    editing_text = State()
-    adding_media = State()
-
-# Configuration helpers
-async def get_conf(key: str):
-    async with AsyncSessionLocal() as session:
-        cfg = await session.get(BotConfig, key)
-        return cfg.value if cfg else None
-
-async def set_conf(key: str, value: str):
-    async with AsyncSessionLocal() as session:
-        cfg = await session.get(BotConfig, key)
-        if cfg:
-            cfg.value = value
-        else:
-            session.add(BotConfig(key=key, value=value))
-        await session.commit()
-
-# /set_channel and /get_channel
-@dp.message(Command("set_channel"))
-async def cmd_set_channel(msg: Message):
-    parts = msg.text.split(maxsplit=1)
-    if len(parts) < 2:
-        await msg.reply("Использование: /set_channel <@username|chat_id>")
-        return
-    await set_conf('TARGET_CHAT_ID', parts[1])
-    await msg.reply(f"Канал для публикации установлен: {parts[1]}")
-
-@dp.message(Command("get_channel"))
-async def cmd_get_channel(msg: Message):
-    target = await get_conf('TARGET_CHAT_ID') or 'не задан'
-    style = await get_conf('DEFAULT_REWRITE_STYLE') or DEFAULT_REWRITE_STYLE
-    await msg.reply(
-        f"Текущий канал: {target}
-"
-        f"Текущий стиль рерайта: {style}"
-    )
-
-# /set_style
-@dp.message(Command("set_style"))
-async def cmd_set_style(msg: Message):
-    parts = msg.text.split(maxsplit=1)
-    choices = ", ".join(AVAILABLE_REWRITE_STYLES)
-    if len(parts) < 2 or parts[1] not in AVAILABLE_REWRITE_STYLES:
-        await msg.reply(
-            f"Использование: /set_style <style>
-"
-            f"Доступные стили: {choices}"
-        )
-        return
-    await set_conf('DEFAULT_REWRITE_STYLE', parts[1])
-    await msg.reply(f"Стиль рерайта установлен: {parts[1]}")
-
-# CRUD blocks
-@dp.message(Command("add_block"))
-async def cmd_add_block(msg: Message):
-    title = msg.text.partition(' ')[2].strip()
-    if not title:
-        await msg.reply("Использование: /add_block <название>")
-        return
-    async with AsyncSessionLocal() as session:
-        block = ThemeBlock(title=title)
-        session.add(block)
-        await session.commit()
-        await msg.reply(f"Создан блок '{title}' (id={block.id})")
-
-@dp.message(Command("list_blocks"))
-async def cmd_list_blocks(msg: Message):
-    async with AsyncSessionLocal() as session:
-        res = await session.execute(ThemeBlock.__table__.select())
-        blocks = res.scalars().all()
-    if not blocks:
-        await msg.reply("Список блоков пуст.")
-        return
-    text = "
-".join(f"{b.id}: {b.title}" for b in blocks)
-    await msg.reply(f"Список блоков:
-{text}")
-
-@dp.message(Command("remove_block"))
-async def cmd_remove_block(msg: Message):
-    parts = msg.text.split(maxsplit=1)
-    if len(parts) < 2 or not parts[1].isdigit():
-        await msg.reply("Использование: /remove_block <block_id>")
-        return
-    block_id = int(parts[1])
-    async with AsyncSessionLocal() as session:
-        block = await session.get(ThemeBlock, block_id)
-        if not block:
-            await msg.reply("Блок не найден.")
-            return
-        await session.delete(block)
-        await session.commit()
-        await msg.reply(f"Удалён блок id={block_id}")
-
-# CRUD channels
-@dp.message(Command("add_channel"))
-async def cmd_add_channel(msg: Message):
-    parts = msg.text.split(maxsplit=2)
-    if len(parts) < 3 or not parts[1].isdigit():
-        await msg.reply("Использование: /add_channel <block_id> @username")
-        return
-    block_id, username = int(parts[1]), parts[2]
-    async with AsyncSessionLocal() as session:
-        ch = Channel(block_id=block_id, username=username)
-        session.add(ch)
-        await session.commit()
-        await msg.reply(f"Добавлен канал {username} в блок {block_id}")
-
-@dp.message(Command("list_channels"))
-async def cmd_list_channels(msg: Message):
-    parts = msg.text.split(maxsplit=1)
-    if len(parts) < 2 or not parts[1].isdigit():
-        await msg.reply("Использование: /list_channels <block_id>")
-        return
-    block_id = int(parts[1])
-    async with AsyncSessionLocal() as session:
-        res = await session.execute(
-            Channel.__table__.select().where(Channel.block_id == block_id)
-        )
-        channels = res.scalars().all()
-    if not channels:
-        await msg.reply("В блоке нет каналов.")
-        return
-    text = "
-".join(f"{c.id}: {c.username}" for c in channels)
-    await msg.reply(f"Каналы в блоке {block_id}:
-{text}")
-
-@dp.message(Command("remove_channel"))
-async def cmd_remove_channel(msg: Message):
-    parts = msg.text.split(maxsplit=2)
-    if len(parts) < 3 or not parts[1].isdigit():
-        await msg.reply("Использование: /remove_channel <block_id> @username")
-        return
-    block_id, username = int(parts[1]), parts[2]
-    async with AsyncSessionLocal() as session:
-        res = await session.execute(
-            Channel.__table__.select().where(
-                Channel.block_id == block_id,
-                Channel.username == username
-            )
-        )
-        ch = res.scalars().first()
-        if not ch:
-            await msg.reply("Канал не найден.")
-            return
-        await session.delete(ch)
-        await session.commit()
-        await msg.reply(f"Удалён канал {username} из блока {block_id}")
-
-# Message scan stub
-async def scan_block(block_id: int, hours: int):
-    return []  # TODO implement
-
-@dp.message(Command("scan"))
-async def cmd_scan(msg: Message):
-    parts = msg.text.split()
-    if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit():
-        await msg.reply("Использование: /scan <block_id> <hours>")
-        return
-    block_id, hours = int(parts[1]), int(parts[2])
-    msgs = await scan_block(block_id, hours)
-    await msg.reply(f"Собрано {len(msgs)} сообщений")
-
-# Rewrite funnel
-@dp.message(Command("select_for_rewrite"))
-async def cmd_select_for_rewrite(msg: Message):
-    parts = msg.text.split()
-    usage = (f"Использование: /select_for_rewrite <block_id> [style]
-"
-             f"Стили: {', '.join(AVAILABLE_REWRITE_STYLES)}")
-    if len(parts) < 2 or not parts[1].isdigit():
-        await msg.reply(usage)
-        return
-    block_id = int(parts[1])
-    user_style = parts[2] if len(parts) > 2 else None
-    async with AsyncSessionLocal() as session:
-        style = (user_style if user_style in AVAILABLE_REWRITE_STYLES
-                 else await get_conf('DEFAULT_REWRITE_STYLE') or DEFAULT_REWRITE_STYLE)
-        res = await session.execute(
-            Channel.__table__.select().where(Channel.block_id == block_id)
-        )
-        channel_ids = [c.id for c in res.scalars().all()]
-        res = await session.execute(
-            MsgModel.__table__.select().where(
-                MsgModel.status == 'new',
-                MsgModel.channel_id.in_(channel_ids)
-            )
-        )
-        msgs = res.scalars().all()
-    if not msgs:
-        await msg.reply("Нет новых сообщений.")
-        return
-    kb = InlineKeyboardMarkup()
-    for m in msgs:
-        snippet = (m.content or '')[:30].replace('
-',' ') + '...'
-        kb.add(InlineKeyboardButton(f"[{style}] {snippet}", callback_data=f"rewrite:{m.id}:{style}"))
-    await msg.reply("Выберите сообщение:", reply_markup=kb)
-
-@dp.callback_query(F.data.startswith("rewrite:"))
-async def callback_rewrite(cb: CallbackQuery):
-    _, mid, style = cb.data.split(":")
-    mid = int(mid)
-    async with AsyncSessionLocal() as session:
-        orig = await session.get(MsgModel, mid)
-        new_text = await rewrite_text(orig.content, style)
-        task = RewriteTask(message_id=mid, style=style, result=new_text, status='done')
-        orig.status = 'funnel'
-        session.add_all([orig, task])
-        await session.commit()
-    kb = InlineKeyboardMarkup()
-    kb.add(
-        InlineKeyboardButton("Одобрить", callback_data=f"mod_approve:{task.id}"),
-        InlineKeyboardButton("Редактировать", callback_data=f"mod_edit:{task.id}"),
-        InlineKeyboardButton("Удалить", callback_data=f"mod_delete:{task.id}")
-    )
-    await cb.message.edit_text(f"Рерайт [{style}]:
-{new_text}", reply_markup=kb)
-    await cb.answer()
-
-# Moderation approve/delete/edit
-@dp.callback_query(F.data.startswith("mod_approve:"))
-async def callback_mod_approve(cb: CallbackQuery):
-    tid = int(cb.data.split(":")[1])
-    async with AsyncSessionLocal() as session:
-        rewrite = await session.get(RewriteTask, tid)
-        mod = ModerationTask(rewrite_id=tid, user_text=rewrite.result, status='approved')
-        session.add(mod)
-        await session.commit()
-        sched = PublicationSchedule(moderation_task_id=mod.id, scheduled_time=datetime.utcnow()+timedelta(minutes=1))
-        session.add(sched)
-        await session.commit()
-    await cb.message.delete_reply_markup()
-    await cb.answer("Сообщение запланировано.")
-
-@dp.callback_query(F.data.startswith("mod_delete:"))
-async def callback_mod_delete(cb: CallbackQuery):
-    tid = int(cb.data.split(":")[1])
-    async with AsyncSessionLocal() as session:
-        rewrite = await session.get(RewriteTask, tid)
-        await session.delete(rewrite)
-        await session.commit()
-    await cb.message.delete()
-    await cb.answer("Удалено.")
-
-@dp.callback_query(F.data.startswith("mod_edit:"))
-async def callback_mod_edit(cb: CallbackQuery, state: FSMContext):
-    tid = int(cb.data.split(":")[1])
-    await state.update_data(edit_task_id=tid)
-    await cb.message.reply("Отправьте новый текст:")
-    await state.set_state(ModerationStates.editing_text)
-    await cb.answer()
-
-@dp.message(F.state(ModerationStates.editing_text))
-async def process_edit_text(msg: Message, state: FSMContext):
-    data = await state.get_data()
-    tid = data.get("edit_task_id")
-    async with AsyncSessionLocal() as session:
-        mod = ModerationTask(rewrite_id=tid, user_text=msg.text, status='pending')
-        session.add(mod)
-        await session.commit()
-    await msg.reply("Текст обновлён, прикрепите медиа или /skip_media")
-    await state.set_state(ModerationStates.adding_media)
-
-@dp.message(F.photo | F.video, F.state(ModerationStates.adding_media))
-async def process_media(msg: Message, state: FSMContext):
-    data = await state.get_data()
-    tid = data.get("edit_task_id")
-    file_id = msg.photo[-1].file_id if msg.photo else msg.video.file_id
-    async with AsyncSessionLocal() as session:
-        res = await session.execute(
-            ModerationTask.__table__.select().where(
-                ModerationTask.rewrite_id==tid,
-                ModerationTask.status=='pending'
-            )
-        )
-        mt = res.scalars().first()
-        if mt:
-            mt.media = file_id
-            await session.commit()
-    await msg.reply("Медиа прикреплено.")
-    await state.clear()
-
-@dp.message(Command("skip_media"), F.state(ModerationStates.adding_media))
-async def skip_media(msg: Message, state: FSMContext):
-    await msg.reply("Пропускаем медиа.")
-    await state.clear()
-
-# Instant publication
-@dp.message(Command("post_now"))
-async def cmd_post_now(msg: Message):
-    text = msg.text.partition(' ')[2].strip()
-    if not text:
-        await msg.reply("Использование: /post_now <текст>")
-        return
-    target = await get_conf('TARGET_CHAT_ID')
-    if not target:
-        await msg.reply("Сначала /set_channel")
-        return
-    await publish_message(target, text, [])
-    await msg.reply("Опубликовано.")
-
-# Show schedule
-@dp.message(Command("show_schedule"))
-async def cmd_show_schedule(msg: Message):
-    async with AsyncSessionLocal() as session:
-        res = await session.execute(
-            PublicationSchedule.__table__.select().where(PublicationSchedule.status=='scheduled')
-        )
-        scheds = res.scalars().all()
-    if not scheds:
-        await msg.reply("Расписание пусто.")
-        return
-    text = "
-".join(f"{s.id}: task {s.moderation_task_id} @ {s.scheduled_time}" for s in scheds)
-    await msg.reply(f"Расписание публикаций:
-{text}")
-
-# Scheduled publishing job
-async def publish_scheduled():
-    async with AsyncSessionLocal() as session:
-        now = datetime.utcnow()
-        res = await session.execute(
-            PublicationSchedule.__table__.select().where(
-                PublicationSchedule.status=='scheduled',
-                PublicationSchedule.scheduled_time<=now
-            )
-        )
-        tasks = res.scalars().all()
-        target = await get_conf('TARGET_CHAT_ID')
-        for s in tasks:
-            mt = await session.get(ModerationTask, s.moderation_task_id)
-            medias = []
-            if mt.media:
-                medias.append(InputMediaPhoto(mt.media))
-            await publish_message(target, mt.user_text, medias)
-            s.status = 'published'
-        await session.commit()
-
-# Startup
-async def main():
-    await init_db()
-    start_scheduler()
-    await dp.start_polling(bot)
-
-if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+import time
+STARTED = time.perf_counter()  # before the imports: cold start counts them
+
+import logging
+import asyncio
+import multiprocessing
+import secrets
+import signal
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Dispatcher, F
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.types import (
+    Message, CallbackQuery,
+    InlineKeyboardButton, InlineKeyboardMarkup
+)
+from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import StatesGroup, State
+from sqlalchemy import select, update, delete, exists, func, and_, or_
+from sqlalchemy.orm import aliased
+
+from config import (
+    AVAILABLE_REWRITE_STYLES,
+    REWRITE_EDIT_INTERVAL,
+    SELECT_PAGE_SIZE,
+    SNIPPET_LEN,
+    BOT_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEB_WORKERS,
+    WEBHOOK_MAX_CONNECTIONS,
+    METRICS_PORT,
+    ADMIN_IDS,
+    BOT_JOBS
+)
+from models import (
+    AsyncSessionLocal, init_db,
+    ThemeBlock, Channel,
+    Message as MsgModel, RewriteTask,
+    ModerationTask, PublicationSchedule
+)
+from deepseek import rewrite_text_stream, cache_stats, DeepSeekError
+from ingest import scan_block
+from dedup import dedup_block
+from rewriter import enqueue_block, pool as rewrite_pool
+from publisher import get_bot, publish_message, PRIORITY_URGENT
+from scheduler import notify as notify_scheduler
+from fsm_storage import SQLStorage
+from settings import settings
+import planner
+from search import search
+from scoring import rescore_block
+from retention import run_retention
+from media import load_media, dump_media, media_item, albums
+from worker import ROLES, start_metrics
+import context
+import metrics
+
+logging.basicConfig(level=logging.INFO)
+MESSAGE_LIMIT = 4096
+
+# aiogram inner middleware: the matched handler is known, label by its name
+class HandlerMetrics(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        target = data.get('handler')
+        label = getattr(getattr(target, 'callback', None), '__name__', type(event).__name__)
+        with metrics.track(label):
+            return await handler(event, data)
+
+storage = SQLStorage()
+dp = Dispatcher(storage=storage)
+dp.message.middleware(HandlerMetrics())
+dp.callback_query.middleware(HandlerMetrics())
+
+# FSM for moderation states
+class ModerationStates(StatesGroup):
+    editing_text = State()
+    adding_media = State()
+
+# /set_channel and /get_channel
+@dp.message(Command("set_channel"))
+async def cmd_set_channel(msg: Message):
+    parts = msg.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await msg.reply("Использование: /set_channel <@username|chat_id>")
+        return
+    try:
+        await settings.set_target_chat(parts[1])
+    except ValueError:
+        await msg.reply("Канал задаётся как @username или числовой chat_id")
+        return
+    await msg.reply(f"Канал для публикации установлен: {parts[1]}")
+
+@dp.message(Command("get_channel"))
+async def cmd_get_channel(msg: Message):
+    await msg.reply(
+        f"Текущий канал: {settings.target_chat or 'не задан'}\n"
+        f"Текущий стиль рерайта: {settings.default_style}"
+    )
+
+# /set_style
+@dp.message(Command("set_style"))
+async def cmd_set_style(msg: Message):
+    parts = msg.text.split(maxsplit=1)
+    choices = ", ".join(AVAILABLE_REWRITE_STYLES)
+    if len(parts) < 2 or parts[1] not in AVAILABLE_REWRITE_STYLES:
+        await msg.reply(
+            f"Использование: /set_style <style>\n"
+            f"Доступные стили: {choices}"
+        )
+        return
+    await settings.set_default_style(parts[1])
+    await msg.reply(f"Стиль рерайта установлен: {parts[1]}")
+
+# CRUD blocks
+@dp.message(Command("add_block"))
+async def cmd_add_block(msg: Message):
+    title = msg.text.partition(' ')[2].strip()
+    if not title:
+        await msg.reply("Использование: /add_block <название>")
+        return
+    async with AsyncSessionLocal() as session:
+        block = ThemeBlock(title=title)
+        session.add(block)
+        await session.commit()
+        await msg.reply(f"Создан блок '{title}' (id={block.id})")
+
+@dp.message(Command("list_blocks"))
+async def cmd_list_blocks(msg: Message):
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(ThemeBlock.__table__.select())
+        blocks = res.scalars().all()
+    if not blocks:
+        await msg.reply("Список блоков пуст.")
+        return
+    text = "\n".join(f"{b.id}: {b.title}" for b in blocks)
+    await msg.reply(f"Список блоков:\n{text}")
+
+@dp.message(Command("remove_block"))
+async def cmd_remove_block(msg: Message):
+    parts = msg.text.split(maxsplit=1)
+    if len(parts) < 2 or not parts[1].isdigit():
+        await msg.reply("Использование: /remove_block <block_id>")
+        return
+    block_id = int(parts[1])
+    async with AsyncSessionLocal() as session:
+        block = await session.get(ThemeBlock, block_id)
+        if not block:
+            await msg.reply("Блок не найден.")
+            return
+        await session.delete(block)
+        await session.commit()
+        await msg.reply(f"Удалён блок id={block_id}")
+
+# CRUD channels
+@dp.message(Command("add_channel"))
+async def cmd_add_channel(msg: Message):
+    parts = msg.text.split(maxsplit=2)
+    if len(parts) < 3 or not parts[1].isdigit():
+        await msg.reply("Использование: /add_channel <block_id> @username")
+        return
+    block_id, username = int(parts[1]), parts[2]
+    async with AsyncSessionLocal() as session:
+        ch = Channel(block_id=block_id, username=username)
+        session.add(ch)
+        await session.commit()
+        await msg.reply(f"Добавлен канал {username} в блок {block_id}")
+
+@dp.message(Command("list_channels"))
+async def cmd_list_channels(msg: Message):
+    parts = msg.text.split(maxsplit=1)
+    if len(parts) < 2 or not parts[1].isdigit():
+        await msg.reply("Использование: /list_channels <block_id>")
+        return
+    block_id = int(parts[1])
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(
+            Channel.__table__.select().where(Channel.block_id == block_id)
+        )
+        channels = res.scalars().all()
+    if not channels:
+        await msg.reply("В блоке нет каналов.")
+        return
+    text = "\n".join(f"{c.id}: {c.username}" for c in channels)
+    await msg.reply(f"Каналы в блоке {block_id}:\n{text}")
+
+@dp.message(Command("remove_channel"))
+async def cmd_remove_channel(msg: Message):
+    parts = msg.text.split(maxsplit=2)
+    if len(parts) < 3 or not parts[1].isdigit():
+        await msg.reply("Использование: /remove_channel <block_id> @username")
+        return
+    block_id, username = int(parts[1]), parts[2]
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(
+            Channel.__table__.select().where(
+                Channel.block_id == block_id,
+                Channel.username == username
+            )
+        )
+        ch = res.scalars().first()
+        if not ch:
+            await msg.reply("Канал не найден.")
+            return
+        await session.delete(ch)
+        await session.commit()
+        await msg.reply(f"Удалён канал {username} из блока {block_id}")
+
+# Message scan
+@dp.message(Command("scan"))
+async def cmd_scan(msg: Message):
+    parts = msg.text.split()
+    if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit():
+        await msg.reply("Использование: /scan <block_id> <hours>")
+        return
+    block_id, hours = int(parts[1]), int(parts[2])
+    msgs = await scan_block(block_id, hours)
+    await msg.reply(f"Собрано {len(msgs)} сообщений")
+
+@dp.message(Command("set_keywords"))
+async def cmd_set_keywords(msg: Message):
+    parts = msg.text.split(maxsplit=2)
+    if len(parts) != 3 or not parts[1].isdigit():
+        await msg.reply("Использование: /set_keywords <block_id> <ключевые слова>")
+        return
+    scored = await rescore_block(int(parts[1]), parts[2])
+    await msg.reply(f"Ключевые слова сохранены, переоценено сообщений: {scored}")
+
+@dp.message(Command("rescore"))
+async def cmd_rescore(msg: Message):
+    parts = msg.text.split()
+    if len(parts) != 2 or not parts[1].isdigit():
+        await msg.reply("Использование: /rescore <block_id>")
+        return
+    scored = await rescore_block(int(parts[1]))
+    await msg.reply(f"Переоценено сообщений: {scored}")
+
+@dp.message(Command("dedup"))
+async def cmd_dedup(msg: Message):
+    parts = msg.text.split()
+    if len(parts) != 2 or not parts[1].isdigit():
+        await msg.reply("Использование: /dedup <block_id>")
+        return
+    marked = await dedup_block(int(parts[1]))
+    await msg.reply(f"Отмечено дубликатов: {marked}")
+
+# Archive search
+async def search_page(query: str, block_id, offset: int):
+    hits = await search(query, block_id, limit=SELECT_PAGE_SIZE + 1, offset=offset)
+    more = len(hits) > SELECT_PAGE_SIZE
+    hits = hits[:SELECT_PAGE_SIZE]
+    lines = []
+    for h in hits:
+        title = f"#{h['message_id']}" + (f" (рерайт #{h['rewrite_id']})" if h['kind'] == 'rewrite' else '')
+        when = h['timestamp'].strftime('%d.%m.%Y') if h['timestamp'] else '—'
+        lines.append(f"{title} · {when}\n{h['snippet']}")
+    nav = []
+    if offset:
+        nav.append(InlineKeyboardButton(text="« Назад", callback_data=f"srch:{max(offset - SELECT_PAGE_SIZE, 0)}"))
+    if more:
+        nav.append(InlineKeyboardButton(text="Далее »", callback_data=f"srch:{offset + SELECT_PAGE_SIZE}"))
+    kb = InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+    return '\n\n'.join(lines), kb
+
+@dp.message(Command("search"))
+async def cmd_search(msg: Message, state: FSMContext):
+    parts = msg.text.split()[1:]
+    block_id = None
+    if len(parts) > 1 and parts[-1].isdigit():
+        block_id = int(parts.pop())
+    query = ' '.join(parts)
+    if not query:
+        await msg.reply("Использование: /search <запрос> [block_id]")
+        return
+    body, kb = await search_page(query, block_id, 0)
+    if not body:
+        await msg.reply("Ничего не найдено.")
+        return
+    # The query doesn't fit into callback_data, paging reads it from the FSM data
+    await state.update_data(search={'q': query, 'block': block_id})
+    await msg.reply(body, reply_markup=kb)
+
+@dp.callback_query(F.data.startswith("srch:"))
+async def callback_search_page(cb: CallbackQuery, state: FSMContext):
+    saved = (await state.get_data()).get('search')
+    if not saved:
+        await cb.answer("Поиск устарел, повторите /search", show_alert=True)
+        return
+    body, kb = await search_page(saved['q'], saved['block'], int(cb.data.split(":")[1]))
+    await cb.message.edit_text(body or "Ничего не найдено.", reply_markup=kb)
+    await cb.answer()
+
+# Rewrite funnel
+async def candidate_page(block_id: int, after: tuple = None, before: tuple = None):
+    # Most relevant first: keyset page over (score, id) along ix_messages_status_score;
+    # only a DB-side snippet of the content is read
+    q = (
+        select(MsgModel.id, MsgModel.score, func.substr(MsgModel.content, 1, SNIPPET_LEN).label('snippet'),
+               Channel.username)
+        .join(Channel, Channel.id == MsgModel.channel_id)
+        .where(Channel.block_id == block_id, MsgModel.status == 'new')
+    )
+    if before is not None:
+        score, mid = before
+        q = (q.where(or_(MsgModel.score > score, and_(MsgModel.score == score, MsgModel.id > mid)))
+             .order_by(MsgModel.score, MsgModel.id))
+    else:
+        if after is not None:
+            score, mid = after
+            q = q.where(or_(MsgModel.score < score, and_(MsgModel.score == score, MsgModel.id < mid)))
+        q = q.order_by(MsgModel.score.desc(), MsgModel.id.desc())
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(q.limit(SELECT_PAGE_SIZE + 1))
+        rows = res.all()
+    more = len(rows) > SELECT_PAGE_SIZE
+    rows = rows[:SELECT_PAGE_SIZE]
+    if before is not None:
+        return rows[::-1], more, True
+    return rows, after is not None, more
+
+def candidate_kb(block_id: int, style: str, rows, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    buttons = []
+    for r in rows:
+        snippet = (r.snippet or '').replace('\n', ' ')
+        buttons.append([InlineKeyboardButton(
+            text=f"{r.score:.2f} [{r.username}] {snippet}...", callback_data=f"rewrite:{r.id}:{style}"
+        )])
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="« Назад", callback_data=f"sel:{block_id}:{style}:p:{rows[0].score!r}:{rows[0].id}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="Далее »", callback_data=f"sel:{block_id}:{style}:n:{rows[-1].score!r}:{rows[-1].id}"))
+    if nav:
+        buttons.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+@dp.message(Command("select_for_rewrite"))
+async def cmd_select_for_rewrite(msg: Message):
+    parts = msg.text.split()
+    usage = (f"Использование: /select_for_rewrite <block_id> [style]\n"
+             f"Стили: {', '.join(AVAILABLE_REWRITE_STYLES)}")
+    if len(parts) < 2 or not parts[1].isdigit():
+        await msg.reply(usage)
+        return
+    block_id = int(parts[1])
+    user_style = parts[2] if len(parts) > 2 else None
+    style = (user_style if user_style in AVAILABLE_REWRITE_STYLES
+             else settings.default_style)
+    rows, has_prev, has_next = await candidate_page(block_id)
+    if not rows:
+        await msg.reply("Нет новых сообщений.")
+        return
+    await msg.reply(f"Выберите сообщение [{style}]:",
+                    reply_markup=candidate_kb(block_id, style, rows, has_prev, has_next))
+
+@dp.callback_query(F.data.startswith("sel:"))
+async def callback_select_page(cb: CallbackQuery):
+    _, block_id, style, direction, *cursor = cb.data.split(":")
+    block_id = int(block_id)
+    # (score, id) of the edge row; buttons from before scoring carry only an id
+    cursor = (float(cursor[0]), int(cursor[1])) if len(cursor) == 2 else None
+    if direction == 'p':
+        rows, has_prev, has_next = await candidate_page(block_id, before=cursor)
+    else:
+        rows, has_prev, has_next = await candidate_page(block_id, after=cursor)
+    if not rows:
+        await cb.answer("Больше сообщений нет.")
+        return
+    await cb.message.edit_reply_markup(reply_markup=candidate_kb(block_id, style, rows, has_prev, has_next))
+    await cb.answer()
+
+def moderation_kb(task_id: int, extra: list = None) -> InlineKeyboardMarkup:
+    rows = [[
+        InlineKeyboardButton(text="Одобрить", callback_data=f"mod_approve:{task_id}"),
+        InlineKeyboardButton(text="Редактировать", callback_data=f"mod_edit:{task_id}"),
+        InlineKeyboardButton(text="Удалить", callback_data=f"mod_delete:{task_id}")
+    ]]
+    if extra:
+        rows.append(extra)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+async def _show_partial(cb: CallbackQuery, text: str):
+    try:
+        await cb.message.edit_text(text[:MESSAGE_LIMIT - 1] + "…")
+    except TelegramRetryAfter as e:
+        return e.retry_after
+    except TelegramBadRequest:
+        pass  # e.g. nothing changed since the last edit
+    return 0
+
+async def _show_final(cb: CallbackQuery, text: str, reply_markup=None):
+    # The last edit carries the moderation buttons, so it has to land: flood
+    # control is waited out and a refused edit becomes a new message
+    if len(text) > MESSAGE_LIMIT:
+        text = text[:MESSAGE_LIMIT - 1] + "…"
+    edit = True
+    while True:
+        try:
+            if edit:
+                await cb.message.edit_text(text, reply_markup=reply_markup)
+            else:
+                await cb.message.answer(text, reply_markup=reply_markup)
+            return
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except TelegramBadRequest:
+            if not edit:
+                raise
+            edit = False
+
+@dp.callback_query(F.data.startswith("rewrite:"))
+async def callback_rewrite(cb: CallbackQuery):
+    _, mid, style = cb.data.split(":")
+    mid = int(mid)
+    async with AsyncSessionLocal() as session:
+        orig = await session.get(MsgModel, mid)
+        content = orig.content
+    await cb.answer()
+    # Don't hold a DB session across the DeepSeek round trip. The rewrite streams
+    # in; the message follows it at most once per REWRITE_EDIT_INTERVAL.
+    header = f"Рерайт [{style}]:\n"
+    new_text, shown, next_edit = '', '', 0.0
+    try:
+        async for new_text in rewrite_text_stream(content, style):
+            now = time.monotonic()
+            if now >= next_edit and new_text.strip() != shown:
+                shown = new_text.strip()
+                wait = await _show_partial(cb, header + new_text)
+                next_edit = time.monotonic() + max(REWRITE_EDIT_INTERVAL, wait)
+    except DeepSeekError as e:
+        logging.warning("Rewrite of message %s failed: %s", mid, e)
+        await _show_final(cb, f"{header}DeepSeek сейчас недоступен, попробуйте позже.")
+        return
+    async with AsyncSessionLocal() as session:
+        task = RewriteTask(message_id=mid, style=style, result=new_text, status='done')
+        session.add(task)
+        await session.execute(update(MsgModel).where(MsgModel.id == mid).values(status='funnel'))
+        await session.commit()
+    await _show_final(cb, f"{header}{new_text}", moderation_kb(task.id))
+
+# Batch rewrite: queue a whole block for the background worker pool
+@dp.message(Command("rewrite_block"))
+async def cmd_rewrite_block(msg: Message):
+    parts = msg.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await msg.reply(
+            f"Использование: /rewrite_block <block_id> [style]\n"
+            f"Стили: {', '.join(AVAILABLE_REWRITE_STYLES)}"
+        )
+        return
+    block_id = int(parts[1])
+    user_style = parts[2] if len(parts) > 2 else None
+    style = (user_style if user_style in AVAILABLE_REWRITE_STYLES
+             else settings.default_style)
+    queued = await enqueue_block(block_id, style)
+    rewrite_pool.wake()
+    await msg.reply(f"В очередь на рерайт [{style}] поставлено {queued} сообщений. Результаты: /rewrites {block_id}")
+
+async def next_rewrite(block_id: int, after_id: int = 0):
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(
+            select(RewriteTask)
+            .join(MsgModel, MsgModel.id == RewriteTask.message_id)
+            .join(Channel, Channel.id == MsgModel.channel_id)
+            .where(
+                Channel.block_id == block_id,
+                RewriteTask.status == 'done',
+                RewriteTask.id > after_id,
+                ~exists().where(ModerationTask.rewrite_id == RewriteTask.id)
+            )
+            .order_by(RewriteTask.id)
+            .limit(1)
+        )
+        task = res.scalars().first()
+        res = await session.execute(
+            select(RewriteTask.status, func.count())
+            .join(MsgModel, MsgModel.id == RewriteTask.message_id)
+            .join(Channel, Channel.id == MsgModel.channel_id)
+            .where(Channel.block_id == block_id, RewriteTask.status.in_(['pending', 'running', 'failed']))
+            .group_by(RewriteTask.status)
+        )
+        counts = dict(res.all())
+    return task, counts
+
+def render_rewrite(block_id: int, task, counts: dict):
+    queued = counts.get('pending', 0) + counts.get('running', 0)
+    header = f"В очереди: {queued}, ошибок: {counts.get('failed', 0)}"
+    if not task:
+        return f"{header}\nГотовых рерайтов нет.", None
+    nav = [InlineKeyboardButton(text="Далее »", callback_data=f"rw_next:{block_id}:{task.id}")]
+    return f"{header}\nРерайт #{task.id} [{task.style}]:\n{task.result}", moderation_kb(task.id, nav)
+
+@dp.message(Command("rewrites"))
+async def cmd_rewrites(msg: Message):
+    parts = msg.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await msg.reply("Использование: /rewrites <block_id>")
+        return
+    block_id = int(parts[1])
+    text, kb = render_rewrite(block_id, *await next_rewrite(block_id))
+    await msg.reply(text, reply_markup=kb)
+
+@dp.callback_query(F.data.startswith("rw_next:"))
+async def callback_rewrite_next(cb: CallbackQuery):
+    _, block_id, after_id = cb.data.split(":")
+    block_id = int(block_id)
+    text, kb = render_rewrite(block_id, *await next_rewrite(block_id, int(after_id)))
+    await cb.message.edit_text(text, reply_markup=kb)
+    await cb.answer()
+
+# Moderation approve/delete/edit
+async def approve_rewrites(session, rewrite_ids: list) -> list:
+    mt = ModerationTask
+    # The original and the edited copy both carry an approve button; schedule once
+    res = await session.execute(
+        select(mt.rewrite_id).where(mt.rewrite_id.in_(rewrite_ids), mt.status == 'approved')
+    )
+    done = set(res.scalars().all())
+    rewrite_ids = [rid for rid in rewrite_ids if rid not in done]
+    if not rewrite_ids:
+        return []
+    # An edited version waiting in moderation wins over the raw rewrite
+    res = await session.execute(
+        select(mt).where(mt.rewrite_id.in_(rewrite_ids), mt.status == 'pending').order_by(mt.id)
+    )
+    tasks = {m.rewrite_id: m for m in res.scalars().all()}
+    missing = [rid for rid in rewrite_ids if rid not in tasks]
+    if missing:
+        res = await session.execute(
+            select(RewriteTask.id, RewriteTask.result, MsgModel.media)
+            .join(MsgModel, MsgModel.id == RewriteTask.message_id)
+            .where(RewriteTask.id.in_(missing))
+        )
+        for r in res.all():
+            tasks[r.id] = mt(rewrite_id=r.id, user_text=r.result, media=r.media)
+            session.add(tasks[r.id])
+    for m in tasks.values():
+        m.status = 'approved'
+    await session.flush()
+    return [tasks[rid].id for rid in rewrite_ids if rid in tasks]
+
+@dp.callback_query(F.data.startswith("mod_approve:"))
+async def callback_mod_approve(cb: CallbackQuery):
+    tid = int(cb.data.split(":")[1])
+    target = settings.target_chat
+    if not target:
+        await cb.answer("Сначала /set_channel", show_alert=True)
+        return
+    try:
+        times = await planner.schedule(target, lambda session: approve_rewrites(session, [tid]))
+    except planner.PlanError:
+        await cb.answer("Все слоты плана попадают в тихие часы, поправьте /set_plan.", show_alert=True)
+        return
+    if not times:
+        await cb.message.delete_reply_markup()
+        await cb.answer("Этот рерайт уже одобрен и стоит в расписании.", show_alert=True)
+        return
+    notify_scheduler(times[0])
+    await cb.message.delete_reply_markup()
+    await cb.answer(f"Сообщение запланировано на {planner.local(times[0]):%d.%m %H:%M}.")
+
+# Bulk approval: the newest finished rewrite of every funnel message in the
+# block that has nothing approved yet, planned in one transaction
+@dp.message(Command("approve_all"))
+async def cmd_approve_all(msg: Message):
+    parts = msg.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await msg.reply("Использование: /approve_all <block_id>")
+        return
+    block_id = int(parts[1])
+    target = settings.target_chat
+    if not target:
+        await msg.reply("Сначала /set_channel")
+        return
+
+    async def prepare(session):
+        other = aliased(RewriteTask)
+        approved = exists().where(
+            ModerationTask.rewrite_id == other.id,
+            other.message_id == RewriteTask.message_id,
+            ModerationTask.status == 'approved'
+        )
+        res = await session.execute(
+            select(func.max(RewriteTask.id))
+            .join(MsgModel, MsgModel.id == RewriteTask.message_id)
+            .join(Channel, Channel.id == MsgModel.channel_id)
+            .where(Channel.block_id == block_id, MsgModel.status == 'funnel',
+                   RewriteTask.status == 'done', ~approved)
+            .group_by(RewriteTask.message_id)
+            .order_by(RewriteTask.message_id)
+        )
+        return await approve_rewrites(session, res.scalars().all())
+
+    try:
+        times = await planner.schedule(target, prepare)
+    except planner.PlanError:
+        await msg.reply("Все слоты плана попадают в тихие часы, поправьте /set_plan.")
+        return
+    if not times:
+        await msg.reply("Нечего одобрять.")
+        return
+    notify_scheduler(times[0])
+    await msg.reply(
+        f"Одобрено и запланировано: {len(times)}\n"
+        f"С {planner.local(times[0]):%d.%m %H:%M} по {planner.local(times[-1]):%d.%m %H:%M}"
+    )
+
+# Posting plan of the current target channel
+@dp.message(Command("set_plan"))
+async def cmd_set_plan(msg: Message):
+    parts = msg.text.split()
+    target = settings.target_chat
+    try:
+        plan = planner.SlotPlan.parse(f"{parts[1]};{parts[2] if len(parts) > 2 else ''}")
+    except (IndexError, ValueError):
+        await msg.reply("Использование: /set_plan <постов в час> [тихие часы, напр. 23-8]")
+        return
+    if not plan.has_open_slots():
+        await msg.reply("При таком шаге все слоты попадают в тихие часы, публиковать будет некогда.")
+        return
+    if not target:
+        await msg.reply("Сначала /set_channel")
+        return
+    await settings.set(planner.plan_key(target), plan.dump())
+    quiet = f", тихие часы {plan.quiet[0]}:00–{plan.quiet[1]}:00" if plan.quiet else ""
+    await msg.reply(f"План для {target}: {plan.posts_per_hour:g} в час{quiet}")
+
+@dp.callback_query(F.data.startswith("mod_delete:"))
+async def callback_mod_delete(cb: CallbackQuery):
+    tid = int(cb.data.split(":")[1])
+    async with AsyncSessionLocal() as session:
+        rewrite = await session.get(RewriteTask, tid)
+        if rewrite is None:
+            await cb.answer("Уже удалено.")
+            return
+        # Edits waiting for approval go with the rewrite
+        await session.execute(
+            delete(ModerationTask).where(ModerationTask.rewrite_id == tid, ModerationTask.status == 'pending')
+        )
+        await session.delete(rewrite)
+        await session.flush()
+        # The message leaves the funnel once it has no finished rewrite left
+        await session.execute(
+            update(MsgModel)
+            .where(MsgModel.id == rewrite.message_id, MsgModel.status == 'funnel',
+                   ~exists().where(RewriteTask.message_id == MsgModel.id, RewriteTask.status == 'done'))
+            .values(status='rejected')
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+    await cb.message.delete()
+    await cb.answer("Удалено.")
+
+@dp.callback_query(F.data.startswith("mod_edit:"))
+async def callback_mod_edit(cb: CallbackQuery, state: FSMContext):
+    tid = int(cb.data.split(":")[1])
+    await state.update_data(edit_task_id=tid)
+    await cb.message.reply("Отправьте новый текст:")
+    await state.set_state(ModerationStates.editing_text)
+    await cb.answer()
+
+@dp.message(ModerationStates.editing_text)
+async def process_edit_text(msg: Message, state: FSMContext):
+    data = await state.get_data()
+    tid = data.get("edit_task_id")
+    async with AsyncSessionLocal() as session:
+        # The edited post starts with the media of the source message
+        res = await session.execute(
+            select(MsgModel.media).join(RewriteTask, RewriteTask.message_id == MsgModel.id)
+            .where(RewriteTask.id == tid)
+        )
+        mod = ModerationTask(rewrite_id=tid, user_text=msg.text, media=res.scalar(), status='pending')
+        session.add(mod)
+        await session.commit()
+    count = len(load_media(mod.media))
+    await msg.reply(
+        f"Текст обновлён. Медиа из источника: {count}.\n"
+        f"Пришлите фото, видео или альбом, чтобы заменить их, или /skip_media"
+    )
+    await state.set_state(ModerationStates.adding_media)
+
+def approve_kb(task_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="Одобрить", callback_data=f"mod_approve:{task_id}")
+    ]])
+
+@dp.message(ModerationStates.adding_media, F.photo | F.video | F.document)
+async def process_media(msg: Message, state: FSMContext):
+    item = media_item(msg)
+    if msg.media_group_id:
+        items = await albums.collect((msg.chat.id, msg.media_group_id), msg.message_id, item)
+        if items is None:
+            return  # the handler of the first part stores the whole album
+    else:
+        items = [item]
+    data = await state.get_data()
+    tid = data.get("edit_task_id")
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(
+            select(ModerationTask)
+            .where(ModerationTask.rewrite_id == tid, ModerationTask.status == 'pending')
+            .order_by(ModerationTask.id.desc()).limit(1)
+        )
+        mt = res.scalars().first()
+        if mt:
+            mt.media = dump_media(items)
+            await session.commit()
+    await msg.reply(f"Медиа прикреплено: {len(items)}.", reply_markup=approve_kb(tid))
+    await state.clear()
+
+@dp.message(ModerationStates.adding_media, Command("skip_media"))
+async def skip_media(msg: Message, state: FSMContext):
+    data = await state.get_data()
+    await msg.reply("Пропускаем медиа.", reply_markup=approve_kb(data.get("edit_task_id")))
+    await state.clear()
+
+# Rewrite cache counters
+@dp.message(Command("cache_stats"))
+async def cmd_cache_stats(msg: Message):
+    st = cache_stats()
+    await msg.reply(
+        f"Кэш рерайтов: {st['size']} записей в памяти\n"
+        f"Попадания: {st['hits']} (память) + {st['db_hits']} (БД), промахи: {st['misses']}\n"
+        f"Вытеснено: {st['evictions']}, истекло: {st['expirations']}\n"
+        f"Доля попаданий: {st['hit_ratio']:.1%}"
+    )
+
+# Latency summary for admins; the full histograms are on the /metrics endpoint
+@dp.message(Command("stats"))
+async def cmd_stats(msg: Message):
+    if ADMIN_IDS and msg.from_user.id not in ADMIN_IDS:
+        await msg.reply("Команда доступна только администраторам.")
+        return
+    st = metrics.summary()
+    lines = ["Обработчики (вызовы, ошибки, ср./p95 мс, SQL на вызов):"]
+    for name, h in st['handlers']:
+        lines.append(f"{name}: {h['count']}, {h['errors']}, "
+                     f"{h['avg'] * 1000:.0f}/{h['p95'] * 1000:.0f}, {h['queries']:.1f}")
+    db, ds, tg, pub = st['db'], st['deepseek'], st['telegram'], st['publish']
+    lines.append(f"SQL: {db['count']} запросов, ср. {db['avg'] * 1000:.1f} мс, p95 {db['p95'] * 1000:.1f} мс")
+    lines.append(f"DeepSeek: {ds['count']} запросов, ошибок {st['deepseek_errors']}, "
+                 f"ср. {ds['avg'] * 1000:.0f} мс, p95 {ds['p95'] * 1000:.0f} мс, "
+                 f"{st['deepseek_bytes']['sent'] // 1024} КБ отправлено / "
+                 f"{st['deepseek_bytes']['received'] // 1024} КБ получено")
+    lines.append(f"Первый фрагмент стрима: p95 {st['deepseek_first_chunk']['p95'] * 1000:.0f} мс")
+    lines.append(f"Упаковка: {st['deepseek_packed']['count']} запросов, "
+                 f"в среднем {st['deepseek_packed']['avg']:.1f} текста, "
+                 f"разбор не удался {st['deepseek_pack_fallbacks']:.0f}")
+    lines.append(f"Клиент DeepSeek: лимит {st['deepseek_concurrency']:.1f} параллельных запросов, "
+                 f"повторов {st['deepseek_retries']:.0f}, размыканий {st['deepseek_breaker_opens']:.0f}")
+    lines.append(f"Bot API: {tg['count']} вызовов, p95 {tg['p95'] * 1000:.0f} мс, "
+                 f"flood control: {st['telegram_retry_after']:.0f}")
+    lines.append(f"Публикации: {pub['count']}, ср. {pub['avg']:.2f} с, p95 {pub['p95']:.2f} с")
+    lines.append(f"Кэш рерайтов: доля попаданий {cache_stats()['hit_ratio']:.1%}")
+    await msg.reply("\n".join(lines))
+
+# Archive cold rows now instead of waiting for the retention timer
+@dp.message(Command("retention"))
+async def cmd_retention(msg: Message):
+    if ADMIN_IDS and msg.from_user.id not in ADMIN_IDS:
+        await msg.reply("Команда доступна только администраторам.")
+        return
+    report = await run_retention()
+    if not report.rows:
+        await msg.reply("Архивировать нечего.")
+        return
+    lines = [f"{table}: {count}" for table, count in sorted(report.rows.items())]
+    lines.append(f"Вынесено в архив {report.raw_bytes // 1024} КБ, "
+                 f"в сжатом виде {report.archived_bytes // 1024} КБ, "
+                 f"освобождено {report.reclaimed // 1024} КБ")
+    await msg.reply("\n".join(lines))
+
+# Instant publication
+@dp.message(Command("post_now"))
+async def cmd_post_now(msg: Message):
+    text = msg.text.partition(' ')[2].strip()
+    if not text:
+        await msg.reply("Использование: /post_now <текст>")
+        return
+    target = settings.target_chat
+    if not target:
+        await msg.reply("Сначала /set_channel")
+        return
+    await publish_message(target, text, [], priority=PRIORITY_URGENT)
+    await msg.reply("Опубликовано.")
+
+# Show schedule
+@dp.message(Command("show_schedule"))
+async def cmd_show_schedule(msg: Message):
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(
+            select(PublicationSchedule)
+            .where(PublicationSchedule.status == 'scheduled')
+            .order_by(PublicationSchedule.scheduled_time)
+            .limit(SELECT_PAGE_SIZE * 3)
+        )
+        scheds = res.scalars().all()
+    if not scheds:
+        await msg.reply("Расписание пусто.")
+        return
+    text = "\n".join(
+        f"{s.id}: task {s.moderation_task_id} → {s.target_chat or '—'} @ {planner.local(s.scheduled_time):%d.%m %H:%M}"
+        for s in scheds
+    )
+    await msg.reply(f"Расписание публикаций:\n{text}")
+
+# Startup
+async def start_background(worker: int = 0):
+    # Every process exposes its own metrics; the BOT_JOBS roles run in the first
+    # one, or in worker.py processes of their own when BOT_JOBS is empty
+    await start_metrics(METRICS_PORT + worker if METRICS_PORT else 0)
+    await settings.load()
+    settings.start()
+    if worker == 0:
+        for role in BOT_JOBS:
+            await ROLES[role]()
+
+async def main():
+    await init_db()
+    await start_background()
+    context.ready('poller', STARTED)
+    try:
+        await dp.start_polling(get_bot())
+    finally:
+        await context.shutdown()
+
+# Webhook mode: WEB_WORKERS processes share WEBHOOK_PORT through SO_REUSEPORT,
+# or run one per port behind a load balancer (WEB_WORKERS=1 each)
+@web.middleware
+async def check_webhook_secret(request, handler):
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if WEBHOOK_SECRET and not secrets.compare_digest(token, WEBHOOK_SECRET):
+        return web.Response(status=401)
+    return await handler(request)
+
+def serve_webhook(worker: int = 0):
+    bot = get_bot()
+    app = web.Application(middlewares=[check_webhook_secret])
+    SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    async def on_startup(app):
+        await start_background(worker)
+        context.ready(f'webhook-{worker}', STARTED)
+
+    async def on_shutdown(app):
+        await context.shutdown()
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, reuse_port=WEB_WORKERS > 1,
+                print=None, access_log=None)
+
+async def register_webhook():
+    await init_db()
+    try:
+        await get_bot().set_webhook(f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                              max_connections=WEBHOOK_MAX_CONNECTIONS, drop_pending_updates=False)
+    finally:
+        await context.shutdown()
+
+def run_webhook():
+    if not WEBHOOK_URL:
+        raise SystemExit("WEBHOOK_URL is required in webhook mode")
+    asyncio.run(register_webhook())
+    if WEB_WORKERS <= 1:
+        serve_webhook()
+        return
+    ctx = multiprocessing.get_context('spawn')
+    workers = [ctx.Process(target=serve_webhook, args=(i,), name=f"webhook-{i}") for i in range(WEB_WORKERS)]
+    for p in workers:
+        p.start()
+
+    def shutdown(*_):
+        for p in workers:
+            p.terminate()  # aiohttp shuts a worker down gracefully on SIGTERM
+    signal.signal(signal.SIGTERM, shutdown)
+    try:
+        for p in workers:
+            p.join()
+    except KeyboardInterrupt:
+        shutdown()
+        for p in workers:
+            p.join()
+
+if __name__ == '__main__':
+    if BOT_MODE == 'webhook':
+        run_webhook()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+import signal
+import time
+
+from config import STARTUP_TARGET
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Process resources are created on first use by their owners (models.get_engine,
+# publisher.get_bot, deepseek.get_session) and by the roles a process runs, and
+# each registers its cleanup here. shutdown() runs the cleanups newest first:
+# jobs stop before the Bot session and HTTP clients they use are closed, and the
+# database engine, created before anything else, is disposed last.
+_cleanups = []
+
+
+def on_shutdown(fn):
+    _cleanups.append(fn)
+    return fn
+
+async def shutdown():
+    while _cleanups:
+        fn = _cleanups.pop()
+        try:
+            await fn()
+        except Exception:
+            logger.exception("Shutdown step %s failed", getattr(fn, '__qualname__', fn))
+
+
+def ready(role: str, started_at: float) -> float:
+    # started_at is time.perf_counter() taken before the process imported anything
+    elapsed = time.perf_counter() - started_at
+    metrics.startup_seconds.observe(elapsed, role)
+    log = logger.warning if elapsed > STARTUP_TARGET else logger.info
+    log("%s ready in %.0f ms (target %.0f ms)", role, elapsed * 1000, STARTUP_TARGET * 1000)
+    return elapsed
+
+async def serve(role: str, start, started_at: float, once: bool = False):
+    # start() brings the role up; the process then runs until SIGTERM or SIGINT
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await start()
+        ready(role, started_at)
+        if not once:
+            await stop.wait()
+            logger.info("%s stopping", role)
+    finally:
+        await shutdown()
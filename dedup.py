@@ -0,0 +1,137 @@
+import hashlib
+import random
+import re
+import struct
+from typing import Iterable
+
+from sqlalchemy import select, update
+
+from config import DEDUP_THRESHOLD
+from models import (
+    AsyncSessionLocal, Channel, Message as MsgModel,
+    MessageFingerprint, FingerprintBand, insert_ignore
+)
+
+# MinHash with 64 permutations split into 16 LSH bands of 4 rows: texts with
+# a shingle Jaccard similarity of ~0.5 and above share at least one band key.
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE = 3
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_rng = random.Random(0x5EED)  # fixed seed: signatures must be stable across processes
+_PERMS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_LOOKUP_CHUNK = 5000  # bound parameters per IN (...) lookup
+
+
+def _hash(data: str) -> int:
+    return int.from_bytes(hashlib.blake2b(data.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def shingles(text: str) -> set:
+    words = _WORD_RE.findall((text or '').lower())
+    if len(words) < SHINGLE:
+        return {_hash(' '.join(words))} if words else set()
+    return {_hash(' '.join(words[i:i + SHINGLE])) for i in range(len(words) - SHINGLE + 1)}
+
+def minhash(text: str) -> tuple:
+    hs = shingles(text)
+    if not hs:
+        return ()
+    return tuple(min((a * h + b) % _PRIME for h in hs) & _MAX_HASH for a, b in _PERMS)
+
+def band_keys(signature: tuple) -> list:
+    keys = []
+    for i in range(BANDS):
+        chunk = struct.pack(f'>H{ROWS}I', i, *signature[i * ROWS:(i + 1) * ROWS])
+        # signed 64-bit to fit BigInteger
+        keys.append(int.from_bytes(hashlib.blake2b(chunk, digest_size=8).digest(), 'big', signed=True))
+    return keys
+
+def similarity(a: tuple, b: tuple) -> float:
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+def pack(signature: tuple) -> bytes:
+    return struct.pack(f'>{NUM_PERM}I', *signature)
+
+def unpack(data: bytes) -> tuple:
+    return struct.unpack(f'>{NUM_PERM}I', data)
+
+
+# Index maintenance. `messages` are (id, content) pairs of one block in ingest
+# order; the first message of a cluster stays its representative and later
+# near-duplicates are marked 'duplicate' so they never reach the rewrite funnel.
+async def index_messages(session, block_id: int, messages: Iterable) -> int:
+    entries = []
+    for mid, content in messages:
+        sig = minhash(content)
+        if sig:
+            entries.append((mid, sig, band_keys(sig)))
+    if not entries:
+        return 0
+
+    # Candidates come from an indexed lookup of the batch's band keys only
+    all_keys = list({k for e in entries for k in e[2]})
+    buckets, signatures = {}, {}
+    for i in range(0, len(all_keys), _LOOKUP_CHUNK):
+        res = await session.execute(
+            select(FingerprintBand.band_key, MessageFingerprint.message_id,
+                   MessageFingerprint.signature, MessageFingerprint.cluster_id)
+            .join(MessageFingerprint, MessageFingerprint.message_id == FingerprintBand.message_id)
+            .where(FingerprintBand.block_id == block_id,
+                   FingerprintBand.band_key.in_(all_keys[i:i + _LOOKUP_CHUNK]))
+        )
+        for key, mid, sig, cluster in res.all():
+            buckets.setdefault(key, set()).add(mid)
+            if mid not in signatures:
+                signatures[mid] = (unpack(sig), cluster)
+
+    fp_rows, band_rows, duplicates = [], [], []
+    for mid, sig, keys in entries:
+        best, cluster = DEDUP_THRESHOLD, mid
+        for other in set().union(*(buckets.get(k, ()) for k in keys)):
+            other_sig, other_cluster = signatures[other]
+            score = similarity(sig, other_sig)
+            if score >= best:
+                best, cluster = score, other_cluster
+        if cluster != mid:
+            duplicates.append(mid)
+        # Later messages in the same batch must see this one as well
+        signatures[mid] = (sig, cluster)
+        for k in set(keys):
+            buckets.setdefault(k, set()).add(mid)
+            band_rows.append({'block_id': block_id, 'band_key': k, 'message_id': mid})
+        fp_rows.append({'message_id': mid, 'block_id': block_id,
+                        'signature': pack(sig), 'cluster_id': cluster})
+
+    await session.execute(insert_ignore(MessageFingerprint.__table__), fp_rows)
+    await session.execute(insert_ignore(FingerprintBand.__table__), band_rows)
+    if duplicates:
+        mt = MsgModel.__table__
+        await session.execute(
+            update(mt).where(mt.c.id.in_(duplicates), mt.c.status == 'new').values(status='duplicate')
+        )
+    return len(duplicates)
+
+
+# Backfill for messages stored before fingerprinting existed
+async def dedup_block(block_id: int, batch_size: int = 1000) -> int:
+    marked, last_id = 0, 0
+    while True:
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(
+                select(MsgModel.id, MsgModel.content)
+                .join(Channel, Channel.id == MsgModel.channel_id)
+                .outerjoin(MessageFingerprint, MessageFingerprint.message_id == MsgModel.id)
+                .where(Channel.block_id == block_id, MsgModel.id > last_id,
+                       MessageFingerprint.message_id.is_(None))
+                .order_by(MsgModel.id)
+                .limit(batch_size)
+            )
+            batch = res.all()
+            if not batch:
+                return marked
+            marked += await index_messages(session, block_id, batch)
+            await session.commit()
+        last_id = batch[-1].id
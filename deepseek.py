@@ -1,19 +1,570 @@
-import aiohttp
-from config import DEESEEK_API_URL, DEESEEK_API_KEY, DEFAULT_REWRITE_STYLE
-
-_session = None
-
-async def get_session():
-    global _session
-    if _session is None:
-        _session = aiohttp.ClientSession()
-    return _session
-
-async def rewrite_text(text: str, style: str = None) -> str:
-    style_to_use = style or DEFAULT_REWRITE_STYLE
-    payload = { 'api_key': DEESEEK_API_KEY, 'text': text, 'style': style_to_use }
-    sess = await get_session()
-    async with sess.post(f"{DEESEEK_API_URL}/rewrite", json=payload) as resp:
-        resp.raise_for_status()
-        data = await resp.json()
-        return data.get('rewritten_text', text)
\ No newline at end of file
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import re
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from contextlib import aclosing
+
+import aiohttp
+from sqlalchemy.exc import IntegrityError
+
+from config import (
+    DEESEEK_API_URL, DEESEEK_API_KEY, DEFAULT_REWRITE_STYLE,
+    REWRITE_CACHE_SIZE, REWRITE_CACHE_TTL, REWRITE_CACHE_DB_TTL,
+    REWRITE_PACK_WINDOW, REWRITE_PACK_TOKENS, REWRITE_PACK_ITEM_TOKENS, REWRITE_PACK_MAX_ITEMS,
+    DEEPSEEK_POOL_SIZE, DEEPSEEK_DNS_TTL, DEEPSEEK_KEEPALIVE,
+    DEEPSEEK_CONNECT_TIMEOUT, DEEPSEEK_READ_TIMEOUT, DEEPSEEK_TIMEOUT,
+    DEEPSEEK_RETRIES, DEEPSEEK_RETRY_BASE, DEEPSEEK_RETRY_MAX,
+    DEEPSEEK_BREAKER_FAILURES, DEEPSEEK_BREAKER_COOLDOWN,
+    DEEPSEEK_CONCURRENCY, DEEPSEEK_MIN_CONCURRENCY, DEEPSEEK_MAX_CONCURRENCY, DEEPSEEK_LATENCY_TARGET
+)
+from models import AsyncSessionLocal, RewriteCache as CacheEntry
+import context
+from metrics import (
+    deepseek_seconds, deepseek_first_chunk_seconds, deepseek_bytes,
+    deepseek_packed_items, deepseek_pack_fallbacks,
+    deepseek_retries, deepseek_breaker_opens, deepseek_concurrency
+)
+
+logger = logging.getLogger(__name__)
+
+
+class DeepSeekError(Exception):
+    def __init__(self, message: str, status: int = None, retry_after: float = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def outage(self) -> bool:
+        # No answer in time or a 5xx: the upstream is in trouble, not the request
+        return self.status is None or self.status >= 500
+
+    @property
+    def overload(self) -> bool:
+        # ... or alive but throttling us
+        return self.outage or self.status == 429
+
+class CircuitOpenError(DeepSeekError):
+    pass
+
+
+# Consecutive outage answers open the breaker: for `cooldown` seconds every
+# call fails at once instead of queueing behind a dead endpoint. Then one probe
+# request goes through; its outcome closes the breaker or opens it again.
+class CircuitBreaker:
+    def __init__(self, failures=DEEPSEEK_BREAKER_FAILURES, cooldown=DEEPSEEK_BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self._failed = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def retry_after(self) -> float:
+        return max(self._opened_at + self.cooldown - time.monotonic(), 0.0)
+
+    def check(self):
+        if self.state == 'open':
+            if self.retry_after() > 0:
+                raise CircuitOpenError("DeepSeek circuit is open", retry_after=self.retry_after())
+            self.state = 'half_open'
+        if self.state == 'half_open':
+            if self._probing:
+                raise CircuitOpenError("DeepSeek circuit is half-open, probe in flight",
+                                       retry_after=self.cooldown)
+            self._probing = True
+
+    def record(self, failed: bool):
+        self._probing = False
+        if not failed:
+            self.state, self._failed = 'closed', 0
+            return
+        self._failed += 1
+        if self.state == 'half_open' or self._failed >= self.failures:
+            if self.state != 'open':
+                logger.warning("DeepSeek circuit opened after %d failures, retrying in %ss",
+                               self._failed, self.cooldown)
+                deepseek_breaker_opens.inc()
+            self.state, self._opened_at = 'open', time.monotonic()
+
+    def abandon(self):
+        # A cancelled call tells nothing about the upstream; let another probe try
+        self._probing = False
+
+
+# AIMD concurrency limit on requests in flight: +1/limit per healthy answer
+# (about +1 per round of `limit` requests), halved on an overload answer or one
+# slower than `target` seconds. Only requests sent after the last decrease can
+# cause the next one, so a burst of failures from one round halves it once.
+class AdaptiveLimiter:
+    def __init__(self, initial=DEEPSEEK_CONCURRENCY, minimum=DEEPSEEK_MIN_CONCURRENCY,
+                 maximum=DEEPSEEK_MAX_CONCURRENCY, target=DEEPSEEK_LATENCY_TARGET):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.inflight = 0
+        self._waiters = deque()
+        self._decreased_at = 0.0
+        deepseek_concurrency.set(self.limit)
+
+    async def acquire(self) -> float:
+        if self.inflight < int(self.limit) and not self._waiters:
+            self.inflight += 1
+            return time.monotonic()
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # the slot was handed over just as we were cancelled
+            else:
+                self._waiters.remove(fut)
+            raise
+        return time.monotonic()
+
+    def release(self, started: float = None, latency: float = None, overload: bool = False):
+        self.inflight -= 1
+        if started is not None:
+            if overload or latency > self.target:
+                if started >= self._decreased_at:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._decreased_at = time.monotonic()
+            elif latency is not None:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            deepseek_concurrency.set(self.limit)
+        # Freed and newly allowed slots go to the waiters in order
+        while self._waiters and self.inflight < int(self.limit):
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.inflight += 1
+                fut.set_result(None)
+
+
+def _retry_after(resp) -> float:
+    try:
+        return float(resp.headers.get('Retry-After', ''))
+    except ValueError:
+        return None
+
+def _backoff(attempt: int, retry_after: float = None) -> float:
+    # Full jitter: spreads the retries of many callers that failed together
+    delay = random.uniform(0, min(DEEPSEEK_RETRY_MAX, DEEPSEEK_RETRY_BASE * 2 ** attempt))
+    return max(delay, retry_after or 0)
+
+
+# One pooled session with keep-alive and a DNS cache, a deadline per request,
+# jittered retries on overload answers, the breaker and the limiter in front.
+class DeepSeekClient:
+    def __init__(self, url=DEESEEK_API_URL, retries=DEEPSEEK_RETRIES, timeout=DEEPSEEK_TIMEOUT,
+                 breaker: CircuitBreaker = None, limiter: AdaptiveLimiter = None):
+        self.url = url
+        self.retries = retries
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter or AdaptiveLimiter()
+        self._session = None
+
+    async def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=DEEPSEEK_POOL_SIZE, ttl_dns_cache=DEEPSEEK_DNS_TTL,
+                                             keepalive_timeout=DEEPSEEK_KEEPALIVE)
+            # A per-request ClientTimeout would replace this one as a whole, so all three live here
+            timeout = aiohttp.ClientTimeout(total=self.timeout, connect=DEEPSEEK_CONNECT_TIMEOUT,
+                                            sock_read=DEEPSEEK_READ_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            context.on_shutdown(self.close)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _call(self, payload: dict, headers: dict, read):
+        # read(resp) is an async generator over a 2xx response. A failed attempt
+        # is retried until the first value has gone out to the caller.
+        body = json.dumps(payload).encode('utf-8')
+        sess = await self.session()
+        for attempt in range(self.retries + 1):
+            self.breaker.check()
+            try:
+                started = await self.limiter.acquire()
+            except BaseException:
+                # Cancelled while queued: the probe slot check() took must go back
+                self.breaker.abandon()
+                raise
+            status, latency, yielded, error = 'error', None, False, None
+            try:
+                async with sess.post(f"{self.url}/rewrite", data=body, headers=headers) as resp:
+                    latency = time.monotonic() - started
+                    status = str(resp.status)
+                    deepseek_bytes.inc(len(body), 'sent')
+                    if resp.status >= 400:
+                        raw = await resp.read()
+                        deepseek_bytes.inc(len(raw), 'received')
+                        raise DeepSeekError(f"DeepSeek answered {resp.status}: {raw[:200]!r}",
+                                            resp.status, _retry_after(resp))
+                    async with aclosing(read(resp)) as values:
+                        async for value in values:
+                            yielded = True
+                            yield value
+            except DeepSeekError as e:
+                error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status = 'timeout' if isinstance(e, asyncio.TimeoutError) else 'error'
+                error = DeepSeekError(f"DeepSeek request failed: {e!r}")
+                error.__cause__ = e
+            except BaseException:
+                # Cancelled, or the caller stopped reading: no verdict on the upstream
+                self.breaker.abandon()
+                self.limiter.release()
+                raise
+            finally:
+                deepseek_seconds.observe(time.monotonic() - started, status)
+            if error is None:
+                self.breaker.record(False)
+                self.limiter.release(started, latency)
+                return
+            # A 429 lowers the limit but doesn't trip the breaker; other 4xx are the request's fault
+            self.breaker.record(error.outage)
+            self.limiter.release(started, latency, error.overload)
+            if not error.overload or yielded or attempt == self.retries \
+                    or (error.retry_after or 0) > DEEPSEEK_RETRY_MAX:
+                raise error
+            deepseek_retries.inc(1, status)
+            delay = _backoff(attempt, error.retry_after)
+            logger.info("DeepSeek %s, retry %d in %.2fs", status, attempt + 1, delay)
+            await asyncio.sleep(delay)
+
+    async def rewrite(self, text: str, style: str) -> str:
+        payload = { 'api_key': DEESEEK_API_KEY, 'text': text, 'style': style }
+        data = {}
+        async for data in self._call(payload, {'Content-Type': 'application/json'}, _read_json):
+            pass
+        return data.get('rewritten_text', text)
+
+    # Streaming: the request asks for server-sent events, one `data: {"delta": "..."}`
+    # line per chunk and `data: [DONE]` at the end
+    async def stream(self, text: str, style: str):
+        payload = { 'api_key': DEESEEK_API_KEY, 'text': text, 'style': style, 'stream': True }
+        headers = {'Content-Type': 'application/json', 'Accept': 'text/event-stream'}
+        start = time.perf_counter()
+        first = True
+        # aclosing: a reader that stops early gives the connection and the limiter slot back at once
+        async with aclosing(self._call(payload, headers, lambda resp: _read_events(resp, text))) as deltas:
+            async for delta in deltas:
+                if first:
+                    deepseek_first_chunk_seconds.observe(time.perf_counter() - start)
+                    first = False
+                yield delta
+
+async def _read_json(resp):
+    raw = await resp.read()
+    deepseek_bytes.inc(len(raw), 'received')
+    yield json.loads(raw)
+
+async def _read_events(resp, text: str):
+    received = 0
+    try:
+        if resp.content_type != 'text/event-stream':
+            # The server answered with a plain JSON body instead
+            raw = await resp.read()
+            received += len(raw)
+            yield json.loads(raw).get('rewritten_text', text)
+            return
+        async for line in resp.content:
+            received += len(line)
+            if not line.startswith(b'data:'):
+                continue
+            data = line[5:].strip()
+            if data == b'[DONE]':
+                return
+            delta = json.loads(data).get('delta')
+            if delta:
+                yield delta
+        raise aiohttp.ClientPayloadError("Rewrite stream ended before [DONE]")
+    finally:
+        deepseek_bytes.inc(received, 'received')
+
+client = DeepSeekClient()
+
+async def get_session() -> aiohttp.ClientSession:
+    return await client.session()
+
+async def close_session():
+    await client.close()
+
+
+# Content-addressed rewrite cache: in-memory LRU in front of the rewrite_cache table
+def cache_key(text: str, style: str) -> str:
+    normalized = ' '.join(unicodedata.normalize('NFKC', text or '').split())
+    return hashlib.sha256(f"{style}\0{normalized}".encode('utf-8')).hexdigest()
+
+class RewriteCache:
+    def __init__(self, max_size=REWRITE_CACHE_SIZE, ttl=REWRITE_CACHE_TTL, db_ttl=REWRITE_CACHE_DB_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_ttl = db_ttl
+        self._items = OrderedDict()  # key -> (stored_at, result)
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get_local(self, key: str):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        stored_at, result = item
+        if time.monotonic() - stored_at > self.ttl:
+            del self._items[key]
+            self.expirations += 1
+            return None
+        self._items.move_to_end(key)
+        return result
+
+    def put_local(self, key: str, result: str):
+        self._items[key] = (time.monotonic(), result)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    async def get(self, key: str):
+        result = self.get_local(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        try:
+            async with AsyncSessionLocal() as session:
+                entry = await session.get(CacheEntry, key)
+                if entry is not None and self._expired(entry):
+                    # Drop it so that put() can store the fresh rewrite under the same key
+                    await session.delete(entry)
+                    await session.commit()
+                    self.expirations += 1
+                    entry = None
+        except Exception:
+            logger.exception("Rewrite cache lookup failed")
+            entry = None
+        if entry is not None:
+            self.db_hits += 1
+            self.put_local(key, entry.result)
+            return entry.result
+        self.misses += 1
+        return None
+
+    def _expired(self, entry: CacheEntry) -> bool:
+        if self.db_ttl <= 0:
+            return False
+        return entry.created_at is None or datetime.utcnow() - entry.created_at > timedelta(seconds=self.db_ttl)
+
+    async def put(self, key: str, style: str, result: str):
+        self.put_local(key, result)
+        try:
+            async with AsyncSessionLocal() as session:
+                session.add(CacheEntry(key=key, style=style, result=result))
+                await session.commit()
+        except IntegrityError:
+            pass  # another process stored the same rewrite first
+        except Exception:
+            logger.exception("Rewrite cache store failed")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.db_hits + self.misses
+        return {
+            'size': len(self._items),
+            'hits': self.hits,
+            'db_hits': self.db_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': (self.hits + self.db_hits) / lookups if lookups else 0.0,
+        }
+
+cache = RewriteCache()
+_inflight = {}  # key -> future of the request currently fetching it
+
+def cache_stats() -> dict:
+    return cache.stats()
+
+
+# Request packing. Short texts that want the same style within REWRITE_PACK_WINDOW
+# go out as one prompt of numbered fragments; the answer is split on the same
+# markers. An answer that doesn't keep every marker in order is not trusted and
+# its texts are rewritten one request each.
+PACK_PROMPT = ("Перепиши каждый фрагмент ниже отдельно, в заданном стиле. Строки-маркеры вида <<<1>>> "
+               "оставь без изменений и в том же порядке, после каждого маркера пиши только "
+               "переписанный фрагмент.\n")
+_MARKER = re.compile(r'^<<<(\d+)>>>[ \t]*$', re.M)
+
+class PackingError(ValueError):
+    pass
+
+def estimate_tokens(text: str) -> int:
+    # BPE vocabularies average ~4 bytes of UTF-8 per token: ~4 Latin or ~2 Cyrillic letters
+    return len(text.encode('utf-8')) // 4 + 1
+
+PROMPT_TOKENS = estimate_tokens(PACK_PROMPT)
+MARKER_TOKENS = estimate_tokens('<<<16>>>\n')
+
+def pack(texts: list) -> str:
+    return PACK_PROMPT + ''.join(f"<<<{i}>>>\n{t.strip()}\n" for i, t in enumerate(texts, 1))
+
+def unpack(answer: str, count: int) -> list:
+    parts = _MARKER.split(answer)
+    numbers, bodies = parts[1::2], [b.strip() for b in parts[2::2]]
+    if numbers != [str(i) for i in range(1, count + 1)] or not all(bodies):
+        raise PackingError(f"expected {count} fragments, got markers {numbers}")
+    return bodies
+
+class RewriteBatcher:
+    def __init__(self, window=REWRITE_PACK_WINDOW, budget=REWRITE_PACK_TOKENS,
+                 item_tokens=REWRITE_PACK_ITEM_TOKENS, max_items=REWRITE_PACK_MAX_ITEMS):
+        self.window = window
+        self.budget = budget
+        self.item_tokens = item_tokens
+        self.max_items = max_items
+        self.requests = 0
+        self.packed = 0  # texts that went out in a packed request
+        self._batches = {}  # style -> [tokens, [(text, future)], timer]
+        self._sending = set()
+
+    def packable(self, text: str, tokens: int) -> bool:
+        return self.max_items > 1 and tokens <= self.item_tokens and '<<<' not in text
+
+    async def rewrite(self, text: str, style: str) -> str:
+        tokens = estimate_tokens(text) + MARKER_TOKENS
+        if not self.packable(text, tokens):
+            self.requests += 1
+            return await client.rewrite(text, style)
+        batch = self._batches.get(style)
+        if batch is not None and PROMPT_TOKENS + batch[0] + tokens > self.budget:
+            self._send(style)
+            batch = None
+        if batch is None:
+            timer = asyncio.get_running_loop().call_later(self.window, self._send, style)
+            batch = self._batches[style] = [0, [], timer]
+        fut = asyncio.get_running_loop().create_future()
+        batch[0] += tokens
+        batch[1].append((text, fut))
+        if len(batch[1]) >= self.max_items:
+            self._send(style)
+        return await fut
+
+    def _send(self, style: str):
+        batch = self._batches.pop(style, None)
+        if batch is None:
+            return
+        batch[2].cancel()
+        task = asyncio.create_task(self._request(style, batch[1]))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _request(self, style: str, items: list):
+        items = [(text, fut) for text, fut in items if not fut.done()]  # callers may have given up
+        if not items:
+            return
+        self.requests += 1
+        try:
+            if len(items) == 1:
+                results = [await client.rewrite(items[0][0], style)]
+            else:
+                deepseek_packed_items.observe(len(items))
+                answer = await client.rewrite(pack([text for text, _ in items]), style)
+                try:
+                    results = unpack(answer, len(items))
+                    self.packed += len(items)
+                except PackingError as e:
+                    logger.warning("Packed rewrite of %d texts not split back (%s), sending them one by one",
+                                   len(items), e)
+                    deepseek_pack_fallbacks.inc()
+                    self.requests += len(items)
+                    results = await asyncio.gather(
+                        *(client.rewrite(text, style) for text, _ in items), return_exceptions=True
+                    )
+        except asyncio.CancelledError:
+            for _, fut in items:
+                fut.cancel()
+            raise
+        except Exception as e:
+            results = [e] * len(items)
+        for (_, fut), result in zip(items, results):
+            if fut.done():
+                continue
+            if isinstance(result, BaseException):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+
+batcher = RewriteBatcher()
+
+
+async def rewrite_text(text: str, style: str = None) -> str:
+    style_to_use = style or DEFAULT_REWRITE_STYLE
+    key = cache_key(text, style_to_use)
+    cached = await cache.get(key)
+    if cached is not None:
+        return cached
+    # Identical requests that arrive while the first one is in flight share its result
+    pending = _inflight.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
+    try:
+        result = await batcher.rewrite(text, style_to_use)
+        await cache.put(key, style_to_use, result)
+        fut.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # mark retrieved when nobody else was waiting
+        raise
+    finally:
+        del _inflight[key]
+
+
+async def rewrite_text_stream(text: str, style: str = None):
+    # Like rewrite_text, but yields the rewrite as it grows; the last value is the result
+    style_to_use = style or DEFAULT_REWRITE_STYLE
+    key = cache_key(text, style_to_use)
+    cached = await cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+    pending = _inflight.get(key)
+    if pending is not None:
+        yield await asyncio.shield(pending)
+        return
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
+    result = ''
+    try:
+        async with aclosing(client.stream(text, style_to_use)) as deltas:
+            async for delta in deltas:
+                result += delta
+                yield result
+        await cache.put(key, style_to_use, result)
+        fut.set_result(result)
+    except (asyncio.CancelledError, GeneratorExit):
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()
+        raise
+    finally:
+        del _inflight[key]
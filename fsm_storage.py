@@ -0,0 +1,85 @@
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from aiogram import Bot
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from sqlalchemy import update
+
+from config import FSM_CACHE_TTL, FSM_CACHE_SIZE
+from models import AsyncSessionLocal, FsmState, insert_ignore
+
+
+# FSM storage in the fsm_states table so that every worker process sees the same
+# moderation sessions. Reads go through a short-lived in-process cache: aiogram
+# asks for the state on every update, and the handler usually reads it again.
+class SQLStorage(BaseStorage):
+    def __init__(self, session_factory=AsyncSessionLocal, ttl: float = FSM_CACHE_TTL,
+                 max_size: int = FSM_CACHE_SIZE):
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self.max_size = max_size
+        self._cache = OrderedDict()  # key -> [loaded_at, state, data]
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.destiny}"
+
+    def _remember(self, k: str, state, data: dict):
+        self._cache[k] = [time.monotonic(), state, data]
+        self._cache.move_to_end(k)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key: StorageKey):
+        k = self._key(key)
+        item = self._cache.get(k)
+        if item is not None and time.monotonic() - item[0] < self.ttl:
+            return item[1], item[2]
+        async with self.session_factory() as session:
+            row = await session.get(FsmState, k)
+        state = row.state if row else None
+        data = json.loads(row.data) if row and row.data else {}
+        self._remember(k, state, data)
+        return state, data
+
+    async def _write(self, key: StorageKey, **values):
+        k = self._key(key)
+        t = FsmState.__table__
+        values['updated_at'] = datetime.utcnow()
+        async with self.session_factory() as session:
+            res = await session.execute(update(t).where(t.c.key == k).values(**values))
+            if not res.rowcount:
+                res = await session.execute(insert_ignore(t).values(key=k, **values))
+                if not res.rowcount:  # another worker inserted the row first
+                    await session.execute(update(t).where(t.c.key == k).values(**values))
+            await session.commit()
+        # Keep a fresh cache entry current, forget a stale one
+        item = self._cache.get(k)
+        if item is not None and time.monotonic() - item[0] < self.ttl:
+            if 'state' in values:
+                item[1] = values['state']
+            if 'data' in values:
+                item[2] = json.loads(values['data'])
+        else:
+            self._cache.pop(k, None)
+
+    async def set_state(self, bot: Bot, key: StorageKey, state: StateType = None) -> None:
+        await self._write(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, bot: Bot, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(key)
+        return state
+
+    async def set_data(self, bot: Bot, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._write(key, data=json.dumps(data))
+
+    async def get_data(self, bot: Bot, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(key)
+        return dict(data)
+
+    async def close(self) -> None:
+        self._cache.clear()
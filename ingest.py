@@ -0,0 +1,233 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import select, update, bindparam, or_, tuple_
+
+from config import (
+    AUTO_SCAN_INTERVAL, INGEST_CONCURRENCY, INGEST_BATCH_SIZE,
+    TG_API_ID, TG_API_HASH, TG_SESSION
+)
+from models import AsyncSessionLocal, ThemeBlock, Channel, Message as MsgModel, MessageFingerprint, insert_ignore
+from dedup import index_messages
+from scoring import load_profile, score_texts
+from media import dump_media, resolve_media
+import context
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SourcePost:
+    message_id: int
+    content: str
+    timestamp: datetime
+    media: list = field(default_factory=list)  # typed items, see media.py
+
+
+# Fetch backends. A source returns the posts of one channel that are newer than
+# `after_id` (when known) and not older than `since`, and downloads their media
+# to a file.
+class ChannelSource:
+    async def fetch(self, username: str, since: datetime, after_id: Optional[int] = None) -> List[SourcePost]:
+        raise NotImplementedError
+
+    async def download(self, username: str, message_id: int, path: str):
+        raise NotImplementedError
+
+
+class TelethonSource(ChannelSource):
+    def __init__(self, api_id=TG_API_ID, api_hash=TG_API_HASH, session=TG_SESSION):
+        self.api_id = api_id
+        self.api_hash = api_hash
+        self.session = session
+        self._client = None
+        self._lock = asyncio.Lock()
+
+    async def _get_client(self):
+        async with self._lock:
+            if self._client is None:
+                if not self.api_id or not self.api_hash:
+                    raise RuntimeError("TG_API_ID/TG_API_HASH are required to read source channels")
+                from telethon import TelegramClient
+                client = TelegramClient(self.session, int(self.api_id), self.api_hash)
+                await client.start()
+                self._client = client
+                context.on_shutdown(self.close)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.disconnect()
+            self._client = None
+
+    @staticmethod
+    def _media_type(m) -> Optional[str]:
+        if m.photo:
+            return 'photo'
+        if m.video:
+            return 'video'
+        if m.document:
+            return 'document'
+        return None
+
+    async def fetch(self, username, since, after_id=None):
+        client = await self._get_client()
+        posts, albums = [], {}
+        # iter_messages walks from newest to oldest, min_id cuts at the watermark
+        async for m in client.iter_messages(username, min_id=after_id or 0):
+            ts = m.date.replace(tzinfo=None)
+            if ts < since:
+                break
+            kind = self._media_type(m)
+            item = {'type': kind, 'source': username, 'message_id': m.id} if kind else None
+            if m.grouped_id is None:
+                posts.append(SourcePost(m.id, m.message or '', ts, [item] if item else []))
+                continue
+            # Album parts are separate messages: merge them into one post keyed by
+            # the highest id so the watermark moves past the whole album
+            post = albums.get(m.grouped_id)
+            if post is None:
+                post = albums[m.grouped_id] = SourcePost(m.id, '', ts)
+                posts.append(post)
+            post.content = post.content or m.message or ''
+            post.timestamp = min(post.timestamp, ts)
+            if item:
+                post.media.insert(0, item)
+        return posts
+
+    async def download(self, username, message_id, path):
+        client = await self._get_client()
+        m = await client.get_messages(username, ids=message_id)
+        if m is None or m.media is None:
+            raise LookupError(f"{username}/{message_id} has no media")
+        await client.download_media(m, file=path)
+
+
+_source: Optional[ChannelSource] = None
+
+def get_source() -> ChannelSource:
+    global _source
+    if _source is None:
+        _source = TelethonSource()
+    return _source
+
+def set_source(source: ChannelSource):
+    global _source
+    _source = source
+
+
+# Ingestion
+async def _fetch_channel(source, sem, ch, since):
+    async with sem:
+        posts = await source.fetch(ch.username, since, ch.last_message_id)
+        last = ch.last_message_id or 0
+        fresh = [p for p in posts if p.message_id > last and p.timestamp >= since]
+        # The Telethon session stays in this worker: publications get Bot API file_ids
+        for p in fresh:
+            p.media = await resolve_media(source, p.media)
+        return ch, fresh
+
+async def _store(block_id: int, profile: dict, rows: list, watermarks: dict):
+    # Relevance is scored for the whole flush in one vectorized batch
+    for row, score in zip(rows, score_texts(profile, [r['content'] for r in rows])):
+        row['score'] = float(score)
+    async with AsyncSessionLocal() as session:
+        for i in range(0, len(rows), INGEST_BATCH_SIZE):
+            chunk = rows[i:i + INGEST_BATCH_SIZE]
+            # Rows another scan already stored are skipped by the unique index
+            await session.execute(insert_ignore(MsgModel.__table__), chunk)
+            res = await session.execute(
+                select(MsgModel.id, MsgModel.content)
+                .outerjoin(MessageFingerprint, MessageFingerprint.message_id == MsgModel.id)
+                .where(tuple_(MsgModel.channel_id, MsgModel.original_message_id).in_(
+                           [(r['channel_id'], r['original_message_id']) for r in chunk]),
+                       MessageFingerprint.message_id.is_(None))
+                .order_by(MsgModel.timestamp, MsgModel.id)
+            )
+            await index_messages(session, block_id, res.all())
+        if watermarks:
+            ch = Channel.__table__
+            await session.execute(
+                update(ch)
+                .where(ch.c.id == bindparam('cid'))
+                .where(or_(ch.c.last_message_id.is_(None), ch.c.last_message_id < bindparam('wm')))
+                .values(last_message_id=bindparam('wm')),
+                [{'cid': cid, 'wm': wm} for cid, wm in watermarks.items()]
+            )
+        await session.commit()
+
+async def scan_block(block_id: int, hours: int, source: ChannelSource = None) -> list:
+    source = source or get_source()
+    since = datetime.utcnow() - timedelta(hours=hours)
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(select(Channel).where(Channel.block_id == block_id))
+        channels = res.scalars().all()
+        block = await session.get(ThemeBlock, block_id)
+    if not channels:
+        return []
+    profile = load_profile(block)
+
+    sem = asyncio.Semaphore(INGEST_CONCURRENCY)
+    collected, rows, watermarks = [], [], {}
+    for fut in asyncio.as_completed([_fetch_channel(source, sem, ch, since) for ch in channels]):
+        try:
+            ch, fresh = await fut
+        except Exception:
+            logger.exception("Channel fetch failed in block %s", block_id)
+            continue
+        if not fresh:
+            continue
+        rows.extend(
+            {'channel_id': ch.id, 'original_message_id': p.message_id,
+             'content': p.content, 'timestamp': p.timestamp, 'status': 'new',
+             'media': dump_media(p.media)}
+            for p in fresh
+        )
+        watermarks[ch.id] = max(p.message_id for p in fresh)
+        # Flush as soon as a full batch is ready so slow channels don't hold up writes
+        if len(rows) >= INGEST_BATCH_SIZE:
+            await _store(block_id, profile, rows, watermarks)
+            collected.extend(rows)
+            rows, watermarks = [], {}
+    if rows:
+        await _store(block_id, profile, rows, watermarks)
+        collected.extend(rows)
+    return collected
+
+
+# Periodic scan of every block for the ingest worker. Each run looks back one
+# interval plus an hour; channel watermarks drop what an earlier run stored.
+class AutoScanner:
+    def __init__(self, interval: int = AUTO_SCAN_INTERVAL):
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def scan_all(self) -> int:
+        async with AsyncSessionLocal() as session:
+            block_ids = (await session.execute(select(ThemeBlock.id).order_by(ThemeBlock.id))).scalars().all()
+        hours = self.interval // 3600 + 1
+        stored = 0
+        for block_id in block_ids:
+            try:
+                stored += len(await scan_block(block_id, hours))
+            except Exception:
+                logger.exception("Auto scan of block %s failed", block_id)
+        logger.info("Auto scan stored %d messages from %d blocks", stored, len(block_ids))
+        return stored
+
+    async def _run(self):
+        while True:
+            await self.scan_all()
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime
+from typing import TYPE_CHECKING, List, Optional
+
+from sqlalchemy import select, delete, func
+
+from config import MEDIA_GROUP_WINDOW, MEDIA_STASH_CHAT
+from models import AsyncSessionLocal, AlbumPart, insert_ignore
+
+if TYPE_CHECKING:
+    from aiogram.types import Message
+    from ingest import ChannelSource
+
+logger = logging.getLogger(__name__)
+
+# Media is stored as an ordered JSON list of typed items:
+#   {"type": "photo", "media": "<Bot API file_id or URL>"}
+#   {"type": "video", "source": "@channel", "message_id": 42}  (ingested, not uploaded yet)
+_EXTENSIONS = {'photo': 'jpg', 'video': 'mp4', 'document': 'bin'}
+_UPLOADS = {'photo': 'send_photo', 'video': 'send_video', 'document': 'send_document'}
+
+
+def load_media(value: Optional[str]) -> List[dict]:
+    if not value:
+        return []
+    if not value.startswith('['):
+        return [{'type': 'photo', 'media': value}]  # a bare file_id from before typed media
+    return json.loads(value)
+
+def dump_media(items: List[dict]) -> Optional[str]:
+    return json.dumps(items) if items else None
+
+def media_item(msg: 'Message') -> Optional[dict]:
+    if msg.photo:
+        return {'type': 'photo', 'media': msg.photo[-1].file_id}
+    if msg.video:
+        return {'type': 'video', 'media': msg.video.file_id}
+    if msg.document:
+        return {'type': 'document', 'media': msg.document.file_id}
+    return None
+
+def _file_id(sent, kind: str) -> str:
+    if kind == 'photo':
+        return sent.photo[-1].file_id
+    return getattr(sent, kind).file_id
+
+async def resolve_media(source: 'ChannelSource', items: List[dict]) -> List[dict]:
+    # Ingested media is only known to the source channel and only the ingest worker
+    # holds the Telethon session. It downloads each file to disk once and uploads it
+    # to MEDIA_STASH_CHAT; the item keeps the Bot API file_id from then on.
+    if not any('source' in item for item in items):
+        return items
+    if not MEDIA_STASH_CHAT:
+        logger.warning("MEDIA_STASH_CHAT is not set, ingested media can't be published")
+        return items
+    from aiogram.types import FSInputFile
+    from publisher import get_bot, outbox
+    bot = get_bot()
+    result = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for item in items:
+            if 'source' not in item:
+                result.append(item)
+                continue
+            kind = item['type']
+            path = os.path.join(tmp, f"{item['message_id']}.{_EXTENSIONS[kind]}")
+            try:
+                await source.download(item['source'], item['message_id'], path)
+                sent, = await outbox.submit(MEDIA_STASH_CHAT, [
+                    (1, lambda k=kind, p=path: getattr(bot, _UPLOADS[k])(MEDIA_STASH_CHAT, FSInputFile(p)))
+                ])
+            except Exception:
+                logger.exception("Media %s/%s could not be resolved", item['source'], item['message_id'])
+                result.append(item)
+                continue
+            finally:
+                if os.path.exists(path):
+                    os.remove(path)
+            result.append({'type': kind, 'media': _file_id(sent, kind)})
+    return result
+
+def input_media(items: List[dict]) -> list:
+    from aiogram.types import InputMediaPhoto, InputMediaVideo, InputMediaDocument
+    input_types = {'photo': InputMediaPhoto, 'video': InputMediaVideo, 'document': InputMediaDocument}
+    unresolved = [item for item in items if 'media' not in item]
+    if unresolved:
+        # Publishers never open the ingest worker's Telethon session
+        raise LookupError(f"{len(unresolved)} media were not uploaded at ingest, see MEDIA_STASH_CHAT")
+    return [input_types[item['type']](media=item['media']) for item in items]
+
+
+# Telegram delivers every part of an album as its own update with a shared
+# media_group_id, and with WEB_WORKERS > 1 the parts land in different
+# processes. Every part goes to the album_parts table; the part with the
+# lowest message id waits until no new part has arrived for
+# MEDIA_GROUP_WINDOW seconds and returns the whole album in message order,
+# the others return None.
+class AlbumCollector:
+    def __init__(self, window: float = MEDIA_GROUP_WINDOW, session_factory=AsyncSessionLocal):
+        self.window = window
+        self.session_factory = session_factory
+
+    async def collect(self, key, order: int, item: dict) -> Optional[List[dict]]:
+        k = ':'.join(map(str, key))
+        t = AlbumPart.__table__
+        async with self.session_factory() as session:
+            await session.execute(insert_ignore(t).values(
+                group_key=k, message_id=order, item=json.dumps(item), created_at=datetime.utcnow()
+            ))
+            await session.commit()
+        while True:
+            async with self.session_factory() as session:
+                res = await session.execute(
+                    select(func.min(t.c.message_id), func.max(t.c.created_at)).where(t.c.group_key == k)
+                )
+                first, last = res.one()
+            if first is None or first < order:
+                return None  # an earlier part collects the album, or already has
+            wait = self.window - (datetime.utcnow() - last).total_seconds()
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        async with self.session_factory() as session:
+            res = await session.execute(
+                select(t.c.message_id, t.c.item).where(t.c.group_key == k).order_by(t.c.message_id)
+            )
+            parts = res.all()
+            await session.execute(
+                delete(t).where(t.c.group_key == k, t.c.message_id.in_([p.message_id for p in parts]))
+            )
+            await session.commit()
+        return [json.loads(p.item) for p in parts]
+
+albums = AlbumCollector()
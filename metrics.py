@@ -0,0 +1,255 @@
+import functools
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# In-process metrics: fixed-bucket histograms and counters, exported in the
+# Prometheus text format. One observation is a bisect and two dict lookups.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+_metrics = []
+
+
+def _labels(names, values, extra='') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _num(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, *labels):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def render(self) -> list:
+        return [f'{self.name}{_labels(self.labels, key)} {_num(v)}' for key, v in sorted(self.values.items())]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+class HistogramSeries:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        _metrics.append(self)
+
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = HistogramSeries(len(self.buckets) + 1)
+        series.counts[bisect_left(self.buckets, value)] += 1
+        series.sum += value
+        series.count += 1
+
+    def quantile(self, q: float, *labels) -> float:
+        # Linear interpolation inside the bucket, as histogram_quantile() does
+        series = self.series.get(labels)
+        if series is None or not series.count:
+            return 0.0
+        rank = q * series.count
+        seen = 0
+        for i, n in enumerate(series.counts):
+            if seen + n >= rank and n:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def render(self) -> list:
+        lines = []
+        for key, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, series.counts):
+                cumulative += n
+                le = _labels(self.labels, key, 'le="%s"' % bound)
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            le = _labels(self.labels, key, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{le} {series.count}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, key)} {_num(series.sum)}')
+            lines.append(f'{self.name}_count{_labels(self.labels, key)} {series.count}')
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for m in _metrics:
+        lines.append(f'# HELP {m.name} {m.help}')
+        lines.append(f'# TYPE {m.name} {m.kind}')
+        lines.extend(m.render())
+    return '\n'.join(lines) + '\n'
+
+
+handler_seconds = Histogram('contentmaker_handler_seconds', 'Handler and job run time',
+                            ('handler', 'status'))
+handler_queries = Histogram('contentmaker_handler_db_queries', 'SQL statements per handler run',
+                            ('handler',), COUNT_BUCKETS)
+db_query_seconds = Histogram('contentmaker_db_query_seconds', 'SQL statement time', ('handler',))
+deepseek_seconds = Histogram('contentmaker_deepseek_request_seconds', 'DeepSeek request time', ('status',))
+deepseek_first_chunk_seconds = Histogram('contentmaker_deepseek_first_chunk_seconds',
+                                        'Time to the first streamed rewrite chunk')
+deepseek_bytes = Counter('contentmaker_deepseek_bytes_total', 'DeepSeek payload bytes', ('direction',))
+deepseek_packed_items = Histogram('contentmaker_deepseek_packed_items', 'Texts per packed DeepSeek request',
+                                  (), COUNT_BUCKETS)
+deepseek_pack_fallbacks = Counter('contentmaker_deepseek_pack_fallbacks_total',
+                                  'Packed responses that could not be split back')
+deepseek_retries = Counter('contentmaker_deepseek_retries_total', 'DeepSeek requests sent again', ('status',))
+deepseek_breaker_opens = Counter('contentmaker_deepseek_breaker_opens_total', 'Times the DeepSeek circuit opened')
+deepseek_concurrency = Gauge('contentmaker_deepseek_concurrency_limit', 'Adaptive limit of DeepSeek requests in flight')
+telegram_seconds = Histogram('contentmaker_telegram_request_seconds', 'Bot API call time',
+                             ('method', 'status'))
+publish_seconds = Histogram('contentmaker_publish_seconds', 'Post time from submit to last API call',
+                            ('priority',))
+publish_retry_after = Counter('contentmaker_publish_retry_after_total', 'Flood control retries')
+retention_rows = Counter('contentmaker_retention_rows_total', 'Rows archived or deleted by retention', ('table',))
+startup_seconds = Histogram('contentmaker_startup_seconds', 'Process start to ready, imports included', ('role',))
+retention_bytes = Counter('contentmaker_retention_bytes_total', 'Payload bytes moved out of the hot tables',
+                          ('kind',))
+
+
+# The current handler; SQL statements issued while it runs are attributed to it
+_scope = ContextVar('metrics_scope', default=None)
+
+@contextmanager
+def track(label: str):
+    scope = [label, 0]
+    token = _scope.set(scope)
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        handler_seconds.observe(time.perf_counter() - start, label, status)
+        handler_queries.observe(scope[1], label)
+        _scope.reset(token)
+
+# Same for background jobs that no middleware sees
+def tracked(label: str):
+    def decorate(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with track(label):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def instrument_engine(engine):
+    # engine is the sync Engine behind an AsyncEngine (AsyncEngine.sync_engine)
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_started'].pop()
+        scope = _scope.get()
+        if scope is None:
+            db_query_seconds.observe(elapsed, 'background')
+            return
+        scope[1] += 1
+        db_query_seconds.observe(elapsed, scope[0])
+
+    @event.listens_for(engine, 'handle_error')
+    def _error(context):
+        started = context.connection.info.get('metrics_started') if context.connection else None
+        if started:
+            started.pop()
+
+
+async def start_server(host: str, port: int):
+    from aiohttp import web  # workers without an HTTP server of their own don't pay for it
+    async def handle(request):
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Metrics on http://%s:%s/metrics", host, port)
+    return runner
+
+
+def _merged(hist, match=lambda key: True) -> dict:
+    count = total = 0
+    p95 = 0.0
+    for key, series in hist.series.items():
+        if match(key):
+            count += series.count
+            total += series.sum
+            p95 = max(p95, hist.quantile(0.95, *key))
+    return {'count': count, 'avg': total / count if count else 0.0, 'p95': p95}
+
+def summary(top: int = 10) -> dict:
+    handlers = []
+    for label in {key[0] for key in handler_seconds.series}:
+        h = _merged(handler_seconds, lambda key: key[0] == label)
+        h['errors'] = _merged(handler_seconds, lambda key: key == (label, 'error'))['count']
+        queries = handler_queries.series.get((label,))
+        h['queries'] = queries.sum / queries.count if queries and queries.count else 0.0
+        handlers.append((label, h))
+    # Where the time goes: busiest handlers by total time first
+    handlers.sort(key=lambda item: item[1]['count'] * item[1]['avg'], reverse=True)
+    return {
+        'handlers': handlers[:top],
+        'db': _merged(db_query_seconds),
+        'deepseek': _merged(deepseek_seconds),
+        'deepseek_first_chunk': _merged(deepseek_first_chunk_seconds),
+        'deepseek_errors': _merged(deepseek_seconds, lambda key: key[0] != '200')['count'],
+        'deepseek_bytes': {d: deepseek_bytes.values.get((d,), 0) for d in ('sent', 'received')},
+        'deepseek_packed': _merged(deepseek_packed_items),
+        'deepseek_pack_fallbacks': deepseek_pack_fallbacks.total(),
+        'deepseek_retries': deepseek_retries.total(),
+        'deepseek_breaker_opens': deepseek_breaker_opens.total(),
+        'deepseek_concurrency': deepseek_concurrency.values.get((), 0),
+        'telegram': _merged(telegram_seconds),
+        'telegram_retry_after': publish_retry_after.total(),
+        'publish': _merged(publish_seconds),
+    }
@@ -0,0 +1,272 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import (
+    MetaData, Table, Column, Integer, String, DateTime,
+    inspect, text, select
+)
+
+from config import SEARCH_LANGUAGE
+from models import Base
+
+logger = logging.getLogger(__name__)
+
+# Applied versions live in their own metadata so create_all never touches them
+_meta = MetaData()
+schema_migrations = Table(
+    'schema_migrations', _meta,
+    Column('version', Integer, primary_key=True),
+    Column('description', String, nullable=False),
+    Column('applied_at', DateTime, default=datetime.utcnow),
+)
+
+MIGRATIONS = []
+
+def migration(version: int, description: str):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return register
+
+
+# Helpers. Every migration is idempotent: a fresh database gets the current
+# models from create_all and the later steps only fill what is missing.
+def _tables(conn) -> set:
+    return set(inspect(conn).get_table_names())
+
+def _columns(conn, table: str) -> dict:
+    return {c['name']: c for c in inspect(conn).get_columns(table)}
+
+def _add_column(conn, table: str, name: str):
+    column = Base.metadata.tables[table].c[name]
+    if name in _columns(conn, table):
+        return
+    col_type = column.type.compile(dialect=conn.dialect)
+    conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} {col_type}'))
+
+def _create_index(conn, name: str, table: str, *columns: str, unique: bool = False):
+    # Spelled out per migration: the live model may index columns a later step adds
+    kind = 'UNIQUE INDEX' if unique else 'INDEX'
+    conn.execute(text(f'CREATE {kind} IF NOT EXISTS {name} ON {table} ({", ".join(columns)})'))
+
+def _drop_not_null(conn, table: str, name: str):
+    if _columns(conn, table)[name]['nullable']:
+        return
+    if conn.dialect.name != 'sqlite':
+        conn.execute(text(f'ALTER TABLE {table} ALTER COLUMN {name} DROP NOT NULL'))
+        return
+    # SQLite can't alter a column in place: copy into a table built from the model
+    model = Base.metadata.tables[table]
+    shared = ', '.join(c for c in _columns(conn, table) if c in model.c)
+    for index in inspect(conn).get_indexes(table):
+        conn.execute(text(f'DROP INDEX IF EXISTS {index["name"]}'))
+    scratch = MetaData()
+    for t in Base.metadata.sorted_tables:
+        t.to_metadata(scratch)  # so foreign keys of the copy resolve
+    model.to_metadata(scratch, name=f'_new_{table}').create(conn)
+    conn.execute(text(f'INSERT INTO _new_{table} ({shared}) SELECT {shared} FROM {table}'))
+    conn.execute(text(f'DROP TABLE {table}'))
+    conn.execute(text(f'ALTER TABLE _new_{table} RENAME TO {table}'))
+
+
+@migration(1, "move the legacy database.py sqlite schema out of the way")
+def _rename_legacy_tables(conn):
+    tables = _tables(conn)
+    if 'thematic_blocks' not in tables:
+        return
+    conn.execute(text('ALTER TABLE thematic_blocks RENAME TO legacy_thematic_blocks'))
+    if 'channels' in tables and 'added_at' not in _columns(conn, 'channels'):
+        conn.execute(text('ALTER TABLE channels RENAME TO legacy_channels'))
+    if 'messages' in tables and 'original_text' in _columns(conn, 'messages'):
+        conn.execute(text('ALTER TABLE messages RENAME TO legacy_messages'))
+    if 'publication_queue' in tables:
+        conn.execute(text('ALTER TABLE publication_queue RENAME TO legacy_publication_queue'))
+
+@migration(2, "create tables from models")
+def _create_tables(conn):
+    Base.metadata.create_all(conn)
+
+@migration(3, "ingestion watermark, rewrite queue and publication tracking columns")
+def _pipeline_columns(conn):
+    _add_column(conn, 'channels', 'last_message_id')
+    for name in ('attempts', 'error', 'updated_at'):
+        _add_column(conn, 'rewrite_tasks', name)
+    _drop_not_null(conn, 'rewrite_tasks', 'result')
+    for name in ('attempts', 'last_error', 'claimed_by', 'claimed_at', 'published_at'):
+        _add_column(conn, 'publication_schedule', name)
+
+@migration(4, "drop duplicate messages and make (channel_id, original_message_id) unique")
+def _unique_messages(conn):
+    dupes = conn.execute(text(
+        'SELECT m.id, k.keep_id FROM messages m JOIN ('
+        ' SELECT channel_id, original_message_id, MIN(id) AS keep_id FROM messages'
+        ' GROUP BY channel_id, original_message_id HAVING COUNT(*) > 1'
+        ') k ON k.channel_id = m.channel_id AND k.original_message_id = m.original_message_id'
+        ' WHERE m.id <> k.keep_id'
+    )).all()
+    for mid, keep_id in dupes:
+        conn.execute(text('UPDATE rewrite_tasks SET message_id = :keep WHERE message_id = :mid'),
+                     {'keep': keep_id, 'mid': mid})
+        conn.execute(text('DELETE FROM fingerprint_bands WHERE message_id = :mid'), {'mid': mid})
+        conn.execute(text('DELETE FROM message_fingerprints WHERE message_id = :mid'), {'mid': mid})
+        conn.execute(text('DELETE FROM messages WHERE id = :mid'), {'mid': mid})
+    if dupes:
+        logger.info("Removed %s duplicate messages", len(dupes))
+    _create_index(conn, 'uq_messages_channel_original', 'messages', 'channel_id', 'original_message_id', unique=True)
+    _create_index(conn, 'ix_messages_channel_status', 'messages', 'channel_id', 'status')
+
+@migration(5, "indexes for the hot status queries")
+def _hot_indexes(conn):
+    _create_index(conn, 'ix_rewrite_tasks_status', 'rewrite_tasks', 'status', 'id')
+    _create_index(conn, 'ix_rewrite_tasks_message', 'rewrite_tasks', 'message_id')
+    _create_index(conn, 'ix_moderation_tasks_rewrite_status', 'moderation_tasks', 'rewrite_id', 'status')
+    _create_index(conn, 'ix_publication_schedule_status_time', 'publication_schedule', 'status', 'scheduled_time')
+
+@migration(6, "import blocks, channels and messages from the legacy schema")
+def _import_legacy(conn):
+    tables = _tables(conn)
+    if 'legacy_thematic_blocks' not in tables:
+        return
+    conn.execute(text(
+        'INSERT INTO theme_blocks (title, created_at)'
+        ' SELECT name, CURRENT_TIMESTAMP FROM legacy_thematic_blocks'
+        ' WHERE name IS NOT NULL AND name NOT IN (SELECT title FROM theme_blocks)'
+    ))
+    if 'legacy_channels' in tables:
+        conn.execute(text(
+            'INSERT INTO channels (block_id, username, added_at)'
+            ' SELECT tb.id, lc.username, CURRENT_TIMESTAMP FROM legacy_channels lc'
+            ' JOIN legacy_thematic_blocks lb ON lb.id = lc.block_id'
+            ' JOIN theme_blocks tb ON tb.title = lb.name'
+            ' WHERE NOT EXISTS (SELECT 1 FROM channels c'
+            '  WHERE c.block_id = tb.id AND c.username = lc.username)'
+        ))
+    if 'legacy_messages' not in tables:
+        return
+    # Legacy messages only know their block: they go into a placeholder channel
+    conn.execute(text(
+        "INSERT INTO channels (block_id, username, added_at)"
+        " SELECT DISTINCT tb.id, '__legacy__', CURRENT_TIMESTAMP FROM legacy_messages lm"
+        " JOIN legacy_thematic_blocks lb ON lb.id = lm.block_id"
+        " JOIN theme_blocks tb ON tb.title = lb.name"
+        " WHERE NOT EXISTS (SELECT 1 FROM channels c"
+        "  WHERE c.block_id = tb.id AND c.username = '__legacy__')"
+    ))
+    conn.execute(text(
+        "INSERT INTO messages (channel_id, original_message_id, content, timestamp, status)"
+        " SELECT c.id, lm.id, lm.original_text, lm.created_at,"
+        "  CASE WHEN lm.status = 'raw' THEN 'new' ELSE lm.status END"
+        " FROM legacy_messages lm"
+        " JOIN legacy_thematic_blocks lb ON lb.id = lm.block_id"
+        " JOIN theme_blocks tb ON tb.title = lb.name"
+        " JOIN channels c ON c.block_id = tb.id AND c.username = '__legacy__'"
+        " WHERE NOT EXISTS (SELECT 1 FROM messages m"
+        "  WHERE m.channel_id = c.id AND m.original_message_id = lm.id)"
+    ))
+    conn.execute(text(
+        "INSERT INTO rewrite_tasks (message_id, style, result, status, attempts, created_at)"
+        " SELECT m.id, 'legacy', lm.rewritten_text, 'done', 0, CURRENT_TIMESTAMP"
+        " FROM legacy_messages lm"
+        " JOIN legacy_thematic_blocks lb ON lb.id = lm.block_id"
+        " JOIN theme_blocks tb ON tb.title = lb.name"
+        " JOIN channels c ON c.block_id = tb.id AND c.username = '__legacy__'"
+        " JOIN messages m ON m.channel_id = c.id AND m.original_message_id = lm.id"
+        " WHERE lm.rewritten_text IS NOT NULL"
+        " AND NOT EXISTS (SELECT 1 FROM rewrite_tasks rt WHERE rt.message_id = m.id)"
+    ))
+
+@migration(7, "shared FSM storage table")
+def _fsm_states(conn):
+    Base.metadata.tables['fsm_states'].create(conn, checkfirst=True)
+
+@migration(8, "media of ingested messages")
+def _message_media(conn):
+    _add_column(conn, 'messages', 'media')
+
+@migration(9, "publication slots per target channel")
+def _publication_slots(conn):
+    for name in ('target_chat', 'slot'):
+        _add_column(conn, 'publication_schedule', name)
+    _create_index(conn, 'uq_publication_schedule_slot', 'publication_schedule', 'target_chat', 'slot', unique=True)
+
+# Full-text search over messages.content and rewrite_tasks.result. SQLite keeps an
+# external-content FTS5 table per column, synced by triggers; Postgres a generated
+# tsvector column with a GIN index. Either way every write path updates it.
+SEARCH_SOURCES = (('messages', 'content', 'messages_fts'), ('rewrite_tasks', 'result', 'rewrites_fts'))
+
+@migration(10, "full-text search index")
+def _search_index(conn):
+    for table, column, fts in SEARCH_SOURCES:
+        if conn.dialect.name == 'postgresql':
+            if 'search_vector' not in _columns(conn, table):
+                conn.execute(text(
+                    f"ALTER TABLE {table} ADD COLUMN search_vector tsvector GENERATED ALWAYS AS"
+                    f" (to_tsvector('{SEARCH_LANGUAGE}'::regconfig, coalesce({column}, ''))) STORED"
+                ))
+            conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} USING GIN (search_vector)'))
+            continue
+        conn.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({column}, content='{table}',"
+            f" content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        ))
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} WHEN new.{column} IS NOT NULL BEGIN"
+            f" INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END"
+        ))
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} WHEN old.{column} IS NOT NULL BEGIN"
+            f" INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); END"
+        ))
+        conn.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {column} ON {table} BEGIN"
+            f" INSERT INTO {fts}({fts}, rowid, {column}) SELECT 'delete', old.id, old.{column} WHERE old.{column} IS NOT NULL;"
+            f" INSERT INTO {fts}(rowid, {column}) SELECT new.id, new.{column} WHERE new.{column} IS NOT NULL; END"
+        ))
+        conn.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+
+@migration(11, "message archive and retention indexes")
+def _retention(conn):
+    Base.metadata.tables['archived_messages'].create(conn, checkfirst=True)
+    _create_index(conn, 'ix_messages_status_timestamp', 'messages', 'status', 'timestamp')
+    _create_index(conn, 'ix_fingerprint_bands_message', 'fingerprint_bands', 'message_id')
+
+@migration(12, "block keyword profiles and message relevance scores")
+def _relevance(conn):
+    for name in ('keywords', 'profile'):
+        _add_column(conn, 'theme_blocks', name)
+    _add_column(conn, 'messages', 'score')
+    conn.execute(text('UPDATE messages SET score = 0 WHERE score IS NULL'))  # /rescore fills real values
+    _create_index(conn, 'ix_messages_status_score', 'messages', 'status', 'score', 'id')
+
+
+@migration(13, "rewrite task claims")
+def _rewrite_claims(conn):
+    for name in ('claimed_by', 'claimed_at'):
+        _add_column(conn, 'rewrite_tasks', name)
+
+@migration(14, "shared album buffer")
+def _album_parts(conn):
+    Base.metadata.tables['album_parts'].create(conn, checkfirst=True)
+
+@migration(15, "rewrite cache expiry index")
+def _rewrite_cache_expiry(conn):
+    _create_index(conn, 'ix_rewrite_cache_created_at', 'rewrite_cache', 'created_at')
+
+
+def upgrade(conn, target: int = None):
+    # target stops after that version; benchmarks/upgrade.py starts from every step
+    if conn.dialect.name == 'postgresql':
+        # Several workers may start at once; only one of them migrates
+        conn.execute(text('SELECT pg_advisory_xact_lock(727001)'))
+    _meta.create_all(conn)
+    applied = set(conn.execute(select(schema_migrations.c.version)).scalars().all())
+    for version, description, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        if target is not None and version > target:
+            break
+        logger.info("Applying migration %s: %s", version, description)
+        fn(conn)
+        conn.execute(schema_migrations.insert().values(
+            version=version, description=description, applied_at=datetime.utcnow()
+        ))
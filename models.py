@@ -1,74 +1,185 @@
-from datetime import datetime
-from sqlalchemy import (
-    Column, Integer, String, DateTime, ForeignKey, Text, UniqueConstraint
-)
-from sqlalchemy.orm import relationship, declarative_base
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
-from config import DATABASE_URL
-
-Base = declarative_base()
-
-class ThemeBlock(Base):
-    __tablename__ = 'theme_blocks'
-    id = Column(Integer, primary_key=True)
-    title = Column(String, nullable=False, unique=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    channels = relationship('Channel', back_populates='block', cascade='all, delete')
-
-class Channel(Base):
-    __tablename__ = 'channels'
-    id = Column(Integer, primary_key=True)
-    block_id = Column(Integer, ForeignKey('theme_blocks.id', ondelete='CASCADE'))
-    username = Column(String, nullable=False)
-    added_at = Column(DateTime, default=datetime.utcnow)
-    block = relationship('ThemeBlock', back_populates='channels')
-    __table_args__ = (UniqueConstraint('block_id', 'username', name='_block_channel_uc'),)
-
-class Message(Base):
-    __tablename__ = 'messages'
-    id = Column(Integer, primary_key=True)
-    channel_id = Column(Integer, ForeignKey('channels.id'), nullable=False)
-    original_message_id = Column(Integer, nullable=False)
-    content = Column(Text)
-    timestamp = Column(DateTime)
-    status = Column(String, default='new')
-
-class BotConfig(Base):
-    __tablename__ = 'bot_config'
-    key = Column(String, primary_key=True)
-    value = Column(String, nullable=False)
-
-class RewriteTask(Base):
-    __tablename__ = 'rewrite_tasks'
-    id = Column(Integer, primary_key=True)
-    message_id = Column(Integer, ForeignKey('messages.id'), nullable=False)
-    style = Column(String, nullable=False)
-    result = Column(Text, nullable=False)
-    status = Column(String, default='pending')
-    created_at = Column(DateTime, default=datetime.utcnow)
-
-class ModerationTask(Base):
-    __tablename__ = 'moderation_tasks'
-    id = Column(Integer, primary_key=True)
-    rewrite_id = Column(Integer, ForeignKey('rewrite_tasks.id'), nullable=False)
-    user_text = Column(Text, nullable=False)
-    media = Column(Text)  # JSON or Telegram file_id
-    status = Column(String, default='pending')
-    created_at = Column(DateTime, default=datetime.utcnow)
-
-class PublicationSchedule(Base):
-    __tablename__ = 'publication_schedule'
-    id = Column(Integer, primary_key=True)
-    moderation_task_id = Column(Integer, ForeignKey('moderation_tasks.id'), nullable=False)
-    scheduled_time = Column(DateTime, nullable=False)
-    status = Column(String, default='scheduled')
-    created_at = Column(DateTime, default=datetime.utcnow)
-
-# Async engine & session
-engine = create_async_engine(DATABASE_URL, echo=False, future=True)
-AsyncSessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
-
-async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+from datetime import datetime
+from sqlalchemy import (
+    Column, Integer, BigInteger, Float, String, DateTime, ForeignKey, Text, LargeBinary, UniqueConstraint, Index,
+    insert
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from config import DATABASE_URL
+from metrics import instrument_engine
+import context
+
+Base = declarative_base()
+
+class ThemeBlock(Base):
+    __tablename__ = 'theme_blocks'
+    id = Column(Integer, primary_key=True)
+    title = Column(String, nullable=False, unique=True)
+    keywords = Column(Text)  # free text describing the block's topic
+    profile = Column(Text)  # JSON keyword -> weight built from keywords, see scoring.py
+    created_at = Column(DateTime, default=datetime.utcnow)
+    channels = relationship('Channel', back_populates='block', cascade='all, delete')
+
+class Channel(Base):
+    __tablename__ = 'channels'
+    id = Column(Integer, primary_key=True)
+    block_id = Column(Integer, ForeignKey('theme_blocks.id', ondelete='CASCADE'))
+    username = Column(String, nullable=False)
+    added_at = Column(DateTime, default=datetime.utcnow)
+    last_message_id = Column(Integer)  # ingestion high-water mark
+    block = relationship('ThemeBlock', back_populates='channels')
+    __table_args__ = (UniqueConstraint('block_id', 'username', name='_block_channel_uc'),)
+
+class Message(Base):
+    __tablename__ = 'messages'
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(Integer, ForeignKey('channels.id'), nullable=False)
+    original_message_id = Column(Integer, nullable=False)
+    content = Column(Text)
+    timestamp = Column(DateTime)
+    status = Column(String, default='new')
+    media = Column(Text)  # JSON list of typed media, see media.py
+    score = Column(Float, default=0)  # relevance to the block profile, 0..1
+    __table_args__ = (
+        Index('uq_messages_channel_original', 'channel_id', 'original_message_id', unique=True),
+        Index('ix_messages_channel_status', 'channel_id', 'status'),
+        Index('ix_messages_status_timestamp', 'status', 'timestamp'),
+        Index('ix_messages_status_score', 'status', 'score', 'id'),
+    )
+
+class MessageFingerprint(Base):
+    __tablename__ = 'message_fingerprints'
+    message_id = Column(Integer, ForeignKey('messages.id', ondelete='CASCADE'), primary_key=True)
+    block_id = Column(Integer, nullable=False)
+    signature = Column(LargeBinary, nullable=False)  # packed MinHash signature
+    cluster_id = Column(Integer, nullable=False)  # message id of the cluster representative
+
+class FingerprintBand(Base):
+    __tablename__ = 'fingerprint_bands'
+    block_id = Column(Integer, primary_key=True)
+    band_key = Column(BigInteger, primary_key=True)  # hash of one LSH band of the signature
+    message_id = Column(Integer, ForeignKey('messages.id', ondelete='CASCADE'), primary_key=True)
+    __table_args__ = (Index('ix_fingerprint_bands_message', 'message_id'),)
+
+class BotConfig(Base):
+    __tablename__ = 'bot_config'
+    key = Column(String, primary_key=True)
+    value = Column(String, nullable=False)
+
+class RewriteTask(Base):
+    __tablename__ = 'rewrite_tasks'
+    id = Column(Integer, primary_key=True)
+    message_id = Column(Integer, ForeignKey('messages.id'), nullable=False)
+    style = Column(String, nullable=False)
+    result = Column(Text)  # filled once the task is done
+    status = Column(String, default='pending')  # pending -> running -> done/failed
+    attempts = Column(Integer, default=0)
+    error = Column(Text)
+    claimed_by = Column(String)  # token of the rewrite pool working on it
+    claimed_at = Column(DateTime)  # renewed while that pool is alive
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    __table_args__ = (
+        Index('ix_rewrite_tasks_status', 'status', 'id'),
+        Index('ix_rewrite_tasks_message', 'message_id'),
+    )
+
+class RewriteCache(Base):
+    __tablename__ = 'rewrite_cache'
+    key = Column(String(64), primary_key=True)  # sha256 of style + normalized text
+    style = Column(String, nullable=False)
+    result = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (Index('ix_rewrite_cache_created_at', 'created_at'),)
+
+class ModerationTask(Base):
+    __tablename__ = 'moderation_tasks'
+    id = Column(Integer, primary_key=True)
+    rewrite_id = Column(Integer, ForeignKey('rewrite_tasks.id'), nullable=False)
+    user_text = Column(Text, nullable=False)
+    media = Column(Text)  # JSON list of typed media; older rows hold a bare photo file_id
+    status = Column(String, default='pending')
+    created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (Index('ix_moderation_tasks_rewrite_status', 'rewrite_id', 'status'),)
+
+class PublicationSchedule(Base):
+    __tablename__ = 'publication_schedule'
+    id = Column(Integer, primary_key=True)
+    moderation_task_id = Column(Integer, ForeignKey('moderation_tasks.id'), nullable=False)
+    target_chat = Column(String)  # channel the post was planned for
+    slot = Column(BigInteger)  # planner slot start, epoch seconds
+    scheduled_time = Column(DateTime, nullable=False)
+    status = Column(String, default='scheduled')  # scheduled -> publishing -> published/failed
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text)
+    claimed_by = Column(String)  # token of the publisher run holding the row
+    claimed_at = Column(DateTime)
+    published_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index('ix_publication_schedule_status_time', 'status', 'scheduled_time'),
+        Index('uq_publication_schedule_slot', 'target_chat', 'slot', unique=True),
+    )
+
+class FsmState(Base):
+    __tablename__ = 'fsm_states'
+    key = Column(String, primary_key=True)  # bot_id:chat_id:user_id:destiny
+    state = Column(String)
+    data = Column(Text)  # JSON
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class AlbumPart(Base):
+    __tablename__ = 'album_parts'
+    group_key = Column(String, primary_key=True)  # chat_id:media_group_id
+    message_id = Column(BigInteger, primary_key=True)
+    item = Column(Text, nullable=False)  # JSON media item, see media.py
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ArchivedMessage(Base):
+    __tablename__ = 'archived_messages'
+    id = Column(Integer, primary_key=True)  # the id it had in messages
+    channel_id = Column(Integer, nullable=False)
+    original_message_id = Column(Integer, nullable=False)
+    status = Column(String)
+    timestamp = Column(DateTime)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+    payload = Column(LargeBinary, nullable=False)  # zlib JSON of the message and its pipeline rows, see retention.py
+
+# Async engine & session, created on first use: importing models has no side effects
+_engine = None
+_sessionmaker = None
+
+def get_engine():
+    global _engine, _sessionmaker
+    if _engine is None:
+        _engine = create_async_engine(DATABASE_URL, echo=False, future=True)
+        _sessionmaker = sessionmaker(bind=_engine, class_=AsyncSession, expire_on_commit=False)
+        instrument_engine(_engine.sync_engine)
+        context.on_shutdown(dispose_engine)
+    return _engine
+
+async def dispose_engine():
+    global _engine, _sessionmaker
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = _sessionmaker = None
+
+def AsyncSessionLocal(**kwargs) -> AsyncSession:
+    get_engine()
+    return _sessionmaker(**kwargs)
+
+async def init_db():
+    from migrations import upgrade
+    async with get_engine().begin() as conn:
+        await conn.run_sync(upgrade)
+
+# INSERT that silently skips rows violating a unique constraint
+def insert_ignore(table):
+    dialect = get_engine().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    return insert(table).prefix_with('IGNORE')
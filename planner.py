@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import math
+from bisect import bisect_left
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from config import PLAN_POSTS_PER_HOUR, PLAN_QUIET_HOURS, PLAN_TZ_OFFSET, PLAN_LEAD
+from models import AsyncSessionLocal, PublicationSchedule
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+PLAN_RETRIES = 3
+
+
+class PlanError(ValueError):
+    pass
+
+
+# Posting plan of one target channel: slots every 3600 / posts_per_hour seconds,
+# none of them starting inside the quiet hours (local time, tz_offset from UTC).
+# A slot is identified by its start in epoch seconds, so changing the rate
+# doesn't reinterpret slots that are already taken.
+@dataclass
+class SlotPlan:
+    posts_per_hour: float = PLAN_POSTS_PER_HOUR
+    quiet: Optional[tuple] = None  # (start_hour, end_hour)
+    tz_offset: float = PLAN_TZ_OFFSET
+
+    @property
+    def step(self) -> int:
+        return max(int(3600 / self.posts_per_hour), 1)
+
+    def first_slot(self, after: datetime) -> int:
+        return math.ceil((after - EPOCH).total_seconds() / self.step) * self.step
+
+    @staticmethod
+    def time_of(slot: int) -> datetime:
+        return EPOCH + timedelta(seconds=slot)
+
+    def is_quiet(self, slot: int) -> bool:
+        if not self.quiet:
+            return False
+        start, end = self.quiet
+        hour = (self.time_of(slot) + timedelta(hours=self.tz_offset)).hour
+        return start <= hour < end if start < end else hour >= start or hour < end
+
+    def has_open_slots(self) -> bool:
+        # Slot hours repeat after 86400 / gcd(step, 86400) slots
+        period = 86400 // math.gcd(self.step, 86400)
+        return any(not self.is_quiet(i * self.step) for i in range(period))
+
+    @classmethod
+    def parse(cls, value: str) -> 'SlotPlan':
+        # "4" or "4;23-8": posts per hour and optional quiet hours
+        rate, _, quiet = value.partition(';')
+        posts_per_hour = float(rate)
+        if posts_per_hour <= 0:
+            raise ValueError("posts per hour must be positive")
+        return cls(posts_per_hour, parse_quiet(quiet))
+
+    def dump(self) -> str:
+        quiet = f";{self.quiet[0]}-{self.quiet[1]}" if self.quiet else ''
+        return f"{self.posts_per_hour:g}{quiet}"
+
+def parse_quiet(value: str) -> Optional[tuple]:
+    if not value.strip():
+        return None
+    start, end = (int(h) for h in value.split('-'))
+    if not (0 <= start < 24 and 0 <= end < 24) or start == end:
+        raise ValueError("quiet hours must look like 23-8")
+    return start, end
+
+DEFAULT_PLAN = SlotPlan(PLAN_POSTS_PER_HOUR, parse_quiet(PLAN_QUIET_HOURS))
+
+def local(when: datetime) -> datetime:
+    return when + timedelta(hours=PLAN_TZ_OFFSET)
+
+def plan_key(target: str) -> str:
+    return f"PLAN:{target}"
+
+def load_plan(target: str) -> SlotPlan:
+    value = settings.get(plan_key(target))
+    return SlotPlan.parse(value) if value else DEFAULT_PLAN
+
+
+async def free_slots(session, target: str, plan: SlotPlan, count: int, after: datetime) -> List[int]:
+    # Walk the slot grid window by window; each window is one range scan of the
+    # (target_chat, slot) unique index instead of a scan of the schedule. A slot
+    # is free when no post is within one step of it, which also keeps the spacing
+    # when the rate changed since earlier posts were planned.
+    if not plan.has_open_slots():
+        # The walk below would never end
+        raise PlanError(f"every slot of the plan for {target} falls in the quiet hours")
+    ps = PublicationSchedule.__table__
+    step = plan.step
+    cursor = plan.first_slot(after)
+    found = []
+    while len(found) < count:
+        end = cursor + step * max(2 * (count - len(found)), 32)
+        res = await session.execute(
+            select(ps.c.slot)
+            .where(ps.c.target_chat == target, ps.c.slot > cursor - step, ps.c.slot < end + step)
+            .order_by(ps.c.slot)
+        )
+        taken = res.scalars().all()
+        for slot in range(cursor, end, step):
+            if plan.is_quiet(slot):
+                continue
+            i = bisect_left(taken, slot - step + 1)
+            if i < len(taken) and taken[i] < slot + step:
+                continue
+            found.append(slot)
+            taken.insert(i, slot)
+            if len(found) == count:
+                break
+        cursor = end
+    return found
+
+
+# Assignment runs under a lock so this process never hands out a slot twice;
+# the unique index catches another process taking it, and the plan is redone.
+_lock = asyncio.Lock()
+
+async def schedule(target: str, prepare) -> List[datetime]:
+    # prepare(session) approves moderation tasks in the session and returns their ids
+    for attempt in range(PLAN_RETRIES):
+        async with _lock, AsyncSessionLocal() as session:
+            task_ids = await prepare(session)
+            if not task_ids:
+                return []
+            plan = load_plan(target)
+            slots = await free_slots(session, target, plan, len(task_ids),
+                                     datetime.utcnow() + timedelta(seconds=PLAN_LEAD))
+            session.add_all([
+                PublicationSchedule(moderation_task_id=tid, target_chat=target, slot=slot,
+                                    scheduled_time=plan.time_of(slot))
+                for tid, slot in zip(task_ids, slots)
+            ])
+            try:
+                await session.commit()
+            except IntegrityError:
+                if attempt + 1 == PLAN_RETRIES:
+                    raise
+                logger.info("Slot taken concurrently for %s, planning again", target)
+                continue
+            return [plan.time_of(slot) for slot in slots]
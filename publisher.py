@@ -1,10 +1,327 @@
-from aiogram import Bot
-from config import BOT_TOKEN
-
-bot = Bot(token=BOT_TOKEN, parse_mode='HTML')
-
-async def publish_message(chat_id: int, text: str, medias: list = None):
-    if medias:
-        await bot.send_media_group(chat_id, medias)
-    if text:
-        await bot.send_message(chat_id, text)
\ No newline at end of file
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
+from sqlalchemy import select, update, and_, or_
+
+from config import (
+    BOT_TOKEN, TELEGRAM_API_URL,
+    PUBLISH_GLOBAL_RATE, PUBLISH_CHAT_RATE, PUBLISH_CHAT_BURST,
+    PUBLISH_WORKERS, PUBLISH_MAX_RETRIES,
+    PUBLISH_BATCH_SIZE, PUBLISH_MAX_ATTEMPTS, PUBLISH_RETRY_DELAY, PUBLISH_CLAIM_TIMEOUT
+)
+from models import AsyncSessionLocal, ModerationTask, PublicationSchedule
+from media import load_media, input_media
+from settings import settings
+import context
+import metrics
+from metrics import telegram_seconds, publish_seconds, publish_retry_after
+
+logger = logging.getLogger(__name__)
+
+CAPTION_LIMIT = 1024
+MEDIA_GROUP_LIMIT = 10
+
+# Lower value goes out first
+PRIORITY_URGENT = 0
+PRIORITY_SCHEDULED = 10
+
+
+# Bot API session middleware: one observation per API call, by method
+class BotApiMetrics(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            response = await make_request(bot, method)
+            status = 'ok'
+            return response
+        except TelegramRetryAfter:
+            status = 'retry_after'
+            raise
+        finally:
+            telegram_seconds.observe(time.perf_counter() - start, type(method).__name__, status)
+
+
+def make_bot(**kwargs) -> Bot:
+    # TELEGRAM_API_URL points the bot at a local Bot API server or a test stub
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    else:
+        session = AiohttpSession()
+    session.middleware(BotApiMetrics())
+    return Bot(token=BOT_TOKEN, session=session, **kwargs)
+
+# One Bot and HTTP session per process, shared by the dispatcher and the
+# publisher. It has no default parse_mode: handler replies go out as plain
+# text, published posts ask for HTML explicitly.
+_bot = None
+
+def get_bot() -> Bot:
+    global _bot
+    if _bot is None:
+        _bot = make_bot()
+        context.on_shutdown(close_bot)
+    return _bot
+
+async def close_bot():
+    global _bot
+    if _bot is not None:
+        await _bot.session.close()
+        _bot = None
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, cost: float = 1) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        cost = min(cost, self.burst)
+        wait = max(self.blocked_until - now, 0)
+        if self.tokens < cost:
+            wait = max(wait, (cost - self.tokens) / self.rate)
+        return wait
+
+    def take(self, cost: float = 1):
+        self.tokens -= min(cost, self.burst)
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+# Outbound queue: every post is a job of one or more API calls sent in order under
+# per-chat and global token buckets; a RetryAfter pauses the chat and retries.
+class SendQueue:
+    def __init__(self, bot: Bot = None, global_rate=PUBLISH_GLOBAL_RATE, chat_rate=PUBLISH_CHAT_RATE,
+                 chat_burst=PUBLISH_CHAT_BURST, workers=PUBLISH_WORKERS, max_retries=PUBLISH_MAX_RETRIES):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, max(global_rate, 1))
+        self._chats = {}
+        self._chat_locks = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._ready = None
+        self._tasks = []
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def start(self):
+        self._ready = asyncio.Semaphore(0)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        context.on_shutdown(self.stop)
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for _, _, job in self._heap:
+            if not job[2].done():
+                job[2].cancel()
+        self._heap = []
+
+    async def submit(self, chat_id, calls: list, priority: int = PRIORITY_SCHEDULED):
+        # calls: [(cost, factory)], factory() returns the API coroutine
+        if not self._tasks:
+            self.start()
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), (chat_id, calls, fut)))
+        self._ready.release()
+        start = time.perf_counter()
+        try:
+            return await fut
+        finally:
+            publish_seconds.observe(time.perf_counter() - start, priority)
+
+    async def _acquire(self, chat_id, cost: float):
+        bucket = self._bucket(chat_id)
+        while True:
+            wait = max(bucket.delay(cost), self._global.delay(cost))
+            if wait <= 0:
+                bucket.take(cost)
+                self._global.take(cost)
+                return
+            await asyncio.sleep(wait)
+
+    async def _call(self, chat_id, cost, factory):
+        retries = 0
+        while True:
+            await self._acquire(chat_id, cost)
+            try:
+                return await factory()
+            except TelegramRetryAfter as e:
+                retries += 1
+                publish_retry_after.inc()
+                if retries > self.max_retries:
+                    raise
+                logger.warning("Flood control on %s, retrying in %ss", chat_id, e.retry_after)
+                self._bucket(chat_id).block(e.retry_after)
+
+    async def _work(self):
+        while True:
+            await self._ready.acquire()
+            _, _, (chat_id, calls, fut) = heapq.heappop(self._heap)
+            if fut.done():
+                continue
+            # Posts to one chat keep their order even with several workers
+            lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+            async with lock:
+                try:
+                    results = [await self._call(chat_id, cost, factory) for cost, factory in calls]
+                except Exception as e:
+                    if not fut.done():
+                        fut.set_exception(e)
+                else:
+                    if not fut.done():
+                        fut.set_result(results)
+
+outbox = SendQueue()
+
+
+_SINGLE_SEND = {
+    'photo': ('send_photo', 'photo'),
+    'video': ('send_video', 'video'),
+    'document': ('send_document', 'document'),
+    'audio': ('send_audio', 'audio'),
+}
+
+def _albums(medias: list) -> list:
+    # Photos and videos share an album; documents and audio only group with their own type
+    groups = []
+    for m in medias:
+        kind = 'visual' if m.type in ('photo', 'video') else m.type
+        if groups and groups[-1][0] == kind and len(groups[-1][1]) < MEDIA_GROUP_LIMIT:
+            groups[-1][1].append(m)
+        else:
+            groups.append((kind, [m]))
+    return [group for _, group in groups]
+
+def build_calls(chat_id, text: str, medias: list, bot: Bot = None) -> list:
+    bot = bot or get_bot()
+    calls = []
+    medias = list(medias or [])
+    # The text rides along as the caption of the first media whenever it fits
+    caption = text if medias and text and len(text) <= CAPTION_LIMIT else None
+    for i, group in enumerate(_albums(medias)):
+        if i == 0 and caption:
+            group[0] = group[0].copy(update={'caption': caption, 'parse_mode': 'HTML'})
+        if len(group) == 1:
+            method, field = _SINGLE_SEND[group[0].type]
+            kwargs = {field: group[0].media, 'caption': group[0].caption, 'parse_mode': 'HTML'}
+            calls.append((1, lambda m=method, kw=kwargs: getattr(bot, m)(chat_id, **kw)))
+        else:
+            calls.append((len(group), lambda g=group: bot.send_media_group(chat_id, g)))
+    if text and not caption:
+        calls.append((1, lambda: bot.send_message(chat_id, text, parse_mode='HTML')))
+    return calls
+
+async def publish_message(chat_id: int, text: str, medias: list = None, priority: int = PRIORITY_SCHEDULED):
+    calls = build_calls(chat_id, text, medias)
+    if not calls:
+        return []
+    return await outbox.submit(chat_id, calls, priority)
+
+
+# Scheduled publishing job
+def _due_rows(now: datetime):
+    ps = PublicationSchedule.__table__
+    stale = now - timedelta(seconds=PUBLISH_CLAIM_TIMEOUT)
+    return or_(
+        and_(ps.c.status == 'scheduled', ps.c.scheduled_time <= now),
+        and_(ps.c.status == 'publishing', ps.c.claimed_at < stale)  # publisher died mid-run
+    )
+
+async def claim_scheduled(limit: int = PUBLISH_BATCH_SIZE, untargeted: bool = True) -> list:
+    # untargeted=False leaves rows without their own target_chat where they are
+    ps, mt = PublicationSchedule.__table__, ModerationTask.__table__
+    token = uuid.uuid4().hex
+    now = datetime.utcnow()
+    due = _due_rows(now) if untargeted else and_(_due_rows(now), ps.c.target_chat.isnot(None))
+    async with AsyncSessionLocal() as session:
+        # SKIP LOCKED lets concurrent publishers take disjoint rows on Postgres; SQLite
+        # ignores it but serializes writers, and the guarded UPDATE below only takes
+        # rows that are still due, so a row is claimed by one token at most.
+        res = await session.execute(
+            select(ps.c.id).where(due)
+            .order_by(ps.c.scheduled_time).limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        ids = res.scalars().all()
+        if not ids:
+            return []
+        await session.execute(
+            update(ps).where(ps.c.id.in_(ids), due)
+            .values(status='publishing', claimed_by=token, claimed_at=now)
+        )
+        await session.commit()
+        res = await session.execute(
+            select(ps.c.id, ps.c.attempts, ps.c.target_chat, mt.c.user_text, mt.c.media)
+            .join(mt, mt.c.id == ps.c.moderation_task_id)
+            .where(ps.c.claimed_by == token, ps.c.status == 'publishing')
+            .order_by(ps.c.scheduled_time)
+        )
+        return res.all()
+
+async def _finish_publication(sid: int, attempts: int, error: Exception = None):
+    # Returns the retry time when the row goes back to 'scheduled'
+    ps = PublicationSchedule.__table__
+    now = datetime.utcnow()
+    retry_at = None
+    if error is None:
+        values = dict(status='published', published_at=now, attempts=attempts + 1, last_error=None)
+    elif attempts + 1 < PUBLISH_MAX_ATTEMPTS:
+        retry_at = now + timedelta(seconds=PUBLISH_RETRY_DELAY * 2 ** attempts)
+        values = dict(status='scheduled', scheduled_time=retry_at, attempts=attempts + 1, last_error=repr(error))
+    else:
+        values = dict(status='failed', attempts=attempts + 1, last_error=repr(error))
+    async with AsyncSessionLocal() as session:
+        await session.execute(update(ps).where(ps.c.id == sid).values(claimed_by=None, **values))
+        await session.commit()
+    return retry_at
+
+@metrics.tracked('job:publish_scheduled')
+async def publish_scheduled() -> list:
+    # Returns the times of the retries it scheduled, for the deadline timer
+    target = settings.target_chat
+    if not target:
+        logger.warning("TARGET_CHAT_ID is not set, posts without their own channel are waiting")
+    retries = []
+    while True:
+        rows = await claim_scheduled(untargeted=bool(target))
+        for row in rows:
+            try:
+                medias = input_media(load_media(row.media))
+                await publish_message(row.target_chat or target, row.user_text, medias)
+            except Exception as e:
+                logger.exception("Publication %s failed", row.id)
+                retry_at = await _finish_publication(row.id, row.attempts or 0, e)
+                if retry_at is not None:
+                    retries.append(retry_at)
+            else:
+                await _finish_publication(row.id, row.attempts or 0)
+        if len(rows) < PUBLISH_BATCH_SIZE:
+            return retries
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import logging
+import zlib
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict
+
+from sqlalchemy import select, update, delete, exists
+
+from config import RETENTION_POLICY, RETENTION_INTERVAL, RETENTION_BATCH_SIZE, REWRITE_CACHE_DB_TTL
+from models import (
+    AsyncSessionLocal, Message as MsgModel, RewriteTask, ModerationTask, PublicationSchedule,
+    MessageFingerprint, FingerprintBand, ArchivedMessage, RewriteCache, insert_ignore
+)
+import metrics
+
+logger = logging.getLogger(__name__)
+
+m = MsgModel.__table__
+rt = RewriteTask.__table__
+mt = ModerationTask.__table__
+ps = PublicationSchedule.__table__
+rc = RewriteCache.__table__
+ACTIVE_PUBLICATION = ('scheduled', 'publishing')
+
+
+# "duplicate=7,published=30": days a message of that status stays in the hot
+# tables. Ages count from the post date, for "published" from the publication.
+# "failed" is for failed rewrite tasks; 0 keeps rows forever.
+def parse_policy(value: str) -> Dict[str, int]:
+    policy = {}
+    for part in value.split(','):
+        if part.strip():
+            status, _, days = part.partition('=')
+            policy[status.strip()] = int(days)
+    return policy
+
+POLICY = parse_policy(RETENTION_POLICY)
+
+
+@dataclass
+class RetentionReport:
+    rows: Dict[str, int] = field(default_factory=dict)  # table -> rows archived or deleted
+    raw_bytes: int = 0  # JSON size of the archived rows
+    archived_bytes: int = 0  # what they take compressed in archived_messages
+
+    def add(self, table: str, count: int):
+        if count:
+            self.rows[table] = self.rows.get(table, 0) + count
+
+    @property
+    def reclaimed(self) -> int:
+        return self.raw_bytes - self.archived_bytes
+
+
+def _row(row) -> dict:
+    return {k: v.isoformat() if isinstance(v, datetime) else v for k, v in row._mapping.items()}
+
+def _published(*where):
+    # ids of messages with a publication matching where
+    return (
+        select(rt.c.message_id)
+        .join(mt, mt.c.rewrite_id == rt.c.id)
+        .join(ps, ps.c.moderation_task_id == mt.c.id)
+        .where(*where)
+    )
+
+def _cold(status: str, cutoff: datetime):
+    if status == 'published':
+        q = select(m.c.id).where(m.c.id.in_(_published(ps.c.status == 'published', ps.c.published_at < cutoff)))
+    else:
+        q = select(m.c.id).where(m.c.status == status, m.c.timestamp < cutoff)
+    # Never anything that is still waiting to go out
+    return q.where(~m.c.id.in_(_published(ps.c.status.in_(ACTIVE_PUBLICATION)))).order_by(m.c.id)
+
+
+# Each batch is one short transaction over at most RETENTION_BATCH_SIZE ids,
+# so ingestion and moderation writes get in between batches.
+async def _in_batches(query, handle):
+    while True:
+        async with AsyncSessionLocal() as session:
+            ids = (await session.execute(query.limit(RETENTION_BATCH_SIZE))).scalars().all()
+            if ids:
+                await handle(session, ids)
+                await session.commit()
+        if len(ids) < RETENTION_BATCH_SIZE:
+            return
+        await asyncio.sleep(0)
+
+async def _delete(session, report: RetentionReport, table, *where):
+    res = await session.execute(delete(table).where(*where))
+    report.add(table.name, res.rowcount)
+
+
+# A message moves to archived_messages as one compressed JSON document together
+# with its rewrites, moderation tasks and publications, then leaves the hot tables.
+async def _archive(session, ids: list, status: str, report: RetentionReport):
+    messages = (await session.execute(select(m).where(m.c.id.in_(ids)))).all()
+    rewrites = (await session.execute(select(rt).where(rt.c.message_id.in_(ids)))).all()
+    message_of = {r.id: r.message_id for r in rewrites}
+    moderations = []
+    if message_of:
+        moderations = (await session.execute(select(mt).where(mt.c.rewrite_id.in_(list(message_of))))).all()
+    rewrite_of = {r.id: r.rewrite_id for r in moderations}
+    publications = []
+    if rewrite_of:
+        publications = (await session.execute(
+            select(ps).where(ps.c.moderation_task_id.in_(list(rewrite_of)))
+        )).all()
+
+    docs = {r.id: {'message': _row(r), 'rewrites': [], 'moderation': [], 'publications': []} for r in messages}
+    for r in rewrites:
+        docs[r.message_id]['rewrites'].append(_row(r))
+    for r in moderations:
+        docs[message_of[r.rewrite_id]]['moderation'].append(_row(r))
+    for r in publications:
+        docs[message_of[rewrite_of[r.moderation_task_id]]]['publications'].append(_row(r))
+
+    now = datetime.utcnow()
+    archive = []
+    for r in messages:
+        raw = json.dumps(docs[r.id], ensure_ascii=False).encode('utf-8')
+        payload = zlib.compress(raw)
+        report.raw_bytes += len(raw)
+        report.archived_bytes += len(payload)
+        archive.append({'id': r.id, 'channel_id': r.channel_id, 'original_message_id': r.original_message_id,
+                        'status': status, 'timestamp': r.timestamp, 'archived_at': now, 'payload': payload})
+    await session.execute(insert_ignore(ArchivedMessage.__table__), archive)
+    report.add('archived_messages', len(archive))
+
+    # Children first: the foreign keys point up the chain
+    if publications:
+        await _delete(session, report, ps, ps.c.id.in_([r.id for r in publications]))
+    if moderations:
+        await _delete(session, report, mt, mt.c.id.in_(list(rewrite_of)))
+    if rewrites:
+        await _delete(session, report, rt, rt.c.id.in_(list(message_of)))
+    await _delete(session, report, FingerprintBand.__table__, FingerprintBand.message_id.in_(ids))
+    await _delete(session, report, MessageFingerprint.__table__, MessageFingerprint.message_id.in_(ids))
+    await _delete(session, report, m, m.c.id.in_(ids))
+
+def unpack(payload: bytes) -> dict:
+    return json.loads(zlib.decompress(payload))
+
+
+@metrics.tracked('job:retention')
+async def run_retention(policy: Dict[str, int] = None) -> RetentionReport:
+    policy = POLICY if policy is None else policy
+    now = datetime.utcnow()
+    report = RetentionReport()
+
+    # Leftovers of deleted rewrites first, so the messages they release can age out below
+    async def drop_moderation(session, ids):
+        await _delete(session, report, ps, ps.c.moderation_task_id.in_(ids))
+        await _delete(session, report, mt, mt.c.id.in_(ids))
+    await _in_batches(
+        select(mt.c.id)
+        .where(~exists().where(rt.c.id == mt.c.rewrite_id),
+               ~exists().where(ps.c.moderation_task_id == mt.c.id, ps.c.status.in_(ACTIVE_PUBLICATION)))
+        .order_by(mt.c.id),
+        drop_moderation
+    )
+
+    async def reject(session, ids):
+        res = await session.execute(update(m).where(m.c.id.in_(ids)).values(status='rejected'))
+        report.add('messages_rejected', res.rowcount)
+    await _in_batches(
+        select(m.c.id)
+        .where(m.c.status == 'funnel', ~exists().where(rt.c.message_id == m.c.id, rt.c.status == 'done'))
+        .order_by(m.c.id),
+        reject
+    )
+
+    if policy.get('failed', 0) > 0:
+        async def drop_failed(session, ids):
+            await _delete(session, report, rt, rt.c.id.in_(ids))
+        cutoff = now - timedelta(days=policy['failed'])
+        await _in_batches(
+            select(rt.c.id).where(rt.c.status == 'failed', rt.c.updated_at < cutoff).order_by(rt.c.id),
+            drop_failed
+        )
+
+    # Stored rewrites past REWRITE_CACHE_DB_TTL are no longer served, see deepseek.RewriteCache
+    if REWRITE_CACHE_DB_TTL > 0:
+        async def drop_cached(session, keys):
+            await _delete(session, report, rc, rc.c.key.in_(keys))
+        cutoff = now - timedelta(seconds=REWRITE_CACHE_DB_TTL)
+        await _in_batches(
+            select(rc.c.key).where(rc.c.created_at < cutoff).order_by(rc.c.created_at),
+            drop_cached
+        )
+
+    for status, days in policy.items():
+        if status == 'failed' or days <= 0:
+            continue
+        await _in_batches(
+            _cold(status, now - timedelta(days=days)),
+            lambda session, ids, status=status: _archive(session, ids, status, report)
+        )
+
+    for table, count in report.rows.items():
+        metrics.retention_rows.inc(count, table)
+    metrics.retention_bytes.inc(report.raw_bytes, 'raw')
+    metrics.retention_bytes.inc(report.archived_bytes, 'archived')
+    logger.info("Retention: %s, %d bytes moved out as %d compressed",
+                report.rows or 'nothing to do', report.raw_bytes, report.archived_bytes)
+    return report
+
+
+class RetentionTimer:
+    def __init__(self, interval: int = RETENTION_INTERVAL):
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        # The first run waits a full interval, so restarts don't pile up runs
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await run_retention()
+            except Exception:
+                logger.exception("Retention run failed")
@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, update, bindparam, or_
+
+from config import (
+    REWRITE_CONCURRENCY, REWRITE_BATCH_SIZE, REWRITE_MAX_ATTEMPTS,
+    REWRITE_BACKOFF_BASE, REWRITE_POLL_INTERVAL, REWRITE_CLAIM_TIMEOUT
+)
+from models import AsyncSessionLocal, Channel, Message as MsgModel, RewriteTask
+from deepseek import rewrite_text, CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+
+# Queueing: every 'new' message of a block becomes a pending RewriteTask
+async def enqueue_block(block_id: int, style: str) -> int:
+    async with AsyncSessionLocal() as session:
+        res = await session.execute(
+            select(MsgModel.id)
+            .join(Channel, Channel.id == MsgModel.channel_id)
+            .where(Channel.block_id == block_id, MsgModel.status == 'new')
+        )
+        ids = res.scalars().all()
+        for i in range(0, len(ids), REWRITE_BATCH_SIZE):
+            chunk = ids[i:i + REWRITE_BATCH_SIZE]
+            await session.execute(
+                insert(RewriteTask.__table__),
+                [{'message_id': mid, 'style': style, 'status': 'pending', 'attempts': 0} for mid in chunk]
+            )
+            await session.execute(
+                update(MsgModel.__table__)
+                .where(MsgModel.__table__.c.id.in_(chunk))
+                .values(status='queued')
+            )
+        await session.commit()
+    return len(ids)
+
+
+# Several pools (bot.py and worker.py processes) share the queue. A pool claims
+# tasks under its own token and renews the claims while it lives; claims not
+# renewed for REWRITE_CLAIM_TIMEOUT belong to a dead pool and go back to pending.
+class RewritePool:
+    def __init__(self, concurrency=REWRITE_CONCURRENCY, batch_size=REWRITE_BATCH_SIZE,
+                 max_attempts=REWRITE_MAX_ATTEMPTS, backoff=REWRITE_BACKOFF_BASE, rewrite=None,
+                 claim_timeout=REWRITE_CLAIM_TIMEOUT):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.claim_timeout = claim_timeout
+        self.token = uuid.uuid4().hex
+        self._rewrite = rewrite or rewrite_text
+        self._queue = None
+        self._wake = None
+        self._results = []
+        self._flush_lock = None
+        self._tasks = []
+
+    def wake(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        await self._requeue(self._stale())
+        self._tasks = [asyncio.create_task(self._feed()), asyncio.create_task(self._keep_claims())]
+        self._tasks += [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self._flush()
+        # Whatever was claimed but not finished is free for the other pools right away
+        await self._requeue(RewriteTask.__table__.c.claimed_by == self.token)
+
+    def _stale(self):
+        rt = RewriteTask.__table__
+        cutoff = datetime.utcnow() - timedelta(seconds=self.claim_timeout)
+        return or_(rt.c.claimed_at < cutoff, rt.c.claimed_at.is_(None))  # no claim: left by an older version
+
+    async def _requeue(self, which):
+        rt = RewriteTask.__table__
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(
+                update(rt).where(rt.c.status == 'running', which)
+                .values(status='pending', claimed_by=None, claimed_at=None)
+            )
+            await session.commit()
+        if res.rowcount:
+            logger.info("Requeued %d claimed rewrite tasks", res.rowcount)
+
+    async def _keep_claims(self):
+        rt = RewriteTask.__table__
+        while True:
+            await asyncio.sleep(self.claim_timeout / 3)
+            try:
+                await self._flush()  # results a failed flush put back
+                async with AsyncSessionLocal() as session:
+                    await session.execute(
+                        update(rt).where(rt.c.status == 'running', rt.c.claimed_by == self.token)
+                        .values(claimed_at=datetime.utcnow())
+                    )
+                    await session.commit()
+                await self._requeue(self._stale())
+            except Exception:
+                logger.exception("Renewing rewrite claims failed")
+
+    async def _claim(self):
+        rt = RewriteTask.__table__
+        async with AsyncSessionLocal() as session:
+            # As in publisher.claim_scheduled: SKIP LOCKED on Postgres, and the guarded
+            # UPDATE only takes rows still pending, so a task gets one token at most
+            res = await session.execute(
+                select(rt.c.id).where(rt.c.status == 'pending')
+                .order_by(rt.c.id).limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            ids = res.scalars().all()
+            if not ids:
+                return []
+            await session.execute(
+                update(rt).where(rt.c.id.in_(ids), rt.c.status == 'pending')
+                .values(status='running', claimed_by=self.token, claimed_at=datetime.utcnow())
+            )
+            await session.commit()
+            res = await session.execute(
+                select(RewriteTask.id, RewriteTask.message_id, RewriteTask.style,
+                       RewriteTask.attempts, MsgModel.content)
+                .join(MsgModel, MsgModel.id == RewriteTask.message_id)
+                .where(rt.c.id.in_(ids), rt.c.claimed_by == self.token, rt.c.status == 'running')
+                .order_by(rt.c.id)
+            )
+            return res.all()
+
+    async def _feed(self):
+        while True:
+            rows = await self._claim()
+            if not rows:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), REWRITE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for row in rows:
+                await self._queue.put(row)
+
+    async def _work(self):
+        while True:
+            row = await self._queue.get()
+            try:
+                result = await self._process(row)
+                self._results.append(result)
+            finally:
+                self._queue.task_done()
+            if len(self._results) >= self.batch_size or self._queue.empty():
+                try:
+                    await self._flush()
+                except Exception:
+                    logger.exception("Failed to commit rewrite results")
+
+    async def _process(self, row):
+        attempt, error = row.attempts or 0, None
+        while attempt < self.max_attempts:
+            attempt += 1
+            try:
+                text = await self._rewrite(row.content or '', row.style)
+                return {'tid': row.id, 'mid': row.message_id, 'status': 'done',
+                        'result': text, 'error': None, 'attempts': attempt}
+            except CircuitOpenError as e:
+                # DeepSeek is down: wait for the breaker instead of burning attempts
+                attempt -= 1
+                await asyncio.sleep(e.retry_after * random.uniform(1, 1.5))
+            except Exception as e:
+                error = e
+                if attempt < self.max_attempts:
+                    delay = self.backoff * 2 ** (attempt - 1)
+                    await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+        logger.warning("Rewrite task %s failed after %s attempts: %r", row.id, attempt, error)
+        return {'tid': row.id, 'mid': row.message_id, 'status': 'failed',
+                'result': None, 'error': repr(error), 'attempts': attempt}
+
+    async def _flush(self):
+        async with self._flush_lock:
+            results, self._results = self._results, []
+            if not results:
+                return
+            try:
+                await self._store(results)
+            except BaseException:
+                # Keep them for the next flush; the claims stay ours until then
+                self._results[:0] = results
+                raise
+
+    async def _store(self, results: list):
+        rt, mt = RewriteTask.__table__, MsgModel.__table__
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                update(rt).where(rt.c.id == bindparam('tid'), rt.c.claimed_by == self.token).values(
+                    status=bindparam('r_status'), result=bindparam('r_result'),
+                    error=bindparam('r_error'), attempts=bindparam('r_attempts'),
+                    claimed_by=None, claimed_at=None, updated_at=datetime.utcnow()
+                ),
+                [{'tid': r['tid'], 'r_status': r['status'], 'r_result': r['result'],
+                  'r_error': r['error'], 'r_attempts': r['attempts']} for r in results]
+            )
+            # Done messages enter the moderation funnel, failed ones go back to 'new'
+            await session.execute(
+                update(mt).where(mt.c.id == bindparam('mid')).values(status=bindparam('msg_status')),
+                [{'mid': r['mid'], 'msg_status': 'funnel' if r['status'] == 'done' else 'new'}
+                 for r in results]
+            )
+            await session.commit()
+
+
+pool = RewritePool()
@@ -1,10 +1,97 @@
-import asyncio
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from config import AUTO_SCAN_INTERVAL
-from bot import publish_scheduled
-
-scheduler = AsyncIOScheduler()
-
-def start_scheduler():
-    scheduler.add_job(lambda: asyncio.create_task(publish_scheduled()), 'interval', seconds=AUTO_SCAN_INTERVAL, id='auto_publish')
-    scheduler.start()
\ No newline at end of file
+import asyncio
+import heapq
+import logging
+from datetime import datetime
+
+from sqlalchemy import select
+
+from config import SCHEDULER_RESYNC_INTERVAL, SCHEDULER_PRELOAD
+from models import AsyncSessionLocal, PublicationSchedule
+
+logger = logging.getLogger(__name__)
+
+
+# Deadline timer: sleeps until the earliest PublicationSchedule.scheduled_time,
+# is woken by notify() when a new row is planned in this process and re-reads
+# the table every SCHEDULER_RESYNC_INTERVAL for rows written elsewhere. The job
+# returns the retry times it scheduled.
+class DeadlineScheduler:
+    def __init__(self, job, resync_interval=SCHEDULER_RESYNC_INTERVAL, preload=SCHEDULER_PRELOAD):
+        self._job = job
+        self.resync_interval = resync_interval
+        self.preload = preload
+        self._heap = []
+        self._wake = None
+        self._task = None
+
+    def notify(self, when: datetime):
+        heapq.heappush(self._heap, when)
+        if self._wake is not None:
+            self._wake.set()
+
+    async def resync(self):
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(
+                select(PublicationSchedule.scheduled_time)
+                .where(PublicationSchedule.status == 'scheduled')
+                .order_by(PublicationSchedule.scheduled_time)
+                .limit(self.preload)
+            )
+            heap = list(res.scalars().all())
+        heapq.heapify(heap)
+        self._heap = heap
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_sync = 0
+        while True:
+            if loop.time() >= next_sync:
+                try:
+                    await self.resync()
+                except Exception:
+                    logger.exception("Schedule resync failed")
+                next_sync = loop.time() + self.resync_interval
+            now = datetime.utcnow()
+            if self._heap and self._heap[0] <= now:
+                while self._heap and self._heap[0] <= now:
+                    heapq.heappop(self._heap)
+                try:
+                    retries = await self._job()
+                except Exception:
+                    logger.exception("Scheduled publishing failed")
+                    retries = None
+                # Due rows the job left in place come back with the next regular resync
+                for when in retries or ():
+                    heapq.heappush(self._heap, when)
+                continue
+            timeout = next_sync - loop.time()
+            if self._heap:
+                timeout = min(timeout, (self._heap[0] - now).total_seconds())
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+
+
+scheduler = None
+
+def start_scheduler(job) -> DeadlineScheduler:
+    global scheduler
+    scheduler = DeadlineScheduler(job)
+    scheduler.start()
+    return scheduler
+
+def notify(when: datetime):
+    if scheduler is not None:
+        scheduler.notify(when)
@@ -0,0 +1,125 @@
+import json
+import logging
+import re
+from itertools import chain
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import select, update, bindparam
+
+from config import SCORE_STEM_LEN, SCORE_BATCH_SIZE, SCORE_IDF_SAMPLE
+from models import AsyncSessionLocal, ThemeBlock, Channel, Message as MsgModel
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+# Relevance of a message to its block: cosine similarity between the message's
+# sublinear term frequencies (1 + log tf) and the block profile, a keyword ->
+# idf weight map. Words are cut to SCORE_STEM_LEN characters, a crude stemmer
+# that folds most Russian inflections ("экономика", "экономики") together.
+def stems(text: Optional[str]) -> List[str]:
+    return [w[:SCORE_STEM_LEN] for w in _WORD_RE.findall((text or '').lower()) if len(w) > 2]
+
+def _term_counts(texts: list):
+    # One pass over the whole batch: (doc, term) pairs of the flattened token
+    # array, counted with np.unique instead of a Counter per message
+    docs = [stems(t) for t in texts]
+    lengths = np.fromiter(map(len, docs), dtype=np.int64, count=len(docs))
+    if not lengths.sum():
+        return None
+    vocab, terms = np.unique(np.array(list(chain.from_iterable(docs))), return_inverse=True)
+    doc_ids = np.repeat(np.arange(len(docs)), lengths)
+    keys, counts = np.unique(doc_ids * len(vocab) + terms.ravel(), return_counts=True)
+    return vocab, keys // len(vocab), keys % len(vocab), counts
+
+def _lookup(vocab: np.ndarray, words: list) -> tuple:
+    # positions of words in the sorted vocab, and which of them are present
+    words = np.array(words)
+    pos = np.minimum(np.searchsorted(vocab, words), len(vocab) - 1)
+    return pos, vocab[pos] == words
+
+def score_texts(profile: Dict[str, float], texts: list) -> np.ndarray:
+    scores = np.zeros(len(texts))
+    if not profile or not texts:
+        return scores
+    counted = _term_counts(texts)
+    if counted is None:
+        return scores
+    vocab, doc_of, term_of, counts = counted
+    weights = 1.0 + np.log(counts)
+    norms = np.sqrt(np.bincount(doc_of, weights * weights, minlength=len(texts)))
+    profile_terms = list(profile)
+    profile_weights = np.fromiter(profile.values(), dtype=float, count=len(profile))
+    pos, present = _lookup(vocab, profile_terms)
+    by_term = np.zeros(len(vocab))
+    by_term[pos[present]] = profile_weights[present]
+    dots = np.bincount(doc_of, weights * by_term[term_of], minlength=len(texts))
+    np.divide(dots, norms * np.linalg.norm(profile_weights), out=scores, where=norms > 0)
+    return scores.round(6)  # short enough for the paging cursor in callback_data
+
+def build_profile(keywords: str, sample: list) -> Dict[str, float]:
+    # Keyword weights are idf over a sample of the block: words every post has say little
+    words = sorted(set(stems(keywords)))
+    if not words:
+        return {}
+    df = np.zeros(len(words))
+    counted = _term_counts(sample) if sample else None
+    if counted is not None:
+        vocab, _, term_of, _ = counted
+        pos, present = _lookup(vocab, words)
+        df[present] = np.bincount(term_of, minlength=len(vocab))[pos[present]]
+    idf = np.log((1 + len(sample)) / (1 + df)) + 1
+    return {w: round(float(v), 4) for w, v in zip(words, idf)}
+
+
+def load_profile(block: ThemeBlock) -> Dict[str, float]:
+    if block.profile:
+        return json.loads(block.profile)
+    return build_profile(block.title, [])  # no keywords yet: the title stands in
+
+async def rescore_block(block_id: int, keywords: str = None) -> int:
+    # Rebuilds the profile (and stores new keywords when given), then rescores
+    # every message of the block in SCORE_BATCH_SIZE batches
+    async with AsyncSessionLocal() as session:
+        block = await session.get(ThemeBlock, block_id)
+        if block is None:
+            return 0
+        if keywords is not None:
+            block.keywords = keywords
+        res = await session.execute(
+            select(MsgModel.content)
+            .join(Channel, Channel.id == MsgModel.channel_id)
+            .where(Channel.block_id == block_id)
+            .order_by(MsgModel.id.desc())
+            .limit(SCORE_IDF_SAMPLE)
+        )
+        profile = build_profile(block.keywords or block.title, res.scalars().all())
+        block.profile = json.dumps(profile, ensure_ascii=False)
+        await session.commit()
+
+    mt = MsgModel.__table__
+    scored, last_id = 0, 0
+    while True:
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(
+                select(MsgModel.id, MsgModel.content)
+                .join(Channel, Channel.id == MsgModel.channel_id)
+                .where(Channel.block_id == block_id, MsgModel.id > last_id)
+                .order_by(MsgModel.id)
+                .limit(SCORE_BATCH_SIZE)
+            )
+            batch = res.all()
+            if not batch:
+                break
+            scores = score_texts(profile, [r.content for r in batch])
+            await session.execute(
+                update(mt).where(mt.c.id == bindparam('mid')).values(score=bindparam('new_score')),
+                [{'mid': r.id, 'new_score': float(s)} for r, s in zip(batch, scores)]
+            )
+            await session.commit()
+        scored += len(batch)
+        last_id = batch[-1].id
+    logger.info("Rescored %d messages of block %s against %d keywords", scored, block_id, len(profile))
+    return scored
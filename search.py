@@ -0,0 +1,94 @@
+import re
+from typing import List, Optional
+
+from sqlalchemy import select, text, Integer, String, DateTime
+
+from config import SEARCH_LANGUAGE, SEARCH_SNIPPET_LEN
+from models import AsyncSessionLocal, get_engine, Message as MsgModel, RewriteTask
+
+_TOKEN = re.compile(r'\w+')
+MAX_TERMS = 16
+
+
+def terms(query: str) -> List[str]:
+    return _TOKEN.findall(query.lower())[:MAX_TERMS]
+
+# All terms must match, the last one as a prefix. Terms are \w+ only, so they
+# can't carry query syntax of either engine.
+def _fts5_query(words: list) -> str:
+    return ' '.join(f'"{w}"' for w in words[:-1]) + f' "{words[-1]}"*'
+
+def _tsquery(words: list) -> str:
+    return ' & '.join(words[:-1] + [f'{words[-1]}:*'])
+
+
+# Ranked (kind, message_id, rewrite_id, timestamp) rows; higher score is better
+_SQLITE_SEARCH = """
+SELECT kind, message_id, rewrite_id, timestamp FROM (
+    SELECT 'message' AS kind, m.id AS message_id, NULL AS rewrite_id, m.timestamp AS timestamp,
+           -bm25(messages_fts) AS score
+    FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid {block_join}
+    WHERE messages_fts MATCH :q
+    UNION ALL
+    SELECT 'rewrite', r.message_id, r.id, m.timestamp, -bm25(rewrites_fts)
+    FROM rewrites_fts JOIN rewrite_tasks r ON r.id = rewrites_fts.rowid
+    JOIN messages m ON m.id = r.message_id {block_join}
+    WHERE rewrites_fts MATCH :q
+) ORDER BY score DESC, message_id DESC LIMIT :limit OFFSET :offset
+"""
+
+_PG_SEARCH = """
+WITH query AS (SELECT to_tsquery(CAST(:language AS regconfig), :q) AS q)
+SELECT kind, message_id, rewrite_id, timestamp FROM (
+    SELECT 'message' AS kind, m.id AS message_id, NULL::integer AS rewrite_id, m.timestamp AS timestamp,
+           ts_rank_cd(m.search_vector, query.q) AS score
+    FROM query, messages m {block_join}
+    WHERE m.search_vector @@ query.q
+    UNION ALL
+    SELECT 'rewrite', r.message_id, r.id, m.timestamp, ts_rank_cd(r.search_vector, query.q)
+    FROM query, rewrite_tasks r JOIN messages m ON m.id = r.message_id {block_join}
+    WHERE r.search_vector @@ query.q
+) hits ORDER BY score DESC, message_id DESC LIMIT :limit OFFSET :offset
+"""
+
+_BLOCK_JOIN = "JOIN channels c ON c.id = m.channel_id AND c.block_id = :block_id"
+
+
+def snippet(content: str, words: list, width: int = SEARCH_SNIPPET_LEN) -> str:
+    low = content.lower()
+    found = [i for i in (low.find(w) for w in words) if i >= 0]
+    start = max(min(found, default=0) - width // 3, 0)
+    piece = ' '.join(content[start:start + width].split())
+    return ('…' if start else '') + piece + ('…' if start + width < len(content) else '')
+
+async def search(query: str, block_id: Optional[int] = None, limit: int = 10, offset: int = 0) -> list:
+    words = terms(query)
+    if not words:
+        return []
+    block_join = _BLOCK_JOIN if block_id is not None else ''
+    params = {'limit': limit, 'offset': offset, 'block_id': block_id}
+    if get_engine().dialect.name == 'postgresql':
+        sql = _PG_SEARCH.format(block_join=block_join)
+        params.update(q=_tsquery(words), language=SEARCH_LANGUAGE)
+    else:
+        sql = _SQLITE_SEARCH.format(block_join=block_join)
+        params.update(q=_fts5_query(words))
+    # Typed result columns: SQLite hands raw SQL timestamps back as strings
+    query = text(sql).columns(kind=String, message_id=Integer, rewrite_id=Integer, timestamp=DateTime)
+    async with AsyncSessionLocal() as session:
+        hits = (await session.execute(query, params)).all()
+        # Texts are read for the page only, never for every match
+        message_ids = [h.message_id for h in hits if h.kind == 'message']
+        rewrite_ids = [h.rewrite_id for h in hits if h.kind == 'rewrite']
+        contents = {}
+        if message_ids:
+            res = await session.execute(select(MsgModel.id, MsgModel.content).where(MsgModel.id.in_(message_ids)))
+            contents.update((('message', i), c) for i, c in res.all())
+        if rewrite_ids:
+            res = await session.execute(select(RewriteTask.id, RewriteTask.result).where(RewriteTask.id.in_(rewrite_ids)))
+            contents.update((('rewrite', i), c) for i, c in res.all())
+    return [
+        {'kind': h.kind, 'message_id': h.message_id, 'rewrite_id': h.rewrite_id, 'timestamp': h.timestamp,
+         'snippet': snippet(contents.get((h.kind, h.rewrite_id or h.message_id)) or '', words)}
+        for h in hits
+    ]
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import re
+from typing import Optional
+
+from sqlalchemy import select, update, cast, Integer, String
+
+from config import AVAILABLE_REWRITE_STYLES, DEFAULT_REWRITE_STYLE, SETTINGS_CHECK_INTERVAL
+from models import AsyncSessionLocal, BotConfig, insert_ignore
+import context
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = '_VERSION'  # bumped in the same transaction as every change
+TARGET_CHAT_ID = 'TARGET_CHAT_ID'
+DEFAULT_STYLE = 'DEFAULT_REWRITE_STYLE'
+_CHAT = re.compile(r'^(@[A-Za-z]\w{3,}|-?\d+)$')
+
+
+# All of bot_config in memory. Reads never touch the database: writes go
+# through to it and update this copy, and a poller compares VERSION_KEY every
+# SETTINGS_CHECK_INTERVAL to pick up changes other processes made.
+class Settings:
+    def __init__(self, check_interval: float = SETTINGS_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.version = None
+        self._values = {}
+        self._task = None
+
+    async def load(self):
+        async with AsyncSessionLocal() as session:
+            await session.execute(insert_ignore(BotConfig.__table__).values(key=VERSION_KEY, value='0'))
+            await session.commit()
+            res = await session.execute(select(BotConfig.key, BotConfig.value))
+            values = dict(res.all())
+        self.version = int(values.pop(VERSION_KEY))
+        self._values = values
+
+    async def refresh(self) -> bool:
+        async with AsyncSessionLocal() as session:
+            cfg = await session.get(BotConfig, VERSION_KEY)
+        if cfg is None or int(cfg.value) == self.version:
+            return False
+        await self.load()
+        return True
+
+    def get(self, key: str, default: str = None) -> Optional[str]:
+        return self._values.get(key, default)
+
+    async def set(self, key: str, value: str):
+        table = BotConfig.__table__
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(update(table).where(table.c.key == key).values(value=value))
+            if not res.rowcount:
+                await session.execute(insert_ignore(table).values(key=key, value=value))
+            await session.execute(insert_ignore(table).values(key=VERSION_KEY, value='0'))
+            await session.execute(
+                update(table).where(table.c.key == VERSION_KEY)
+                .values(value=cast(cast(table.c.value, Integer) + 1, String))
+            )
+            version = (await session.execute(select(table.c.value).where(table.c.key == VERSION_KEY))).scalar()
+            await session.commit()
+        self._values[key] = value
+        # Another process may have changed something in between; the poller reloads then
+        if self.version is not None and int(version) == self.version + 1:
+            self.version = int(version)
+
+    # Typed accessors
+    @property
+    def target_chat(self) -> Optional[str]:
+        return self.get(TARGET_CHAT_ID)
+
+    async def set_target_chat(self, value: str):
+        if not _CHAT.match(value):
+            raise ValueError("chat must be @username or a numeric chat id")
+        await self.set(TARGET_CHAT_ID, value)
+
+    @property
+    def default_style(self) -> str:
+        style = self.get(DEFAULT_STYLE)
+        return style if style in AVAILABLE_REWRITE_STYLES else DEFAULT_REWRITE_STYLE
+
+    async def set_default_style(self, style: str):
+        if style not in AVAILABLE_REWRITE_STYLES:
+            raise ValueError(f"unknown style {style!r}")
+        await self.set(DEFAULT_STYLE, style)
+
+    def start(self):
+        # Several roles in one process share the poller
+        if self._task is None:
+            self._task = asyncio.create_task(self._poll())
+            context.on_shutdown(self.stop)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                if await self.refresh():
+                    logger.info("Settings reloaded at version %s", self.version)
+            except Exception:
+                logger.exception("Settings refresh failed")
+
+settings = Settings()
@@ -0,0 +1,133 @@
+import argparse
+import asyncio
+import json
+import random
+import re
+
+from aiohttp import web
+
+_MARKER = re.compile(r'^<<<(\d+)>>>[ \t]*$', re.M)
+
+
+# Local stand-in for the DeepSeek /rewrite endpoint with configurable latency
+# and an injected error rate. Requests with "stream": true get server-sent
+# events of `chunk_words` words every `chunk_delay` seconds. A packed prompt of
+# <<<n>>> fragments is answered fragment by fragment, markers kept. Faults:
+# `hang_rate` of requests stall for `hang` seconds, and with `capacity` set
+# requests beyond that many in flight get 429 with a Retry-After.
+class DeepSeekStub:
+    def __init__(self, latency: float = 0.2, jitter: float = 0.05, error_rate: float = 0.0,
+                 error_status: int = 500, seed: int = None, chunk_words: int = 3, chunk_delay: float = 0.05,
+                 hang_rate: float = 0.0, hang: float = 3600, capacity: int = None, retry_after: float = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.chunk_words = chunk_words
+        self.chunk_delay = chunk_delay
+        self.hang_rate = hang_rate
+        self.hang = hang
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.inflight = 0
+        self.peak_inflight = 0
+        self._rng = random.Random(seed)
+        self.app = web.Application()
+        self.app.router.add_post('/rewrite', self.handle_rewrite)
+        self.app.router.add_get('/stats', self.handle_stats)
+        self._runner = None
+
+    async def _delay(self):
+        delay = max(self.latency + self._rng.uniform(-self.jitter, self.jitter), 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def _fail(self):
+        if self.error_rate and self._rng.random() < self.error_rate:
+            self.errors += 1
+            headers = {'Retry-After': str(self.retry_after)} if self.error_status == 429 else None
+            return web.json_response({'error': 'injected failure'}, status=self.error_status, headers=headers)
+        return None
+
+    @staticmethod
+    def rewrite(text: str, style: str) -> str:
+        parts = _MARKER.split(text)
+        if len(parts) > 1:
+            return '\n'.join(f"<<<{n}>>>\n[{style}] {body.strip()}" for n, body in zip(parts[1::2], parts[2::2]))
+        return f"[{style}] {text}"
+
+    async def handle_rewrite(self, request: web.Request):
+        self.requests += 1
+        data = await request.json()
+        if self.capacity is not None and self.inflight >= self.capacity:
+            self.rejected += 1
+            return web.json_response({'error': 'overloaded'}, status=429,
+                                     headers={'Retry-After': str(self.retry_after)})
+        self.inflight += 1
+        self.peak_inflight = max(self.peak_inflight, self.inflight)
+        try:
+            if self.hang_rate and self._rng.random() < self.hang_rate:
+                await asyncio.sleep(self.hang)
+            await self._delay()
+            failure = self._fail()
+            if failure is not None:
+                return failure
+            result = self.rewrite(data.get('text', ''), data.get('style'))
+            if data.get('stream'):
+                return await self.stream(request, result)
+            return web.json_response({'rewritten_text': result})
+        finally:
+            self.inflight -= 1
+
+    async def stream(self, request: web.Request, result: str):
+        resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await resp.prepare(request)
+        words = result.split(' ')
+        for i in range(0, len(words), self.chunk_words):
+            if i:
+                await asyncio.sleep(self.chunk_delay)
+            delta = ' '.join(words[i:i + self.chunk_words]) + (' ' if i + self.chunk_words < len(words) else '')
+            await resp.write(f"data: {json.dumps({'delta': delta}, ensure_ascii=False)}\n\n".encode('utf-8'))
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    async def handle_stats(self, request):
+        return web.json_response({'requests': self.requests, 'errors': self.errors, 'rejected': self.rejected,
+                                  'peak_inflight': self.peak_inflight})
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f'http://{host}:{port}'
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DeepSeek /rewrite stub server')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--chunk-words', type=int, default=3)
+    parser.add_argument('--chunk-delay', type=float, default=0.05)
+    parser.add_argument('--hang-rate', type=float, default=0.0)
+    parser.add_argument('--hang', type=float, default=3600)
+    parser.add_argument('--capacity', type=int, default=None, help='requests in flight before 429s')
+    parser.add_argument('--retry-after', type=float, default=0)
+    args = parser.parse_args()
+    stub = DeepSeekStub(args.latency, args.jitter, args.error_rate, args.error_status,
+                        chunk_words=args.chunk_words, chunk_delay=args.chunk_delay,
+                        hang_rate=args.hang_rate, hang=args.hang, capacity=args.capacity,
+                        retry_after=args.retry_after)
+    web.run_app(stub.app, port=args.port)
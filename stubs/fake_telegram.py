@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+
+# Minimal stand-in for the Bot API: answers the send* methods the bot uses,
+# records every call and can inject 429 Too Many Requests responses.
+class FakeTelegram:
+    def __init__(self, error_rate: float = 0.0, retry_after: int = 1, latency: float = 0.0,
+                 chat_rate: float = None, seed: int = None):
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.latency = latency
+        self.chat_rate = chat_rate  # enforce a real per-chat limit when set
+        self.calls = []
+        self.throttled = 0
+        self._last_by_chat = defaultdict(float)
+        self._message_id = 0
+        self._rng = random.Random(seed)
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+        self.app.router.add_get('/stats', self.handle_stats)
+        self._runner = None
+
+    def _message(self, chat_id, **extra):
+        self._message_id += 1
+        chat = int(chat_id) if str(chat_id).lstrip('-').isdigit() else -abs(hash(chat_id)) % 10 ** 12
+        return {'message_id': self._message_id, 'date': int(time.time()),
+                'chat': {'id': chat, 'type': 'channel'}, **extra}
+
+    def _too_many(self):
+        self.throttled += 1
+        return web.json_response({
+            'ok': False, 'error_code': 429,
+            'description': f'Too Many Requests: retry after {self.retry_after}',
+            'parameters': {'retry_after': self.retry_after}
+        }, status=429)
+
+    async def handle(self, request: web.Request):
+        method = request.match_info['method']
+        data = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = data.get('chat_id')
+        now = time.monotonic()
+        if self.error_rate and self._rng.random() < self.error_rate:
+            return self._too_many()
+        if self.chat_rate and chat_id and now - self._last_by_chat[chat_id] < 1 / self.chat_rate:
+            return self._too_many()
+        self._last_by_chat[chat_id] = now
+        self.calls.append({'method': method, 'chat_id': chat_id, 'at': now, 'data': data})
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'fake', 'username': 'fake_bot'}
+        elif method == 'sendMediaGroup':
+            media = json.loads(data.get('media', '[]'))
+            result = [self._message(chat_id, caption=m.get('caption')) for m in media]
+        elif method in ('sendPhoto', 'sendVideo', 'sendDocument'):
+            # Uploads get a file_id back, as media resolved at ingest needs
+            file = {'file_id': f'file{self._message_id + 1}', 'file_unique_id': f'u{self._message_id + 1}'}
+            kind = method[len('send'):].lower()
+            if kind == 'photo':
+                file = [{**file, 'width': 1280, 'height': 720}]
+            elif kind == 'video':
+                file = {**file, 'width': 1280, 'height': 720, 'duration': 1}
+            result = self._message(chat_id, caption=data.get('caption'), **{kind: file})
+        elif method.startswith('send') or method.startswith('edit'):
+            result = self._message(chat_id, text=data.get('text') or data.get('caption'))
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def handle_stats(self, request):
+        by_method = defaultdict(int)
+        for c in self.calls:
+            by_method[c['method']] += 1
+        return web.json_response({'calls': len(self.calls), 'throttled': self.throttled,
+                                  'by_method': by_method})
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f'http://{host}:{port}'
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Telegram Bot API server')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--chat-rate', type=float, default=None)
+    args = parser.parse_args()
+    fake = FakeTelegram(args.error_rate, args.retry_after, args.latency, args.chat_rate)
+    web.run_app(fake.app, port=args.port)
@@ -0,0 +1,83 @@
+import time
+STARTED = time.perf_counter()  # before the imports: cold start counts them
+
+import argparse
+import asyncio
+import logging
+
+from config import METRICS_HOST, METRICS_PORT, RETENTION_INTERVAL
+import context
+
+logger = logging.getLogger(__name__)
+
+
+# Background roles. A starter imports only the modules its role needs, brings
+# it up and registers the stop with the application context; the database
+# engine, the Bot and HTTP sessions are created on first use in between.
+async def start_publish():
+    from settings import settings
+    from scheduler import start_scheduler
+    from publisher import get_bot, publish_scheduled
+    await settings.load()
+    settings.start()
+    get_bot()  # before the scheduler, so it is closed after the scheduler stops
+    context.on_shutdown(start_scheduler(publish_scheduled).stop)
+
+async def start_rewrite():
+    from deepseek import get_session
+    from rewriter import pool
+    await get_session()  # closed after the pool has flushed its results
+    await pool.start()
+    context.on_shutdown(pool.stop)
+
+async def start_ingest():
+    from ingest import AutoScanner
+    scanner = AutoScanner()
+    scanner.start()
+    context.on_shutdown(scanner.stop)
+
+async def start_retention():
+    from retention import RetentionTimer
+    if not RETENTION_INTERVAL:
+        logger.info("RETENTION_INTERVAL is 0, the retention timer is off")
+        return
+    timer = RetentionTimer()
+    timer.start()
+    context.on_shutdown(timer.stop)
+
+ROLES = {
+    'publish': start_publish,
+    'rewrite': start_rewrite,
+    'ingest': start_ingest,
+    'retention': start_retention,
+}
+
+
+async def start_roles(roles: list):
+    from models import init_db
+    await init_db()
+    for role in roles:
+        await ROLES[role]()
+
+async def start_metrics(port: int):
+    if port:
+        import metrics
+        runner = await metrics.start_server(METRICS_HOST, port)
+        context.on_shutdown(runner.cleanup)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run background roles without the bot')
+    parser.add_argument('roles', nargs='+', choices=sorted(ROLES))
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT, help='0 disables /metrics')
+    parser.add_argument('--once', action='store_true', help='exit as soon as the roles are up')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    async def start():
+        await start_metrics(args.metrics_port)
+        await start_roles(args.roles)
+    asyncio.run(context.serve('+'.join(args.roles), start, STARTED, args.once))
+
+if __name__ == '__main__':
+    main()